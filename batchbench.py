@@ -0,0 +1,154 @@
+"""
+
+batchbench.py
+
+Benchmarks visibility calculations for many viewers at once, the way a 
+server would run them every tick. Compares calling 
+VisibilityEngine.get_visible_leaves() once per viewer against 
+VisibilityEngine.get_visible_leaves_batch() and VisibilityPool.
+
+"""
+
+import sys
+import time
+import random
+import argparse
+
+from bsp import BSPTree
+from visengine import VisibilityEngine, VisibilityPool
+
+
+def random_views(bspTree, numViews, rng):
+    """ Returns a list of numViews (viewPos, viewTarget) pairs, with each 
+    viewpoint inside a random visleaf of the given BSP tree.
+    
+    Viewers are placed in clusters of a few viewers per leaf, since players 
+    tend to gather in the same places.
+    
+    """
+    
+    visleaves = list(bspTree.iter_visleaves())
+    
+    views = []
+    
+    while len(views) < numViews:
+        left, top, right, bottom = rng.choice(visleaves).bounds
+        
+        for i in xrange(min(rng.randint(1, 8), numViews - len(views))):
+            viewPos = (
+                rng.randint(left, right - 1),
+                rng.randint(top, bottom - 1),
+            )
+            viewTarget = (
+                rng.randint(0, bspTree.maxWidth - 1),
+                rng.randint(0, bspTree.maxHeight - 1),
+            )
+            
+            views.append((viewPos, viewTarget))
+            
+    return views
+    
+    
+def time_call(func, *args):
+    """ Calls the given function with the given arguments, and returns a 
+    (result, seconds) tuple.
+    
+    """
+    
+    start = time.time()
+    result = func(*args)
+    
+    return result, time.time() - start
+    
+    
+def main():
+    parser = argparse.ArgumentParser(
+            description="Project VIS Batched Visibility Benchmark",
+        )
+    parser.add_argument(
+            'levelName',
+            nargs='?',
+            default='tests/crazy',
+            help="path to the level, without the '-bsp.vdf' suffix "
+                "(default: tests/crazy)",
+        )
+    parser.add_argument(
+            '--viewers',
+            type=int,
+            nargs='+',
+            default=[64, 256, 1024],
+            help="numbers of viewers to benchmark (default: 64 256 1024)",
+        )
+    parser.add_argument(
+            '--processes',
+            type=int,
+            default=None,
+            help="number of worker processes (default: one per CPU)",
+        )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help="random seed for the viewer positions (default: 0)",
+        )
+    args = parser.parse_args()
+    
+    bspFilePath = "{}-bsp.vdf".format(args.levelName)
+    
+    with open(bspFilePath, 'r') as f:
+        data = f.read()
+        
+    bspTree = BSPTree.from_vdf_fast(data)
+    bspTree.generate_portals()
+    
+    engine = VisibilityEngine(bspTree)
+    
+    # Always use the workers, so that the pool's own timings are measured.
+    pool = VisibilityPool(
+            bspTree,
+            processes=args.processes,
+            minParallelViews=0,
+        )
+        
+    rng = random.Random(args.seed)
+    
+    print "{} ({} processes)".format(bspFilePath, pool.processes)
+    print "{:>8} {:>12} {:>12} {:>12}".format(
+            "viewers", "single (ms)", "batch (ms)", "pool (ms)",
+        )
+        
+    try:
+        for numViews in args.viewers:
+            views = random_views(bspTree, numViews, rng)
+            
+            singleResults, singleTime = time_call(
+                    lambda: [
+                        frozenset(engine.get_visible_leaves(*view))
+                        for view in views
+                    ]
+                )
+                
+            batchResults, batchTime = time_call(
+                    engine.get_visible_leaves_batch, views,
+                )
+                
+            poolResults, poolTime = time_call(
+                    pool.get_visible_leaves_batch, views,
+                )
+                
+            assert batchResults == singleResults
+            assert poolResults == singleResults
+            
+            print "{:>8} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                    numViews,
+                    singleTime * 1000, batchTime * 1000, poolTime * 1000,
+                )
+                
+    finally:
+        pool.close()
+        
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main())
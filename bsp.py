@@ -9,10 +9,13 @@ at geometry. :(
 """
 
 import gc
-from itertools import izip, product, permutations
+from itertools import izip, chain, product, permutations
 from collections import OrderedDict
 
-from vdfutils import parse_vdf, format_vdf
+from vdfutils import (
+        parse_vdf, format_vdf, iter_vdf_tokens, VDFConsistencyFailure,
+        TOKEN_STRING, TOKEN_OPEN, TOKEN_CLOSE,
+    )
 
 __all__ = (
     'BSPTree',
@@ -31,17 +34,26 @@ COLOR_CYAN = (0, 255, 255)
 
 
 class BSPTree(object):
-    def __init__(self, maxWidth, maxHeight):
+    def __init__(self, maxWidth, maxHeight, origin=(0, 0)):
         self.maxWidth = maxWidth
         self.maxHeight = maxHeight
         
-        self.head = BSPLeaf(None, (0, 0, maxWidth, maxHeight))
+        # The coordinates of the tree's top-left corner. Only trees that are 
+        # chunks of a larger world (see world.py) don't start at (0, 0).
+        self.origin = origin
+        
+        self.head = BSPLeaf(None, self.get_bounds())
         
         # Populated with portal instances once .generate_portals() is called.
         self.portals = set()
         
     def __repr__(self):
-        return "BSPTree({}, {})".format(self.maxWidth, self.maxHeight)
+        if self.origin == (0, 0):
+            return "BSPTree({}, {})".format(self.maxWidth, self.maxHeight)
+        else:
+            return "BSPTree({}, {}, {})".format(
+                    self.maxWidth, self.maxHeight, self.origin,
+                )
         
     def __str__(self):
         return "<BSPTree ({}x{}) with head: {}>".format(
@@ -59,7 +71,12 @@ class BSPTree(object):
         bspDict = parse_vdf(data)['BSP']
         
         # Instantiate a new BSP tree.
-        b = cls(bspDict['maxWidth'], bspDict['maxHeight'])
+        origin = (
+            int(bspDict.get('originX', 0)),
+            int(bspDict.get('originY', 0)),
+        )
+        
+        b = cls(bspDict['maxWidth'], bspDict['maxHeight'], origin)
         
         # A dictionary of all elements in the BSP tree.
         elementsDict = bspDict['elements']
@@ -97,6 +114,195 @@ class BSPTree(object):
         
         return b
         
+    @classmethod
+    def from_vdf_fast(cls, data):
+        ''' Constructs a new BSP tree from a set of VDF KeyValues data, 
+        building the BSP elements directly from the VDF tokens instead of 
+        parsing the whole document into nested dictionaries first.
+        
+        Produces the same tree as .from_vdf(), except that the tree's 
+        maxWidth and maxHeight are stored as integers rather than strings.
+        
+        '''
+        
+        tokens = iter_vdf_tokens(data)
+        
+        def next_token():
+            ''' Returns the next (tokenType, value, index) token. '''
+            
+            try:
+                return next(tokens)
+            except StopIteration:
+                raise VDFConsistencyFailure("Unexpected end of data!")
+                
+        def next_string():
+            ''' Returns the value of the next token, which must be a string.
+            '''
+            
+            tokenType, value, index = next_token()
+            
+            if tokenType != TOKEN_STRING:
+                raise VDFConsistencyFailure(
+                        "Expected a value at index {}!".format(index)
+                    )
+                    
+            return value
+            
+        def iter_block_keys():
+            ''' Consumes the opening bracket of a block and returns an 
+            iterator over the keys within that block. The caller must consume 
+            each key's value before advancing the iterator. The block's 
+            closing bracket is consumed when the iterator is exhausted.
+            
+            '''
+            
+            tokenType, value, index = next_token()
+            
+            if tokenType != TOKEN_OPEN:
+                raise VDFConsistencyFailure(
+                        "Expected a block at index {}!".format(index)
+                    )
+                    
+            while 1:
+                tokenType, value, index = next_token()
+                
+                if tokenType == TOKEN_CLOSE:
+                    return
+                elif tokenType == TOKEN_OPEN:
+                    raise VDFConsistencyFailure("Brackets have no heading!")
+                    
+                yield value
+                
+        def skip_value():
+            ''' Consumes the next value, whether it is a string or a block. '''
+            
+            tokenType, value, index = next_token()
+            
+            if tokenType == TOKEN_CLOSE:
+                raise VDFConsistencyFailure("Key without value!")
+                
+            elif tokenType == TOKEN_OPEN:
+                depth = 1
+                while depth:
+                    tokenType, value, index = next_token()
+                    
+                    if tokenType == TOKEN_OPEN:
+                        depth += 1
+                    elif tokenType == TOKEN_CLOSE:
+                        depth -= 1
+                        
+        def read_element():
+            ''' Reads a single serialized BSP element and returns a 
+            (newElem, leftIndex, rightIndex) tuple. The child indices are 
+            None for BSP leaves.
+            
+            '''
+            
+            bounds = None
+            fields = {}
+            
+            for key in iter_block_keys():
+                if key == 'bounds':
+                    boundsFields = {}
+                    for boundsKey in iter_block_keys():
+                        boundsFields[boundsKey] = int(next_string())
+                        
+                    bounds = (
+                        boundsFields['left'],
+                        boundsFields['top'],
+                        boundsFields['right'],
+                        boundsFields['bottom'],
+                    )
+                    
+                elif key in ELEMENT_FIELDS:
+                    fields[key] = next_string()
+                    
+                else:
+                    skip_value()
+                    
+            if fields['type'] == BSPNode.__name__:
+                newElem = BSPNode(
+                        None, bounds,
+                        int(fields['orientation']),
+                        int(fields['partition']),
+                    )
+                    
+                return newElem, int(fields['left']), int(fields['right'])
+                
+            elif fields['type'] == BSPLeaf.__name__:
+                solid = fields['solid']
+                
+                assert solid in (str(True), str(False))
+                
+                newElem = BSPLeaf(None, bounds)
+                newElem.leafID = int(fields['leafID'])
+                newElem.solid = (solid == str(True))
+                
+                return newElem, None, None
+                
+            else:
+                assert False
+                
+        # Keys of each serialized element that hold plain values.
+        ELEMENT_FIELDS = frozenset(
+                (
+                    'type', 'orientation', 'partition', 'left', 'right',
+                    'leafID', 'solid',
+                )
+            )
+            
+        maxWidth = None
+        maxHeight = None
+        originX = originY = 0
+        
+        # List of all BSP elements, and of each element's child indices.
+        elements = []
+        childIndices = []
+        
+        # Skip any top-level data that precedes the BSP block.
+        while next_string() != 'BSP':
+            skip_value()
+            
+        for key in iter_block_keys():
+            if key == 'maxWidth':
+                maxWidth = int(next_string())
+                
+            elif key == 'maxHeight':
+                maxHeight = int(next_string())
+                
+            elif key == 'originX':
+                originX = int(next_string())
+                
+            elif key == 'originY':
+                originY = int(next_string())
+                
+            elif key == 'elements':
+                for elementKey in iter_block_keys():
+                    newElem, leftIndex, rightIndex = read_element()
+                    
+                    elements.append(newElem)
+                    childIndices.append((leftIndex, rightIndex))
+                    
+            else:
+                skip_value()
+                
+        # Instantiate a new BSP tree.
+        b = cls(maxWidth, maxHeight, (originX, originY))
+        
+        # Link all element relationships.
+        for element, (leftIndex, rightIndex) in izip(elements, childIndices):
+            if leftIndex is not None:
+                element.left = elements[leftIndex]
+                element.right = elements[rightIndex]
+                
+                element.left.parent = element
+                element.right.parent = element
+                
+        # Set the first element to be the BSP tree's head node.
+        b.head = elements[0]
+        
+        return b
+        
     def to_vdf(self):
         ''' Serializes the BSP tree to VDF KeyValues format. '''
         
@@ -154,15 +360,31 @@ class BSPTree(object):
                 (
                     ('maxWidth', self.maxWidth),
                     ('maxHeight', self.maxHeight),
-                    ('elements', bspElementsDict),
                 )
             )
             
+        # Trees at the default origin are written the way they always were.
+        if self.origin != (0, 0):
+            bspDict['originX'], bspDict['originY'] = self.origin
+            
+        bspDict['elements'] = bspElementsDict
+        
         # Ensure that the BSP dictionary only contains strings.
         bspDict = str_items(bspDict)
         
         return format_vdf(OrderedDict(BSP=bspDict))
         
+    def get_bounds(self):
+        ''' Returns the (left, top, right, bottom) bounds of the whole tree. 
+        '''
+        
+        originX, originY = self.origin
+        
+        return (
+            originX, originY,
+            originX + int(self.maxWidth), originY + int(self.maxHeight),
+        )
+        
     def iter_elements(self):
         ''' Returns a iterator over all elements in the BSP tree. '''
         
@@ -306,7 +528,8 @@ class BSPTree(object):
         
     def divide_leaf(self, leaf, orientation, partition):
         ''' Given a BSP leaf, divide that leaf into a BSP node with two leaf 
-        children using the given partition and orientation.
+        children using the given partition and orientation. Returns the new 
+        BSP node.
         
         '''
         
@@ -314,6 +537,8 @@ class BSPTree(object):
             assert leaf is self.head
             self.head = BSPNode(None, leaf.bounds, orientation, partition)
             
+            return self.head
+            
         else:
             parent = leaf.parent
             
@@ -341,6 +566,8 @@ class BSPTree(object):
             assert parent.left.parent is parent
             assert parent.right.parent is parent
             
+            return newNode
+            
     def merge_leaf(self, leaf):
         ''' Consolidate all children of a given BSP leaf's parent into a 
         single BSP leaf.
@@ -353,8 +580,7 @@ class BSPTree(object):
             if parent is None:
                 return
             elif parent is self.head:
-                bounds = (0, 0, self.maxWidth, self.maxHeight)
-                self.head = BSPLeaf(None, bounds)
+                self.head = BSPLeaf(None, self.get_bounds())
                 return
                 
             parentParent = parent.parent
@@ -371,11 +597,220 @@ class BSPTree(object):
             # chance that we created unreachable references while merging.
             gc.collect()
             
-    def segment_collision(self, startPos, endPos):
+    def carve_rect(self, rect, solid):
+        ''' Makes every point within the given (left, top, right, bottom) 
+        rectangle solid or non-solid, in one pass. Leaves that the rectangle 
+        only partly covers are divided along the rectangle's edges first, 
+        while leaves that already have the right solidity are left whole, so 
+        only the splits that are actually needed are made. 
+        
+        The portals are updated once at the end, around the changed leaves 
+        only (see .update_portals()). Every PVS is cleared, since carving can 
+        open or close lines of sight anywhere in the tree. 
+        
+        Returns a (removedLeaves, changedLeaves) tuple of sets, holding the 
+        leaves that were divided and are no longer in the tree, and the 
+        leaves that are either new or have changed solidity. 
+        
+        '''
+        
+        treeLeft, treeTop, treeRight, treeBottom = self.get_bounds()
+        
+        left = max(rect[0], treeLeft)
+        top = max(rect[1], treeTop)
+        right = min(rect[2], treeRight)
+        bottom = min(rect[3], treeBottom)
+        
+        removedLeaves = set()
+        changedLeaves = set()
+        
+        if left >= right or top >= bottom:
+            return removedLeaves, changedLeaves
+            
+        # The partitions that cut a leaf along the rectangle's edges, and 
+        # whether the part inside the rectangle is the new node's right child.
+        cuts = (
+            (BSPNode.Orientation.VERTI, left, True),
+            (BSPNode.Orientation.VERTI, right, False),
+            (BSPNode.Orientation.HORIZ, top, True),
+            (BSPNode.Orientation.HORIZ, bottom, False),
+        )
+        
+        nodeStack = [self.head]
+        while nodeStack:
+            node = nodeStack.pop()
+            
+            nodeLeft, nodeTop, nodeRight, nodeBottom = node.bounds
+            
+            if (nodeRight <= left or right <= nodeLeft
+                    or nodeBottom <= top or bottom <= nodeTop):
+                continue    # Not within the rectangle.
+                
+            if type(node) is BSPNode:
+                nodeStack.append(node.left)
+                nodeStack.append(node.right)
+                continue
+                
+            leaf = node
+            
+            if leaf.solid == solid:
+                continue
+                
+            for orientation, partition, insideIsRight in cuts:
+                if orientation == BSPNode.Orientation.VERTI:
+                    start, end = leaf.bounds[0], leaf.bounds[2]
+                else:
+                    start, end = leaf.bounds[1], leaf.bounds[3]
+                    
+                if not (start < partition < end):
+                    continue
+                    
+                newNode = self.divide_leaf(leaf, orientation, partition)
+                newNode.left.solid = newNode.right.solid = leaf.solid
+                
+                # Leaves that were made during this carve were never seen 
+                # by the caller, so they don't count as removed.
+                if leaf in changedLeaves:
+                    changedLeaves.remove(leaf)
+                else:
+                    removedLeaves.add(leaf)
+                    
+                changedLeaves.add(newNode.left)
+                changedLeaves.add(newNode.right)
+                
+                if insideIsRight:
+                    leaf = newNode.right
+                else:
+                    leaf = newNode.left
+                    
+            leaf.solid = solid
+            changedLeaves.add(leaf)
+            
+        if changedLeaves:
+            self.update_portals(removedLeaves, changedLeaves)
+            
+            for visleaf in self.iter_visleaves():
+                visleaf.pvs.clear()
+                
+        return removedLeaves, changedLeaves
+        
+    def graft_changes(self, newTree):
+        ''' Updates this tree in place to match the given tree, which must 
+        have the same bounds. Parts of the tree that are the same in both 
+        trees are kept as they are, so leaves outside of the changed regions 
+        stay the same objects, and anything keyed by them stays valid. Each 
+        subtree that differs is replaced by the given tree's version of it, 
+        which takes the given tree apart. 
+        
+        As with .carve_rect(), the portals are only updated around the 
+        changed leaves, and every PVS is cleared if anything changed. 
+        
+        Returns a (removedLeaves, changedLeaves) tuple of sets, holding the 
+        leaves that are no longer in the tree, and the leaves that are 
+        either new or have changed solidity. 
+        
+        '''
+        
+        assert self.get_bounds() == newTree.get_bounds()
+        
+        removedLeaves = set()
+        changedLeaves = set()
+        
+        nodeStack = [(self.head, newTree.head)]
+        while nodeStack:
+            node, newNode = nodeStack.pop()
+            
+            if type(node) is BSPNode and type(newNode) is BSPNode:
+                if (node.orientation == newNode.orientation
+                        and node.partition == newNode.partition):
+                    nodeStack.append((node.left, newNode.left))
+                    nodeStack.append((node.right, newNode.right))
+                    continue
+                    
+            elif type(node) is BSPLeaf and type(newNode) is BSPLeaf:
+                if node.solid != newNode.solid:
+                    node.solid = newNode.solid
+                    changedLeaves.add(node)
+                    
+                continue
+                
+            # The subtrees are shaped differently, so graft the new one in.
+            parent = node.parent
+            newNode.parent = parent
+            
+            if parent is None:
+                self.head = newNode
+            elif node is parent.left:
+                parent.left = newNode
+            elif node is parent.right:
+                parent.right = newNode
+            else:
+                assert False
+                
+            removedLeaves.update(iter_subtree_leaves(node))
+            
+            for leaf in iter_subtree_leaves(newNode):
+                # The new tree's leaf IDs may clash with ours.
+                leaf.leafID = BSPLeaf._numLeaves
+                BSPLeaf._numLeaves += 1
+                
+                changedLeaves.add(leaf)
+                
+        if changedLeaves:
+            self.update_portals(removedLeaves, changedLeaves)
+            
+            for visleaf in self.iter_visleaves():
+                visleaf.pvs.clear()
+                
+        return removedLeaves, changedLeaves
+        
+    def update_portals(self, removedLeaves, changedLeaves):
+        ''' Brings the portals up to date after the given leaves were removed 
+        from the tree, and the given leaves were added to it or changed 
+        solidity, without regenerating the portals of the rest of the tree. 
+        
+        '''
+        
+        # Drop every portal that leads into a removed or changed leaf.
+        for leaf in chain(removedLeaves, changedLeaves):
+            for portal in leaf.portals:
+                self.portals.discard(portal)
+                portal.get_other(leaf).portals.discard(portal)
+                
+            leaf.portals.clear()
+            
+        # A set of (unordered) visleaf pairs that have already been processed.
+        alreadyProcessed = set()
+        
+        for visleaf in changedLeaves:
+            if visleaf.solid:
+                continue
+                
+            for neighbor in visleaf.iter_neighbors():
+                if neighbor.solid:
+                    continue    # Only process visleaf pairs.
+                    
+                pair = frozenset({visleaf, neighbor})
+                
+                if pair in alreadyProcessed:
+                    continue
+                    
+                portal = BSPPortal(visleaf, neighbor)
+                alreadyProcessed.add(pair)
+                
+                self.portals.add(portal)
+                visleaf.portals.add(portal)
+                neighbor.portals.add(portal)
+                
+    def segment_collision(self, startPos, endPos, nudgeStart=True):
         ''' Returns the first solid leaf that the given line segment collides
         with, if any. Returns None if the line does not collide with any solid 
         leaf.
         
+        The start point is nudged over as described below, unless nudgeStart 
+        is False, for segments that are pieces of a longer, already-nudged 
+        segment.
+        
         '''
         
         def point_on_edge(point, bounds):
@@ -508,11 +943,8 @@ class BSPTree(object):
         # either direction, to avoid (some) false-collision corner cases. It 
         # won't eliminate all of them, but it should eliminate at least enough 
         # for LOS calculation routines to not completely screw up.
-        if endPos[0] < startPos[0]:
-            startPos = (startPos[0] - 1, startPos[1])
-            
-        if endPos[1] < startPos[1]:
-            startPos = (startPos[0], startPos[1] - 1)
+        if nudgeStart:
+            startPos = nudge_segment_start(startPos, endPos)
             
         return node_seg_collision(self.head, startPos, endPos)
         
@@ -981,34 +1413,34 @@ class BSPPortal(object):
         self.leaf1 = leaf1
         self.leaf2 = leaf2
         
-        if leaf1.is_left_neighbor_of(leaf2):
-            neighborRelation = 'L'
+        neighborRelation = self.get_neighbor_relation(leaf1, leaf2)
+        
+        if neighborRelation == 'L':
             startX = endX = leaf1.bounds[2]
-            
-        elif leaf1.is_top_neighbor_of(leaf2):
-            neighborRelation = 'T'
+        elif neighborRelation == 'T':
             startY = endY = leaf1.bounds[3]
-            
-        elif leaf1.is_right_neighbor_of(leaf2):
-            neighborRelation = 'R'
+        elif neighborRelation == 'R':
             startX = endX = leaf1.bounds[0]
-            
-        elif leaf1.is_bottom_neighbor_of(leaf2):
-            neighborRelation = 'B'
+        elif neighborRelation == 'B':
             startY = endY = leaf1.bounds[1]
-            
         else:
             assert False
             
         if neighborRelation in ('L', 'R'):
             self.orientation = BSPNode.Orientation.VERTI
             
+            # Index of the coordinate that is constant along the portal.
+            self.axis = 0
+            
             startY = max(leaf1.bounds[1], leaf2.bounds[1])
             endY = min(leaf1.bounds[3], leaf2.bounds[3])
             
         elif neighborRelation in ('T', 'B'):
             self.orientation = BSPNode.Orientation.HORIZ
             
+            # Index of the coordinate that is constant along the portal.
+            self.axis = 1
+            
             startX = max(leaf1.bounds[0], leaf2.bounds[0])
             endX = min(leaf1.bounds[2], leaf2.bounds[2])
             
@@ -1018,9 +1450,39 @@ class BSPPortal(object):
         self.start = (startX, startY)
         self.end = (endX, endY)
         
+        # Coefficients of the portal's line, which consists of every point p 
+        # for which dot(self.normal, p) == self.offset. The normal points 
+        # from leaf1 into leaf2.
+        self.normal = {
+            'L': (1, 0),
+            'T': (0, 1),
+            'R': (-1, 0),
+            'B': (0, -1),
+        }[neighborRelation]
+        
+        self.offset = self.normal[0] * startX + self.normal[1] * startY
+        
+    @staticmethod
+    def get_neighbor_relation(leaf1, leaf2):
+        ''' Returns 'L', 'T', 'R' or 'B' if the first leaf is respectively a 
+        left, top, right or bottom neighbor of the second leaf.
+        
+        '''
+        
+        if leaf1.is_left_neighbor_of(leaf2):
+            return 'L'
+        elif leaf1.is_top_neighbor_of(leaf2):
+            return 'T'
+        elif leaf1.is_right_neighbor_of(leaf2):
+            return 'R'
+        elif leaf1.is_bottom_neighbor_of(leaf2):
+            return 'B'
+        else:
+            assert False
+            
     def __repr__(self):
-        return "BSPPortal({}, {})".format(
-                repr(self.leaf1), repr(self.leaf2)
+        return "{}({}, {})".format(
+                type(self).__name__, repr(self.leaf1), repr(self.leaf2)
             )
             
     def __str__(self):
@@ -1086,6 +1548,36 @@ class BSPPortal(object):
         yield self.end
         
         
+def iter_subtree_leaves(element):
+    """ Returns an iterator over all BSP leaves in the subtree headed by the 
+    given BSP element. 
+    
+    """
+    
+    nodeStack = [element]
+    while nodeStack:
+        node = nodeStack.pop()
+        
+        if type(node) is BSPNode:
+            nodeStack.append(node.left)
+            nodeStack.append(node.right)
+        else:
+            yield node
+            
+            
+def nudge_segment_start(startPos, endPos):
+    """ Returns the start point of the given line segment, moved back by a 
+    pixel along each axis that the segment runs "backwards" along. """
+    
+    if endPos[0] < startPos[0]:
+        startPos = (startPos[0] - 1, startPos[1])
+        
+    if endPos[1] < startPos[1]:
+        startPos = (startPos[0], startPos[1] - 1)
+        
+    return startPos
+    
+    
 def segments_intersect(seg1, seg2):
     """ Returns whether or not two line segments intersect. """
     
@@ -19,10 +19,18 @@ so graphics.pyd works perfectly fine in this tool.
 
 """
 
+import os
 import sys
+import time
+import ctypes
+import tempfile
+import threading
+
+import pygame
 
 import graphics
 from bsp import BSPTree, BSPElement, BSPNode, BSPLeaf
+from snapshot import BSPSnapshot, EditHistory
 
 BLOCK_SIZE = 32
 
@@ -34,6 +42,17 @@ HEIGHT = BL_HEIGHT * BLOCK_SIZE
 
 FRAMERATE = 60
 
+# How often unsaved edits are written to the autosave file, in seconds.
+AUTOSAVE_INTERVAL = 30
+AUTOSAVE_SUFFIX = '.autosave'
+
+# How many edits can be undone.
+MAX_UNDOS = 1000
+
+# Flags for MoveFileExW() on Windows.
+MOVEFILE_REPLACE_EXISTING = 0x1
+MOVEFILE_WRITE_THROUGH = 0x8
+
 COLOR_BLACK = (0, 0, 0)
 COLOR_GRAY = (128, 128, 128)
 COLOR_WHITE = (255, 255, 255)
@@ -68,6 +87,206 @@ def snap_to_grid(x, y):
     )
     
     
+class SurfaceCanvas(object):
+    """ Wraps a Pygame surface in the parts of the graphics.Canvas drawing 
+    interface that the BSP trees use, so that they can be drawn off-screen. 
+    
+    """
+    
+    def __init__(self, surface):
+        self.surface = surface
+        
+    def fill_box(self, topLeft, bottomRight, color):
+        rect = pygame.Rect(
+                topLeft,
+                (bottomRight[0] - topLeft[0], bottomRight[1] - topLeft[1]),
+            )
+            
+        self.surface.fill(color, rect)
+        
+    def draw_line(self, start, end, color):
+        pygame.draw.line(self.surface, color, start, end)
+        
+        
+class StaticLayer(object):
+    """ A cached image of the parts of the editor that only change when the 
+    tree is edited: the leaves, the grid and the partitions. 
+    
+    When the layer is brought up to date with a new snapshot, only the 
+    regions that differ from the last snapshot are drawn again. 
+    
+    """
+    
+    def __init__(self, size, depthSurface=None):
+        if depthSurface is None:
+            self.surface = pygame.Surface(size)
+        else:
+            self.surface = pygame.Surface(size, 0, depthSurface)
+            
+        self.canvas = SurfaceCanvas(self.surface)
+        
+        # The snapshot that the layer currently shows.
+        self.snapshot = None
+        
+    def update(self, snapshot):
+        ''' Brings the layer up to date with the given snapshot, and 
+        returns its surface. 
+        
+        '''
+        
+        if snapshot is self.snapshot:
+            return self.surface
+            
+        if self.snapshot is None:
+            self.redraw(snapshot, None)
+        else:
+            for bounds in snapshot.iter_changes(self.snapshot):
+                self.redraw(snapshot, bounds)
+                
+        self.snapshot = snapshot
+        
+        return self.surface
+        
+    def redraw(self, snapshot, bounds):
+        ''' Draws the given region of the given snapshot onto the layer, or 
+        the whole snapshot if bounds is None. 
+        
+        '''
+        
+        if bounds is not None:
+            left, top, right, bottom = bounds
+            self.surface.set_clip(
+                    pygame.Rect(left, top, right - left, bottom - top),
+                )
+                
+        snapshot.draw_leaves(self.canvas, bounds)
+        
+        draw_grid(self.canvas)
+        
+        snapshot.draw_partitions(self.canvas, bounds)
+        
+        self.surface.set_clip(None)
+        
+        
+def replace_file(sourcePath, destPath):
+    """ Renames the given source file to the given destination in a single 
+    step, replacing the destination if it exists. 
+    
+    """
+    
+    if os.name != 'nt':
+        os.rename(sourcePath, destPath)
+        return
+        
+    # Python 2's os.rename() won't replace an existing file on Windows, and 
+    # removing the file first would leave no file at all if we crashed in 
+    # between, so ask Windows to replace it directly.
+    encoding = sys.getfilesystemencoding()
+    
+    if isinstance(sourcePath, str):
+        sourcePath = sourcePath.decode(encoding)
+    if isinstance(destPath, str):
+        destPath = destPath.decode(encoding)
+        
+    if not ctypes.windll.kernel32.MoveFileExW(
+            sourcePath, destPath,
+            MOVEFILE_REPLACE_EXISTING | MOVEFILE_WRITE_THROUGH):
+        raise ctypes.WinError()
+        
+        
+def write_atomically(path, data):
+    """ Writes the given data to the given path without ever leaving a 
+    partially written file there. The data is written to a temporary file in 
+    the same directory first, which then replaces the original (see 
+    replace_file()). 
+    
+    """
+    
+    directory, fileName = os.path.split(os.path.abspath(path))
+    
+    # Keep the permissions of the file being replaced, since temporary files 
+    # are only readable by their owner.
+    try:
+        mode = os.stat(path).st_mode & 0777
+    except OSError:
+        mode = 0644
+        
+    fd, tempPath = tempfile.mkstemp(
+            prefix='.' + fileName, suffix='.tmp', dir=directory,
+        )
+        
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            
+        os.chmod(tempPath, mode)
+        
+        replace_file(tempPath, path)
+        
+    except:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+        
+        
+class SaveWorker(object):
+    """ Serializes and writes tree snapshots on a background thread, so that 
+    the editor never waits on to_vdf() or the disk. 
+    
+    Snapshots are never modified, so they can be handed to the worker as-is. 
+    If several saves to the same path pile up, only the newest snapshot is 
+    written. 
+    
+    """
+    
+    def __init__(self):
+        self._condition = threading.Condition()
+        
+        # Maps paths to the snapshots that are waiting to be written there.
+        self._pending = {}
+        self._closed = False
+        
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def save(self, snapshot, path):
+        ''' Queues the given snapshot to be written to the given path. '''
+        
+        with self._condition:
+            self._pending[path] = snapshot
+            self._condition.notify()
+            
+    def close(self):
+        ''' Waits for all queued saves to finish, and stops the worker. '''
+        
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            
+        self._thread.join()
+        
+    def _run(self):
+        while 1:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                    
+                if not self._pending:
+                    return
+                    
+                path, snapshot = self._pending.popitem()
+                
+            try:
+                write_atomically(path, snapshot.to_vdf())
+            except (IOError, OSError) as e:
+                print >> sys.stderr, "Couldn't save {}: {}".format(path, e)
+            else:
+                print "Saved {}".format(path)
+                
+                
 def main():
     c = graphics.Canvas(WIDTH, HEIGHT)
     c.show()
@@ -80,12 +299,28 @@ def main():
         with open(bspFilePath, 'r') as f:
             data = f.read()
             
-        b = BSPTree.from_vdf(data)
+        b = BSPTree.from_vdf_fast(data)
         
     else:
         bspFilePath = 'out-bsp.vdf'
         b = BSPTree(WIDTH, HEIGHT)
         
+    # Every edit is made to a snapshot of the tree, which keeps the old 
+    # snapshots intact for undo/redo.
+    history = EditHistory(BSPSnapshot.from_tree(b), maxUndos=MAX_UNDOS)
+    
+    saveWorker = SaveWorker()
+    
+    # Edits are autosaved next to the map, rather than over it.
+    autosavePath = bspFilePath + AUTOSAVE_SUFFIX
+    autosavedSnapshot = history.current
+    autosaveTime = time.time()
+    
+    # graphics.Canvas draws straight onto the Pygame display surface, so the 
+    # static layer can be copied onto it before the rest is drawn on top.
+    screen = pygame.display.get_surface()
+    staticLayer = StaticLayer((WIDTH, HEIGHT), screen)
+    
     startPos = None
     
     clickLock = False
@@ -94,11 +329,9 @@ def main():
         mousePos = c.get_mouse_pos()
         snappedCoords = snap_to_grid(*mousePos)
         
-        b.draw_leaves(c)
+        b = history.current
         
-        draw_grid(c)
-        
-        b.draw_partitions(c)
+        screen.blit(staticLayer.update(b), (0, 0))
         
         leaf = b.leaf_from_coords(*mousePos)
         
@@ -121,18 +354,27 @@ def main():
                 
         elif c.get_mouse_r():
             if not clickLock:
-                leaf.solid = not leaf.solid
+                history.push(b.set_solid(mousePos, not leaf.solid))
                 clickLock = True
                 
         elif keysPressed['delete']:
             if not clickLock:
-                b.merge_leaf(leaf)
+                history.push(b.merge_leaf(mousePos))
+                clickLock = True
+                
+        elif keysPressed['left ctrl'] and keysPressed['z']:
+            if not clickLock:
+                history.undo()
+                clickLock = True
+                
+        elif keysPressed['left ctrl'] and keysPressed['y']:
+            if not clickLock:
+                history.redo()
                 clickLock = True
                 
         elif keysPressed['left ctrl'] and keysPressed['s']:
             if not clickLock:
-                with open(bspFilePath, 'w') as f:
-                    f.write(b.to_vdf())
+                saveWorker.save(b, bspFilePath)
                 clickLock = True
                 
         else:
@@ -161,7 +403,9 @@ def main():
                         partition = None
                         
                     if None not in (orientation, partition):
-                        b.divide_leaf(leaf, orientation, partition)
+                        history.push(
+                                b.divide_leaf(mousePos, orientation, partition)
+                            )
                         
                     startPos = None
                     
@@ -175,8 +419,18 @@ def main():
         
         c.refresh()
         
+        now = time.time()
+        if (history.current is not autosavedSnapshot
+                and now - autosaveTime >= AUTOSAVE_INTERVAL):
+            autosavedSnapshot = history.current
+            autosaveTime = now
+            
+            saveWorker.save(autosavedSnapshot, autosavePath)
+            
         graphics.wait_framerate(FRAMERATE)
         
+    saveWorker.close()
+    
     return 0
     
     
@@ -0,0 +1,512 @@
+"""
+
+microbench.py
+
+Micro-benchmarks for the hot paths of bsp.py and vdfutils.py. Each benchmark 
+is timed on the bundled maps and on maps of 1k, 10k and 100k leaves made by 
+stressmap.py, and the results can be saved as a baseline for later runs to be 
+compared against.
+
+Every benchmark runs in a process of its own, so that the peak memory it 
+reports (the peak resident set size of that process, as given by the 
+resource module) isn't skewed by the benchmarks that ran before it. Peak 
+memory isn't available on platforms without the resource module.
+
+"""
+
+import os
+import sys
+import glob
+import json
+import random
+import shutil
+import timeit
+import argparse
+import tempfile
+import multiprocessing
+from Queue import Empty
+from itertools import product
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+    
+import stressmap
+from vdfutils import parse_vdf, format_vdf
+from bsp import BSPTree, segments_intersect
+
+# Number of queries made by each call of the query benchmarks.
+QUERIES_PER_CALL = 1000
+
+# Leaf counts of the generated maps.
+DEFAULT_SCALES = (1000, 10000, 100000)
+
+# How much slower a benchmark may get, or how much more memory it may use, 
+# than its baseline before it is reported as a regression.
+DEFAULT_THRESHOLD = 0.2
+
+
+def random_points(bspTree, rng):
+    """ Returns QUERIES_PER_CALL random points within the given BSP tree. """
+    
+    return [
+        (
+            rng.randrange(bspTree.maxWidth),
+            rng.randrange(bspTree.maxHeight),
+        )
+        for i in xrange(QUERIES_PER_CALL)
+    ]
+    
+    
+def random_segments(bspTree, rng, maxLength=200):
+    """ Returns QUERIES_PER_CALL random line segments within the given BSP 
+    tree, each no longer than maxLength along either axis.
+    
+    """
+    
+    segments = []
+    
+    for start in random_points(bspTree, rng):
+        end = (
+            min(max(start[0] + rng.randint(-maxLength, maxLength), 0),
+                bspTree.maxWidth - 1),
+            min(max(start[1] + rng.randint(-maxLength, maxLength), 0),
+                bspTree.maxHeight - 1),
+        )
+        
+        segments.append((start, end))
+        
+    return segments
+    
+    
+def load_tree(data, portals=False):
+    """ Builds a BSP tree from the given VDF data, along with its portals if 
+    asked to.
+    
+    """
+    
+    bspTree = BSPTree.from_vdf_fast(data)
+    
+    if portals:
+        bspTree.generate_portals()
+        
+    return bspTree
+    
+    
+# Each benchmark takes the VDF data of a map and a random number generator, 
+# does any setup it needs, and returns a function that does the work being 
+# timed.
+
+def bench_parse_vdf(data, rng):
+    return lambda: parse_vdf(data)
+    
+    
+def bench_format_vdf(data, rng):
+    parsed = parse_vdf(data)
+    return lambda: format_vdf(parsed)
+    
+    
+def bench_from_vdf(data, rng):
+    return lambda: BSPTree.from_vdf(data)
+    
+    
+def bench_from_vdf_fast(data, rng):
+    return lambda: BSPTree.from_vdf_fast(data)
+    
+    
+def bench_to_vdf(data, rng):
+    return load_tree(data).to_vdf
+    
+    
+def bench_generate_portals(data, rng):
+    return load_tree(data).generate_portals
+    
+    
+def bench_leaf_from_coords(data, rng):
+    bspTree = load_tree(data)
+    points = random_points(bspTree, rng)
+    
+    def run():
+        for x, y in points:
+            bspTree.leaf_from_coords(x, y)
+            
+    return run
+    
+    
+def bench_iter_neighbors(data, rng):
+    bspTree = load_tree(data)
+    
+    leaves = list(bspTree.iter_leaves())
+    leaves = [rng.choice(leaves) for i in xrange(QUERIES_PER_CALL)]
+    
+    def run():
+        for leaf in leaves:
+            for neighbor in leaf.iter_neighbors():
+                pass
+                
+    return run
+    
+    
+def bench_segment_collision(data, rng):
+    bspTree = load_tree(data)
+    segments = random_segments(bspTree, rng)
+    
+    def run():
+        for startPos, endPos in segments:
+            bspTree.segment_collision(startPos, endPos)
+            
+    return run
+    
+    
+def bench_segments_intersect(data, rng):
+    bspTree = load_tree(data, portals=True)
+    
+    # Test random segments against the portals, like LOS checks would. This 
+    # stands in for intersect_line_ray(), which was removed when viewcones 
+    # switched to direction vectors.
+    portals = sorted(
+            (portal.start, portal.end) for portal in bspTree.portals
+        ) or [((0, 0), (1, 1))]
+        
+    pairs = [
+        (segment, rng.choice(portals))
+        for segment in random_segments(bspTree, rng)
+    ]
+    
+    def run():
+        for seg1, seg2 in pairs:
+            segments_intersect(seg1, seg2)
+            
+    return run
+    
+    
+BENCHMARKS = OrderedDict(
+        (
+            ('parse_vdf', bench_parse_vdf),
+            ('format_vdf', bench_format_vdf),
+            ('from_vdf', bench_from_vdf),
+            ('from_vdf_fast', bench_from_vdf_fast),
+            ('to_vdf', bench_to_vdf),
+            ('generate_portals', bench_generate_portals),
+            ('leaf_from_coords', bench_leaf_from_coords),
+            ('iter_neighbors', bench_iter_neighbors),
+            ('segment_collision', bench_segment_collision),
+            ('segments_intersect', bench_segments_intersect),
+        )
+    )
+    
+    
+def get_peak_memory():
+    """ Returns the peak resident set size of this process so far, in 
+    megabytes, or None if it isn't available.
+    
+    """
+    
+    if resource is None:
+        return None
+        
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    # Linux reports kilobytes, but OS X reports bytes.
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+        
+    return peak / 1024.0
+    
+    
+def time_benchmark(func, minTime, repeat):
+    """ Times the given function, calling it enough times per run for a run 
+    to take at least minTime seconds. Returns the fastest time per call out 
+    of the given number of runs, in milliseconds.
+    
+    """
+    
+    timer = timeit.Timer(func)
+    
+    # Calibrate the number of calls per run with a single call.
+    number = max(int(minTime / max(timer.timeit(1), 1e-9)), 1)
+    
+    return min(timer.repeat(repeat, number)) / number * 1000
+    
+    
+def _run_benchmark(benchName, dataPath, seed, minTime, repeat, queue):
+    """ Runs a single benchmark in a process of its own, and puts its results 
+    in the given queue.
+    
+    """
+    
+    with open(dataPath, 'r') as f:
+        data = f.read()
+        
+    func = BENCHMARKS[benchName](data, random.Random(seed))
+    
+    setupPeak = get_peak_memory()
+    
+    ms = time_benchmark(func, minTime, repeat)
+    
+    peak = get_peak_memory()
+    
+    queue.put(
+            {
+                'ms': ms,
+                'peakMB': peak,
+                'growthMB': None if peak is None else peak - setupPeak,
+            }
+        )
+        
+        
+def _write_scaled_map(style, numLeaves, seed, path):
+    """ Generates a scaled map and writes it to the given path. """
+    
+    bspTree = stressmap.generate_map(style, numLeaves, seed)
+    
+    with open(path, 'w') as f:
+        f.write(bspTree.to_vdf())
+        
+        
+def run_benchmark(benchName, dataPath, seed, minTime, repeat):
+    """ Runs a single benchmark on the map in the given VDF file, in a new 
+    process, and returns a dictionary of its results. Raises RuntimeError if 
+    the process dies without giving any results.
+    
+    """
+    
+    queue = multiprocessing.Queue()
+    
+    process = multiprocessing.Process(
+            target=_run_benchmark,
+            args=(benchName, dataPath, seed, minTime, repeat, queue),
+        )
+    process.start()
+    
+    while 1:
+        try:
+            results = queue.get(timeout=1)
+            
+        except Empty:
+            if process.is_alive():
+                continue
+                
+            # The results may have been sent just before the process exited.
+            try:
+                results = queue.get(timeout=1)
+                
+            except Empty:
+                process.join()
+                
+                raise RuntimeError(
+                        "{} failed on {} (exit code {})".format(
+                            benchName, dataPath, process.exitcode,
+                        )
+                    )
+                    
+        break
+        
+    process.join()
+    
+    return results
+    
+    
+def compare_to_baseline(results, baseline, threshold):
+    """ Returns a list of (key, metric, value, baselineValue) tuples for 
+    every result that got worse than its baseline by more than the given 
+    fraction.
+    
+    """
+    
+    regressions = []
+    
+    for key, result in results.iteritems():
+        if key not in baseline:
+            continue
+            
+        for metric in ('ms', 'peakMB'):
+            value = result[metric]
+            baselineValue = baseline[key][metric]
+            
+            if value is None or baselineValue is None:
+                continue
+                
+            if value > baselineValue * (1 + threshold):
+                regressions.append((key, metric, value, baselineValue))
+                
+    return regressions
+    
+    
+def main():
+    parser = argparse.ArgumentParser(
+            description="Project VIS BSP/VDF Micro-benchmarks",
+        )
+    parser.add_argument(
+            'maps',
+            nargs='*',
+            help="BSP files to benchmark (default: tests/*-bsp.vdf)",
+        )
+    parser.add_argument(
+            '--scales',
+            type=int,
+            nargs='*',
+            default=list(DEFAULT_SCALES),
+            help="leaf counts of the generated maps to benchmark "
+                "(default: 1000 10000 100000)",
+        )
+    parser.add_argument(
+            '--styles',
+            nargs='+',
+            choices=stressmap.STYLES,
+            default=['field'],
+            help="styles of the generated maps (see stressmap.py; default: "
+                "field)",
+        )
+    parser.add_argument(
+            '--benchmarks',
+            nargs='+',
+            choices=list(BENCHMARKS),
+            default=list(BENCHMARKS),
+            metavar='NAME',
+            help="benchmarks to run (default: all of {})".format(
+                ', '.join(BENCHMARKS),
+            ),
+        )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help="random seed for generated maps and queries (default: 0)",
+        )
+    parser.add_argument(
+            '--min-time',
+            type=float,
+            default=0.2,
+            help="minimum number of seconds per timing run (default: 0.2)",
+        )
+    parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help="number of timing runs to take the best of (default: 3)",
+        )
+    parser.add_argument(
+            '--save-baseline',
+            metavar='PATH',
+            help="write the results to PATH as the new baseline",
+        )
+    parser.add_argument(
+            '--baseline',
+            metavar='PATH',
+            help="compare the results to the baseline in PATH, and exit "
+                "with status 1 if any of them regressed",
+        )
+    parser.add_argument(
+            '--threshold',
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help="fraction by which a result may exceed its baseline before "
+                "it counts as a regression (default: 0.2)",
+        )
+    args = parser.parse_args()
+    
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    else:
+        baseline = {}
+        
+    # Maps names to the paths of the VDF files to benchmark.
+    mapPaths = OrderedDict(
+            (os.path.basename(path), path)
+            for path in args.maps or sorted(glob.glob('tests/*-bsp.vdf'))
+        )
+        
+    # Write the generated maps out, so that each benchmark process only 
+    # has to read them. They are generated in processes of their own too, 
+    # since the benchmark processes would otherwise start out with all of 
+    # the memory that went into generating them.
+    tempDir = tempfile.mkdtemp(prefix='microbench')
+    
+    # The number of maps and benchmarks that failed to run.
+    failures = 0
+    
+    try:
+        for style, numLeaves in product(args.styles, args.scales):
+            name = '{}{}'.format(style, numLeaves)
+            path = os.path.join(tempDir, name + '-bsp.vdf')
+            
+            process = multiprocessing.Process(
+                    target=_write_scaled_map,
+                    args=(style, numLeaves, args.seed, path),
+                )
+            process.start()
+            process.join()
+            
+            if process.exitcode != 0:
+                print >> sys.stderr, (
+                    "Couldn't generate {} (exit code {})".format(
+                        name, process.exitcode,
+                    )
+                )
+                failures += 1
+                continue
+                
+            mapPaths[name] = path
+            
+        print "{:<48} {:>12} {:>10} {:>10} {:>9}".format(
+                "benchmark", "time (ms)", "peak (MB)", "growth", "baseline",
+            )
+            
+        results = OrderedDict()
+        
+        for name, path in mapPaths.iteritems():
+            for benchName in args.benchmarks:
+                key = '{}/{}'.format(name, benchName)
+                
+                try:
+                    result = run_benchmark(
+                            benchName, path,
+                            args.seed, args.min_time, args.repeat,
+                        )
+                        
+                except RuntimeError as e:
+                    print "{:<48} FAILED: {}".format(key, e)
+                    failures += 1
+                    continue
+                    
+                results[key] = result
+                
+                if key in baseline:
+                    change = "{:+.0%}".format(
+                            result['ms'] / baseline[key]['ms'] - 1
+                        )
+                else:
+                    change = "-"
+                    
+                print "{:<48} {:>12.3f} {:>10} {:>10} {:>9}".format(
+                        key, result['ms'],
+                        "-" if result['peakMB'] is None
+                            else "{:.1f}".format(result['peakMB']),
+                        "-" if result['growthMB'] is None
+                            else "{:.1f}".format(result['growthMB']),
+                        change,
+                    )
+                    
+    finally:
+        shutil.rmtree(tempDir)
+        
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+            
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    
+    for key, metric, value, baselineValue in regressions:
+        print "REGRESSION: {} {}: {:.3f} (baseline {:.3f})".format(
+                key, metric, value, baselineValue,
+            )
+            
+    return 1 if regressions or failures else 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main())
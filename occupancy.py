@@ -0,0 +1,215 @@
+"""
+
+occupancy.py
+
+Builds BSP trees straight from occupancy grids, so that levels painted in an 
+image editor don't have to be rebuilt by hand in lumberjack.py. An occupancy 
+grid is a 2D NumPy array indexed by [y][x] that is true wherever the level 
+is solid. Images can be loaded as occupancy grids with 
+load_occupancy_image(), where dark pixels are solid.
+
+The grid is partitioned greedily: each region that isn't entirely solid or 
+entirely open is split along a horizontal or vertical line that runs along 
+solid/open boundaries for its whole length, if there is one, and otherwise 
+along whichever line runs along the most of them. Splitting along the walls 
+that are already there, rather than through the middle of open space, keeps 
+the number of leaves close to the minimum. Running sums over the grid make 
+each split decision cost time in proportion to the size of the region's 
+sides rather than its area, so large grids take seconds.
+
+"""
+
+import sys
+import argparse
+
+import numpy
+import pygame
+
+from bsp import BSPTree, BSPNode
+
+__all__ = (
+    'load_occupancy_image',
+    'bsp_from_occupancy',
+)
+
+
+def load_occupancy_image(path, threshold=128):
+    """ Loads the image at the given path as an occupancy grid, in which 
+    every pixel darker than the given threshold (on a scale of 0 to 255) is 
+    solid.
+    
+    """
+    
+    image = pygame.image.load(path)
+    
+    # surfarray indexes pixels by [x][y], so flip the axes around.
+    pixels = pygame.surfarray.array3d(image).transpose(1, 0, 2)
+    
+    return pixels.mean(axis=2) < threshold
+    
+    
+def get_running_sums(array, axis):
+    """ Returns the running sums of the given 2D array along the given axis, 
+    with a row (or column) of zeroes in front, so that the sum of 
+    array[a:b] along the axis is sums[b] - sums[a].
+    
+    """
+    
+    shape = list(array.shape)
+    shape[axis] += 1
+    
+    sums = numpy.zeros(shape, numpy.int32)
+    
+    if axis == 0:
+        numpy.cumsum(array, axis=0, out=sums[1:])
+    else:
+        numpy.cumsum(array, axis=1, out=sums[:, 1:])
+        
+    return sums
+    
+    
+def choose_split(scores, low, high):
+    """ Takes an array of scores for the split positions low + 1 through 
+    high - 1, and returns the best scoring (position, score) pair. Ties are 
+    broken in favor of the position closest to the middle.
+    
+    """
+    
+    bestScore = scores.max()
+    
+    positions = numpy.flatnonzero(scores == bestScore) + low + 1
+    
+    middle = (low + high) * 0.5
+    
+    return int(positions[numpy.abs(positions - middle).argmin()]), bestScore
+    
+    
+def bsp_from_occupancy(grid, cellSize=1):
+    """ Builds a BSP tree from the given occupancy grid, with every grid cell 
+    cellSize pixels across. Every cell ends up in a solid leaf if it is true 
+    in the grid, and in a visleaf otherwise.
+    
+    """
+    
+    grid = numpy.asarray(grid, dtype=bool)
+    
+    height, width = grid.shape
+    
+    # The number of solid cells in grid[:y, :x] is solidSums[y][x].
+    solidSums = get_running_sums(get_running_sums(grid, 0), 1)
+    
+    # verticalEdges[y][x] is true where grid[y][x] and grid[y][x + 1] 
+    # differ, and horizontalEdges[y][x] is true where grid[y][x] and 
+    # grid[y + 1][x] differ. The running sums count the edges along each 
+    # line between any two positions.
+    verticalEdgeSums = get_running_sums(grid[:, 1:] != grid[:, :-1], 0)
+    horizontalEdgeSums = get_running_sums(grid[1:] != grid[:-1], 1)
+    
+    bspTree = BSPTree(width * cellSize, height * cellSize)
+    
+    regionStack = [(bspTree.head, (0, 0, width, height))]
+    
+    while regionStack:
+        leaf, (left, top, right, bottom) = regionStack.pop()
+        
+        numSolid = (
+            solidSums[bottom, right] - solidSums[top, right]
+            - solidSums[bottom, left] + solidSums[top, left]
+        )
+        
+        if numSolid == 0 or numSolid == (right - left) * (bottom - top):
+            leaf.solid = numSolid > 0
+            continue
+            
+        # Measure how much of every vertical line through the region, and of 
+        # every horizontal one, runs along boundaries.
+        verticalScores = (
+            verticalEdgeSums[bottom, left:right - 1]
+            - verticalEdgeSums[top, left:right - 1]
+        )
+        horizontalScores = (
+            horizontalEdgeSums[top:bottom - 1, right]
+            - horizontalEdgeSums[top:bottom - 1, left]
+        )
+        
+        # A line that runs along boundaries for its whole length doesn't cut 
+        # through anything, so it can never add leaves. Take one of those 
+        # whenever there are any.
+        freeVerticals = verticalScores == bottom - top
+        freeHorizontals = horizontalScores == right - left
+        
+        if freeVerticals.any() or freeHorizontals.any():
+            verticalScores = freeVerticals
+            horizontalScores = freeHorizontals
+            
+        if verticalScores.size:
+            x, verticalScore = choose_split(verticalScores, left, right)
+        else:
+            verticalScore = -1
+            
+        if horizontalScores.size:
+            y, horizontalScore = choose_split(horizontalScores, top, bottom)
+        else:
+            horizontalScore = -1
+            
+        if verticalScore >= horizontalScore:
+            node = bspTree.divide_leaf(
+                    leaf, BSPNode.Orientation.VERTI, x * cellSize,
+                )
+            regionStack.append((node.left, (left, top, x, bottom)))
+            regionStack.append((node.right, (x, top, right, bottom)))
+            
+        else:
+            node = bspTree.divide_leaf(
+                    leaf, BSPNode.Orientation.HORIZ, y * cellSize,
+                )
+            regionStack.append((node.left, (left, top, right, y)))
+            regionStack.append((node.right, (left, y, right, bottom)))
+            
+    return bspTree
+    
+    
+def main():
+    parser = argparse.ArgumentParser(
+            description="Project VIS Occupancy Image Importer",
+        )
+    parser.add_argument(
+            'image',
+            help="image of the level, with walls painted in dark colors",
+        )
+    parser.add_argument(
+            'output',
+            help="where to write the BSP tree, e.g. tests/level-bsp.vdf",
+        )
+    parser.add_argument(
+            '--cell-size',
+            type=int,
+            default=1,
+            help="width of each image pixel in the level (default: 1)",
+        )
+    parser.add_argument(
+            '--threshold',
+            type=int,
+            default=128,
+            help="pixels darker than this (0-255) are solid (default: 128)",
+        )
+    args = parser.parse_args()
+    
+    grid = load_occupancy_image(args.image, args.threshold)
+    
+    bspTree = bsp_from_occupancy(grid, args.cell_size)
+    
+    with open(args.output, 'w') as f:
+        f.write(bspTree.to_vdf())
+        
+    print "Wrote {} leaves ({} open) to {}".format(
+            sum(1 for leaf in bspTree.iter_leaves()),
+            sum(1 for leaf in bspTree.iter_visleaves()),
+            args.output,
+        )
+        
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main())
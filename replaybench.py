@@ -0,0 +1,346 @@
+"""
+
+replaybench.py
+
+Benchmarks whole frames of the main runtime without a display. Replays a 
+camera path (a viewing position and view target position per frame) through 
+vismain.build_shroud() on each map, and reports the 50th, 95th and 99th 
+percentile frame times, along with how many leaves were visited and how many 
+shroudmaps had to be allocated.
+
+Camera paths are either scripted walks through the map, which are the same 
+for the same seed, or recorded paths loaded from JSON files that hold a list 
+of [[x, y], [targetX, targetY]] pairs, as written by vismain.py's 
+--record-path option. Since both are repeatable, the results of one commit 
+can be saved with --json and used as the baseline for another.
+
+"""
+
+import os
+import sys
+import glob
+import json
+import math
+import time
+import random
+import argparse
+
+# Shroudmaps are Pygame surfaces, but nothing needs to be shown.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+
+import vismain
+from bsp import BSPTree
+from visengine import VisibilityEngine
+
+# How far the camera moves per frame, in pixels. Same as in vismain.py.
+CAMERA_SPEED = 5
+
+# How far ahead of the camera its view target is placed, in pixels.
+VIEW_DISTANCE = 100
+
+# The results that count as regressions when they grow, and the fraction 
+# that they may grow by before they do, by default.
+BASELINE_METRICS = (
+    'p50', 'p95', 'p99',
+    'leafVisits', 'portalTests', 'allocations', 'leafFills',
+)
+DEFAULT_THRESHOLD = 0.2
+
+
+def percentile(sortedValues, p):
+    """ Returns the p-th percentile of the given sorted list of values, using 
+    the nearest-rank method.
+    
+    """
+    
+    rank = int(math.ceil(p / 100.0 * len(sortedValues)))
+    
+    return sortedValues[max(rank, 1) - 1]
+    
+    
+def iter_leaf_walk(bspTree, rng):
+    """ Yields an endless series of waypoints that walk from visleaf to 
+    visleaf of the given BSP tree, through the middle of a random portal of 
+    each leaf. Stays in the middle of a single leaf if there are no portals.
+    
+    """
+    
+    visleaves = list(bspTree.iter_visleaves())
+    
+    visleaf = rng.choice(
+            [visleaf for visleaf in visleaves if visleaf.portals] or visleaves
+        )
+        
+    while 1:
+        left, top, right, bottom = visleaf.bounds
+        yield ((left + right) // 2, (top + bottom) // 2)
+        
+        if not visleaf.portals:
+            continue
+            
+        # Portals are kept in a set, so sort them to keep the walk the same 
+        # from run to run.
+        portal = rng.choice(
+                sorted(
+                    visleaf.portals,
+                    key=lambda portal: (portal.start, portal.end),
+                )
+            )
+            
+        yield (
+            (portal.start[0] + portal.end[0]) // 2,
+            (portal.start[1] + portal.end[1]) // 2,
+        )
+        
+        visleaf = portal.get_other(visleaf)
+        
+        
+def scripted_camera_path(bspTree, numFrames, seed):
+    """ Returns a list of numFrames (viewPos, viewTarget) pairs that walk 
+    through the given BSP tree at the runtime's movement speed, looking 
+    ahead while sweeping the view from side to side. The same seed always 
+    gives the same path.
+    
+    """
+    
+    rng = random.Random(seed)
+    
+    waypoints = iter_leaf_walk(bspTree, rng)
+    
+    x, y = next(waypoints)
+    goal = next(waypoints)
+    heading = 0.0
+    
+    path = []
+    
+    for frame in xrange(numFrames):
+        dx = goal[0] - x
+        dy = goal[1] - y
+        distance = math.hypot(dx, dy)
+        
+        if distance <= CAMERA_SPEED:
+            x, y = goal
+            goal = next(waypoints)
+            
+        else:
+            x += dx * CAMERA_SPEED / distance
+            y += dy * CAMERA_SPEED / distance
+            heading = math.atan2(dy, dx)
+            
+        # Sweep the view by up to 60 degrees either way.
+        viewAngle = heading + math.radians(60) * math.sin(frame * 0.05)
+        
+        viewPos = (int(round(x)), int(round(y)))
+        viewTarget = (
+            int(round(x + math.cos(viewAngle) * VIEW_DISTANCE)),
+            int(round(y + math.sin(viewAngle) * VIEW_DISTANCE)),
+        )
+        
+        path.append((viewPos, viewTarget))
+        
+    return path
+    
+    
+def load_camera_path(path):
+    """ Loads a recorded camera path from the given JSON file. """
+    
+    with open(path, 'r') as f:
+        return [
+            (tuple(viewPos), tuple(viewTarget))
+            for viewPos, viewTarget in json.load(f)
+        ]
+        
+        
+def replay(bspTree, cameraPath):
+    """ Replays the given camera path through vismain.build_shroud() on the 
+    given BSP tree, starting from empty shroudmap caches. Returns a dictionary 
+    of results. The camera path must not be empty.
+    
+    """
+    
+    engine = VisibilityEngine(bspTree, vismain.FOV)
+    
+    vismain._visEngine = engine
+    vismain._shroudmapPool = vismain.ShroudmapPool()
+    vismain._shroudmapCache = vismain.ShroudmapCache()
+    
+    frameTimes = []
+    
+    for viewPos, viewTarget in cameraPath:
+        start = time.time()
+        vismain.build_shroud(viewPos, viewTarget)
+        frameTimes.append((time.time() - start) * 1000)
+        
+    frameTimes.sort()
+    
+    numFrames = len(cameraPath)
+    
+    return {
+        'frames': numFrames,
+        'p50': percentile(frameTimes, 50),
+        'p95': percentile(frameTimes, 95),
+        'p99': percentile(frameTimes, 99),
+        'leafVisits': engine.leafVisits / float(numFrames),
+        'portalTests': engine.portalTests / float(numFrames),
+        'allocations': vismain._shroudmapPool.allocations,
+        'leafFills': vismain._shroudmapCache.leafFills,
+    }
+    
+    
+def compare_to_baseline(results, baseline, threshold):
+    """ Returns a list of (map, metric, value, baselineValue) tuples for 
+    every result that got worse than its baseline by more than the given 
+    fraction.
+    
+    """
+    
+    regressions = []
+    
+    for bspFilePath, mapResults in results.iteritems():
+        if bspFilePath not in baseline:
+            continue
+            
+        for metric in BASELINE_METRICS:
+            value = mapResults[metric]
+            baselineValue = baseline[bspFilePath].get(metric)
+            
+            if baselineValue is None:
+                continue
+                
+            if value > baselineValue * (1 + threshold):
+                regressions.append(
+                        (bspFilePath, metric, value, baselineValue)
+                    )
+                    
+    return regressions
+    
+    
+def main():
+    parser = argparse.ArgumentParser(
+            description="Project VIS Headless Replay Benchmark",
+        )
+    parser.add_argument(
+            'maps',
+            nargs='*',
+            help="BSP files to replay (default: tests/*-bsp.vdf)",
+        )
+    parser.add_argument(
+            '--frames',
+            type=int,
+            default=600,
+            help="number of frames in scripted camera paths (default: 600)",
+        )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help="random seed for scripted camera paths (default: 0)",
+        )
+    parser.add_argument(
+            '--camera-path',
+            metavar='PATH',
+            help="replay the recorded camera path in PATH on every map, "
+                "instead of a scripted one",
+        )
+    parser.add_argument(
+            '--shroud-backend',
+            choices=sorted(vismain.SHROUD_BACKENDS),
+            default='scanline',
+            help="how shroudmaps are filled (default: scanline)",
+        )
+    parser.add_argument(
+            '--json',
+            metavar='PATH',
+            help="also write the results to PATH as JSON, keyed by map, "
+                "for use as a baseline",
+        )
+    parser.add_argument(
+            '--baseline',
+            metavar='PATH',
+            help="compare the results to the JSON results in PATH, and exit "
+                "with status 1 if any of them regressed",
+        )
+    parser.add_argument(
+            '--threshold',
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help="fraction by which a result may exceed its baseline before "
+                "it counts as a regression (default: 0.2)",
+        )
+    args = parser.parse_args()
+    
+    try:
+        vismain.set_shroud_backend(args.shroud_backend)
+    except ValueError as e:
+        parser.error(str(e))
+        
+    bspFilePaths = args.maps or sorted(glob.glob('tests/*-bsp.vdf'))
+    
+    if args.camera_path:
+        recordedPath = load_camera_path(args.camera_path)
+        
+        if not recordedPath:
+            parser.error(
+                "the camera path in {} is empty".format(args.camera_path)
+            )
+            
+    elif args.frames < 1:
+        parser.error("--frames must be at least 1")
+        
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    else:
+        baseline = {}
+        
+    pygame.init()
+    
+    print "{:<24} {:>6} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7}".format(
+            "map", "frames", "p50 (ms)", "p95 (ms)", "p99 (ms)",
+            "leaves", "portals", "allocs",
+        )
+        
+    allResults = {}
+    
+    for bspFilePath in bspFilePaths:
+        with open(bspFilePath, 'r') as f:
+            data = f.read()
+            
+        bspTree = BSPTree.from_vdf_fast(data)
+        bspTree.generate_portals()
+        
+        if args.camera_path:
+            cameraPath = recordedPath
+        else:
+            cameraPath = scripted_camera_path(bspTree, args.frames, args.seed)
+            
+        results = replay(bspTree, cameraPath)
+        
+        allResults[bspFilePath] = results
+        
+        print (
+            "{:<24} {frames:>6} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} "
+            "{leafVisits:>8.1f} {portalTests:>8.1f} {allocations:>7}".format(
+                os.path.basename(bspFilePath), **results
+            )
+        )
+        
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(allResults, f, indent=4, sort_keys=True)
+            
+    regressions = compare_to_baseline(allResults, baseline, args.threshold)
+    
+    for bspFilePath, metric, value, baselineValue in regressions:
+        print "REGRESSION: {} {}: {:.2f} (baseline {:.2f})".format(
+                os.path.basename(bspFilePath), metric, value, baselineValue,
+            )
+            
+    return 1 if regressions else 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main())
+    
\ No newline at end of file
@@ -0,0 +1,479 @@
+"""
+
+snapshot.py
+
+Immutable snapshots of BSP trees, for undo/redo in lumberjack.py and for 
+reading a tree on one thread while another keeps editing it.
+
+Editing a snapshot never changes it. Instead, each edit returns a new 
+snapshot that shares every part of the tree with the old one, except for 
+the nodes on the path from the head down to the edited leaf, which are 
+copied. An edit therefore only costs time and memory in proportion to the 
+depth of the tree, and keeping every snapshot in an EditHistory is cheap.
+
+Snapshot elements don't have parent references, since a shared subtree may 
+belong to any number of snapshots at once. Leaves are found by coordinates 
+instead.
+
+"""
+
+from bsp import BSPTree, BSPNode
+
+__all__ = (
+    'SnapshotLeaf',
+    'SnapshotNode',
+    'BSPSnapshot',
+    'EditHistory',
+)
+
+COLOR_BLACK = (0, 0, 0)
+COLOR_WHITE = (255, 255, 255)
+COLOR_MAGENTA = (255, 0, 255)
+
+
+def bounds_touch(bounds, otherBounds):
+    """ Returns whether the given (left, top, right, bottom) bounds overlap 
+    or share an edge. 
+    
+    """
+    
+    left, top, right, bottom = bounds
+    otherLeft, otherTop, otherRight, otherBottom = otherBounds
+    
+    return (
+        left <= otherRight and otherLeft <= right
+        and top <= otherBottom and otherTop <= bottom
+    )
+    
+    
+class SnapshotLeaf(object):
+    """ An immutable leaf of a BSPSnapshot. """
+    
+    __slots__ = ('bounds', 'solid')
+    
+    def __init__(self, bounds, solid=True):
+        self.bounds = bounds
+        self.solid = solid
+        
+    def __repr__(self):
+        return "SnapshotLeaf({}, {})".format(self.bounds, self.solid)
+        
+    def get_top_left(self):
+        return (self.bounds[0], self.bounds[1])
+        
+    def get_bottom_right(self):
+        return (self.bounds[2], self.bounds[3])
+        
+    def draw(self, canvas):
+        color = COLOR_BLACK if self.solid else COLOR_WHITE
+        canvas.fill_box(self.get_top_left(), self.get_bottom_right(), color)
+        
+        
+class SnapshotNode(object):
+    """ An immutable node of a BSPSnapshot. Always has two children. """
+    
+    __slots__ = ('bounds', 'orientation', 'partition', 'left', 'right')
+    
+    def __init__(self, bounds, orientation, partition, left, right):
+        self.bounds = bounds
+        self.orientation = orientation
+        self.partition = partition
+        self.left = left
+        self.right = right
+        
+    def __repr__(self):
+        return "SnapshotNode({}, {}, {})".format(
+                self.bounds, self.orientation, self.partition,
+            )
+            
+    @classmethod
+    def divide(cls, bounds, orientation, partition):
+        ''' Returns a new node that divides the given bounds with the given 
+        partition, with two solid leaves as its children, just like 
+        BSPTree.divide_leaf() would make.
+        
+        '''
+        
+        left, top, right, bottom = bounds
+        
+        if orientation == BSPNode.Orientation.VERTI:
+            leftBounds = (left, top, partition, bottom)
+            rightBounds = (partition, top, right, bottom)
+            
+        elif orientation == BSPNode.Orientation.HORIZ:
+            leftBounds = (left, top, right, partition)
+            rightBounds = (left, partition, right, bottom)
+            
+        else:
+            assert False    # Invalid orientation.
+            
+        return cls(
+                bounds, orientation, partition,
+                SnapshotLeaf(leftBounds), SnapshotLeaf(rightBounds),
+            )
+            
+    def goes_right(self, x, y):
+        ''' Returns whether the given point is on the right (or bottom) side 
+        of this node's partition.
+        
+        '''
+        
+        if self.orientation == BSPNode.Orientation.HORIZ:
+            return y >= self.partition
+        else:
+            return x >= self.partition
+            
+    def replace_child(self, right, child):
+        ''' Returns a copy of this node with its right child replaced by the 
+        given child if right is true, and its left child otherwise.
+        
+        '''
+        
+        if right:
+            return SnapshotNode(
+                    self.bounds, self.orientation, self.partition,
+                    self.left, child,
+                )
+        else:
+            return SnapshotNode(
+                    self.bounds, self.orientation, self.partition,
+                    child, self.right,
+                )
+                
+    def draw_partition(self, canvas):
+        left, top, right, bottom = self.bounds
+        
+        if self.orientation == BSPNode.Orientation.HORIZ:
+            start = (left, self.partition)
+            end = (right, self.partition)
+        else:
+            start = (self.partition, top)
+            end = (self.partition, bottom)
+            
+        canvas.draw_line(start, end, COLOR_MAGENTA)
+        
+        
+class BSPSnapshot(object):
+    """ An immutable BSP tree. The editing methods mirror those of BSPTree, 
+    except that they return a new snapshot instead of changing this one, 
+    and that they take the coordinates of a point within the leaf to edit 
+    instead of the leaf itself.
+    
+    """
+    
+    def __init__(self, maxWidth, maxHeight, head, origin=(0, 0)):
+        self.maxWidth = maxWidth
+        self.maxHeight = maxHeight
+        self.head = head
+        self.origin = origin
+        
+    def __repr__(self):
+        return "BSPSnapshot({}, {}, {}, {})".format(
+                self.maxWidth, self.maxHeight, repr(self.head), self.origin,
+            )
+            
+    @classmethod
+    def from_tree(cls, bspTree):
+        ''' Takes a snapshot of the given BSP tree. '''
+        
+        # Maps elements of the tree to their snapshots.
+        converted = {}
+        
+        # Parents come before their children in .iter_elements(), so going 
+        # through the elements backwards converts the children first.
+        for element in reversed(list(bspTree.iter_elements())):
+            if type(element) is BSPNode:
+                converted[element] = SnapshotNode(
+                        element.bounds,
+                        element.orientation, element.partition,
+                        converted.pop(element.left),
+                        converted.pop(element.right),
+                    )
+                    
+            else:
+                converted[element] = SnapshotLeaf(
+                        element.bounds, element.solid,
+                    )
+                    
+        return cls(
+                bspTree.maxWidth, bspTree.maxHeight,
+                converted[bspTree.head], bspTree.origin,
+            )
+            
+    def to_tree(self):
+        ''' Builds a new, mutable BSPTree from this snapshot. '''
+        
+        bspTree = BSPTree(self.maxWidth, self.maxHeight, self.origin)
+        
+        elementStack = [(self.head, bspTree.head)]
+        
+        while elementStack:
+            element, leaf = elementStack.pop()
+            
+            if type(element) is SnapshotNode:
+                node = bspTree.divide_leaf(
+                        leaf, element.orientation, element.partition,
+                    )
+                    
+                elementStack.append((element.left, node.left))
+                elementStack.append((element.right, node.right))
+                
+            else:
+                leaf.solid = element.solid
+                
+        return bspTree
+        
+    def to_vdf(self):
+        ''' Serializes the snapshot to VDF KeyValues format, just like 
+        BSPTree.to_vdf().
+        
+        '''
+        
+        return self.to_tree().to_vdf()
+        
+    def iter_elements(self, bounds=None):
+        ''' Returns an iterator over all elements in the snapshot, or only 
+        over the elements that touch the given bounds, if given. 
+        
+        '''
+        
+        elementStack = [self.head]
+        while elementStack:
+            element = elementStack.pop()
+            
+            if bounds is not None and not bounds_touch(element.bounds, bounds):
+                continue
+                
+            if type(element) is SnapshotNode:
+                elementStack.append(element.left)
+                elementStack.append(element.right)
+                
+            yield element
+            
+    def iter_leaves(self, bounds=None):
+        ''' Returns an iterator over all leaves in the snapshot, or only over 
+        the leaves that touch the given bounds, if given. 
+        
+        '''
+        return (
+            element for element in self.iter_elements(bounds)
+            if type(element) is SnapshotLeaf
+        )
+        
+    def iter_nodes(self, bounds=None):
+        ''' Returns an iterator over all nodes in the snapshot, or only over 
+        the nodes that touch the given bounds, if given. 
+        
+        '''
+        return (
+            element for element in self.iter_elements(bounds)
+            if type(element) is SnapshotNode
+        )
+        
+    def iter_changes(self, other):
+        ''' Returns an iterator over the bounds of the regions where this 
+        snapshot differs from the given one. 
+        
+        Subtrees that the two snapshots share are skipped without being 
+        looked at, so comparing a snapshot to the one it was edited from 
+        only costs time in proportion to the depth of the tree. 
+        
+        '''
+        
+        if (self.maxWidth, self.maxHeight, self.origin) != (
+                other.maxWidth, other.maxHeight, other.origin):
+            yield self.head.bounds
+            return
+            
+        elementStack = [(self.head, other.head)]
+        while elementStack:
+            element, otherElement = elementStack.pop()
+            
+            if element is otherElement:
+                continue
+                
+            if type(element) is SnapshotNode:
+                if (type(otherElement) is SnapshotNode
+                        and element.orientation == otherElement.orientation
+                        and element.partition == otherElement.partition):
+                    elementStack.append((element.left, otherElement.left))
+                    elementStack.append((element.right, otherElement.right))
+                    continue
+                    
+            elif type(otherElement) is SnapshotLeaf:
+                if element.solid == otherElement.solid:
+                    continue
+                    
+            yield element.bounds
+            
+    def draw_leaves(self, canvas, bounds=None):
+        for leaf in self.iter_leaves(bounds):
+            leaf.draw(canvas)
+            
+    def draw_partitions(self, canvas, bounds=None):
+        for node in self.iter_nodes(bounds):
+            node.draw_partition(canvas)
+            
+    def get_path(self, x, y):
+        ''' Returns a list of (node, right) pairs for every node on the path 
+        from the head to the leaf that holds the given point, where right 
+        tells which child the path continues into, followed by the leaf.
+        
+        '''
+        
+        path = []
+        
+        element = self.head
+        
+        while type(element) is SnapshotNode:
+            right = element.goes_right(x, y)
+            path.append((element, right))
+            element = element.right if right else element.left
+            
+        return path, element
+        
+    def leaf_from_coords(self, x, y):
+        ''' Given a set of coordinates, return the corresponding leaf. '''
+        return self.get_path(x, y)[1]
+        
+    def _replace(self, path, element):
+        ''' Returns a new snapshot in which the element at the end of the 
+        given path (see .get_path()) is replaced by the given element. Only 
+        the nodes along the path are copied.
+        
+        '''
+        
+        for node, right in reversed(path):
+            element = node.replace_child(right, element)
+            
+        return BSPSnapshot(self.maxWidth, self.maxHeight, element, self.origin)
+        
+    def divide_leaf(self, point, orientation, partition):
+        ''' Returns a new snapshot in which the leaf that holds the given 
+        point is divided by the given partition, like 
+        BSPTree.divide_leaf().
+        
+        '''
+        
+        path, leaf = self.get_path(*point)
+        
+        left, top, right, bottom = leaf.bounds
+        
+        assert (
+            orientation != BSPNode.Orientation.VERTI or
+            left < partition < right
+        )
+        
+        assert (
+            orientation != BSPNode.Orientation.HORIZ or
+            top < partition < bottom
+        )
+        
+        return self._replace(
+                path, SnapshotNode.divide(leaf.bounds, orientation, partition),
+            )
+            
+    def merge_leaf(self, point):
+        ''' Returns a new snapshot in which all children of the parent of the 
+        leaf that holds the given point are consolidated into a single solid 
+        leaf, like BSPTree.merge_leaf(). Returns this snapshot if the leaf 
+        has no parent.
+        
+        '''
+        
+        path, leaf = self.get_path(*point)
+        
+        if not path:
+            return self
+            
+        parent, right = path.pop()
+        
+        return self._replace(path, SnapshotLeaf(parent.bounds))
+        
+    def set_solid(self, point, solid):
+        ''' Returns a new snapshot in which the leaf that holds the given 
+        point is solid or not, as given. Returns this snapshot if the leaf 
+        already is.
+        
+        '''
+        
+        path, leaf = self.get_path(*point)
+        
+        if leaf.solid == solid:
+            return self
+            
+        return self._replace(path, SnapshotLeaf(leaf.bounds, solid))
+        
+        
+class EditHistory(object):
+    """ A linear undo/redo history of BSPSnapshots. Since snapshots share 
+    everything that an edit didn't touch, each entry only takes up memory 
+    in proportion to the depth of the tree.
+    
+    """
+    
+    def __init__(self, snapshot, maxUndos=None):
+        # Every snapshot in the history, from oldest to newest, and the index 
+        # of the current one. Snapshots after the current one can be redone.
+        self._snapshots = [snapshot]
+        self._index = 0
+        
+        # The number of edits that can be undone, or None for no limit.
+        self.maxUndos = maxUndos
+        
+    def __repr__(self):
+        return "EditHistory({}, {})".format(
+                repr(self.current), self.maxUndos,
+            )
+            
+    @property
+    def current(self):
+        ''' The current snapshot. '''
+        return self._snapshots[self._index]
+        
+    def can_undo(self):
+        return self._index > 0
+        
+    def can_redo(self):
+        return self._index < len(self._snapshots) - 1
+        
+    def push(self, snapshot):
+        ''' Makes the given snapshot the current one, and forgets every 
+        snapshot that could have been redone. Does nothing if the snapshot 
+        already is the current one.
+        
+        '''
+        
+        if snapshot is self.current:
+            return
+            
+        del self._snapshots[self._index + 1:]
+        self._snapshots.append(snapshot)
+        
+        if (self.maxUndos is not None
+                and len(self._snapshots) > self.maxUndos + 1):
+            del self._snapshots[0]
+            
+        self._index = len(self._snapshots) - 1
+        
+    def undo(self):
+        ''' Goes back to the previous snapshot, if there is one. Returns the 
+        new current snapshot.
+        
+        '''
+        
+        if self.can_undo():
+            self._index -= 1
+            
+        return self.current
+        
+    def redo(self):
+        ''' Goes forward to the next snapshot, if there is one. Returns the 
+        new current snapshot.
+        
+        '''
+        
+        if self.can_redo():
+            self._index += 1
+            
+        return self.current
@@ -0,0 +1,412 @@
+"""
+
+stressmap.py
+
+Generates BSP trees of any size for scaling tests, in one of several styles 
+modelled on the bundled test maps:
+
+    rooms   -- Rooms joined by doors in the walls between them. 
+    field   -- Open space broken up by the odd pillar, like test2. 
+    maze    -- Corridors one door wide, with walls as thin as they get. 
+    narrow  -- Thick walls with narrow slits through them, like narrow.
+    
+Maps are built by dividing leaves with BSPTree.divide_leaf(), so the same 
+style, size and seed always give the same map. Run this module directly to 
+write a generated map out as VDF.
+
+"""
+
+import sys
+import math
+import random
+import argparse
+from collections import deque
+
+from bsp import BSPTree, BSPNode
+
+__all__ = (
+    'STYLES',
+    'generate_map',
+    'get_reachable_visleaves',
+)
+
+# Parameters of the styles that divide rooms with walls, in pixels. Each 
+# room is split in two across its longer side by a wall of the given 
+# thickness, with a door somewhere along it, until rooms get smaller than 
+# twice minRoom. Every coordinate is a multiple of the grid size.
+_WALLED_STYLES = {
+    'rooms': {
+        'grid': 16,
+        'wall': 32,
+        'minRoom': 96,
+        'minDoor': 32,
+        'maxDoor': 64,
+    },
+    'maze': {
+        'grid': 8,
+        'wall': 8,
+        'minRoom': 24,
+        'minDoor': 24,
+        'maxDoor': 24,
+    },
+    'narrow': {
+        'grid': 16,
+        'wall': 96,
+        'minRoom': 64,
+        'minDoor': 16,
+        'maxDoor': 32,
+    },
+}
+
+# Average area covered by each leaf of a style, in square pixels. Used to 
+# size maps so that they hold about the requested number of leaves.
+_AREA_PER_LEAF = {
+    'rooms': 8000,
+    'field': 1024,
+    'maze': 700,
+    'narrow': 12000,
+}
+
+STYLES = ('rooms', 'field', 'maze', 'narrow')
+
+
+def get_other_orientation(orientation):
+    """ Returns the orientation perpendicular to the given one. """
+    
+    if orientation == BSPNode.Orientation.VERTI:
+        return BSPNode.Orientation.HORIZ
+    else:
+        return BSPNode.Orientation.VERTI
+        
+        
+def split_across_longer_side(leaf):
+    """ Returns an (orientation, low, high) tuple, giving the orientation 
+    of a partition across the given leaf's longer side, and the range of 
+    coordinates that the partition may fall between.
+    
+    """
+    
+    left, top, right, bottom = leaf.bounds
+    
+    if right - left >= bottom - top:
+        return BSPNode.Orientation.VERTI, left, right
+    else:
+        return BSPNode.Orientation.HORIZ, top, bottom
+        
+        
+def is_on_edge(bounds, room):
+    """ Returns True if the rectangle with the given bounds lies against 
+    one of the given room's edges, from outside the room. """
+    
+    boundsLeft, boundsTop, boundsRight, boundsBottom = bounds
+    left, top, right, bottom = room.bounds
+    
+    if boundsRight == left or boundsLeft == right:
+        return boundsTop < bottom and top < boundsBottom
+    elif boundsBottom == top or boundsTop == bottom:
+        return boundsLeft < right and left < boundsRight
+    else:
+        return False
+        
+        
+def divide_room(bspTree, room, doors, rng, grid, wall, minRoom, minDoor,
+        maxDoor):
+    """ Divides the given room in two with a solid wall that has a door in 
+    it. Returns a (rooms, numNewLeaves) tuple holding the two new rooms, 
+    each paired with the list of door bounds on its own edges, and the 
+    number of leaves that were added to the tree, or None if the room is 
+    too small to be divided.
+    
+    The given doors are the ones on the room's edges. The wall is kept 
+    clear of them, since it would seal them off otherwise. Only the room's 
+    own doors are looked at, so that dividing a room takes the same time 
+    however many doors the map already has.
+    
+    """
+    
+    orientation, low, high = split_across_longer_side(room)
+    
+    if high - low < minRoom * 2 + wall:
+        return None
+        
+    # The span of the wall, along the other side of the room.
+    left, top, right, bottom = room.bounds
+    
+    if orientation == BSPNode.Orientation.VERTI:
+        start, end = top, bottom
+        
+        # The spans of the doors in the room's top and bottom walls.
+        doorSpans = [
+            (doorLeft, doorRight)
+            for doorLeft, doorTop, doorRight, doorBottom in doors
+            if (doorBottom == top or doorTop == bottom)
+                and doorLeft < right and left < doorRight
+        ]
+        
+    else:
+        start, end = left, right
+        
+        # The spans of the doors in the room's left and right walls.
+        doorSpans = [
+            (doorTop, doorBottom)
+            for doorLeft, doorTop, doorRight, doorBottom in doors
+            if (doorRight == left or doorLeft == right)
+                and doorTop < bottom and top < doorBottom
+        ]
+        
+    partitions = [
+        partition
+        for partition in xrange(
+            low + minRoom, high - minRoom - wall + 1, grid,
+        )
+        if not any(
+            doorLow < partition + wall and partition < doorHigh
+            for doorLow, doorHigh in doorSpans
+        )
+    ]
+    
+    if not partitions:
+        return None
+        
+    partition = rng.choice(partitions)
+    
+    node = bspTree.divide_leaf(room, orientation, partition)
+    wallNode = bspTree.divide_leaf(node.right, orientation, partition + wall)
+    
+    newRooms = [node.left, wallNode.right]
+    
+    # Knock a door through the wall.
+    doorWidth = min(
+            grid * rng.randint(minDoor // grid, maxDoor // grid),
+            end - start,
+        )
+    doorStart = start + grid * rng.randint(
+            0, (end - start - doorWidth) // grid,
+        )
+    doorEnd = doorStart + doorWidth
+    
+    doorOrientation = get_other_orientation(orientation)
+    door = wallNode.left
+    numNewLeaves = 2
+    
+    if doorStart > start:
+        door = bspTree.divide_leaf(door, doorOrientation, doorStart).right
+        numNewLeaves += 1
+        
+    if doorEnd < end:
+        door = bspTree.divide_leaf(door, doorOrientation, doorEnd).left
+        numNewLeaves += 1
+        
+    # New leaves are solid, so only the rooms and the door need changing.
+    for leaf in newRooms + [door]:
+        leaf.solid = False
+        
+    # The new door leads into both new rooms, and every other door leads 
+    # into whichever one it now borders.
+    doors = doors + [door.bounds]
+    
+    rooms = [
+        (newRoom, [bounds for bounds in doors if is_on_edge(bounds, newRoom)])
+        for newRoom in newRooms
+    ]
+    
+    return rooms, numNewLeaves
+    
+    
+def generate_walled_map(bspTree, numLeaves, rng, params):
+    """ Fills the given BSP tree with rooms divided by walls, until it has 
+    at least numLeaves leaves or no room can be divided any further. Rooms 
+    are divided breadth-first, so the rooms stay about the same size across 
+    the whole map.
+    
+    """
+    
+    # (room, doors) pairs, where doors holds the bounds of the doors on 
+    # the room's edges.
+    rooms = deque([(bspTree.head, [])])
+    
+    leafCount = 1
+    
+    while rooms and leafCount < numLeaves:
+        room, doors = rooms.popleft()
+        
+        result = divide_room(bspTree, room, doors, rng, **params)
+        
+        if result is None:
+            continue
+            
+        newRooms, numNewLeaves = result
+        
+        rooms.extend(newRooms)
+        leafCount += numNewLeaves
+        
+        
+def generate_field_map(bspTree, numLeaves, rng, grid=8, maxPillar=48,
+        pillarChance=0.15):
+    """ Divides the given BSP tree at random until it has numLeaves leaves. 
+    Leaves no larger than maxPillar along either side have a chance of 
+    being solid, and every other leaf is open, except for any pockets that 
+    the pillars cut off from the rest of the map.
+    
+    """
+    
+    # Leaves that can still be divided, and leaves that are too small to be.
+    leaves = [bspTree.head]
+    smallLeaves = []
+    
+    while leaves and len(leaves) + len(smallLeaves) < numLeaves:
+        i = rng.randrange(len(leaves))
+        
+        orientation, low, high = split_across_longer_side(leaves[i])
+        
+        if high - low < grid * 2:
+            smallLeaves.append(leaves[i])
+            leaves[i] = leaves[-1]
+            leaves.pop()
+            continue
+            
+        # Keep the pieces from getting too thin.
+        steps = (high - low) // grid
+        partition = low + grid * rng.randint(
+                max(steps // 4, 1), steps - max(steps // 4, 1),
+            )
+            
+        node = bspTree.divide_leaf(leaves[i], orientation, partition)
+        
+        leaves[i] = node.left
+        leaves.append(node.right)
+        
+    for leaf in leaves + smallLeaves:
+        leaf.solid = (
+            max(leaf.get_size()) <= maxPillar
+            and rng.random() < pillarChance
+        )
+        
+    # Pillars can now and then wall in a small pocket of open space, which 
+    # is filled in, so that every open leaf can be reached.
+    bspTree.generate_portals()
+    reachable = get_reachable_visleaves(bspTree)
+    
+    for leaf in leaves + smallLeaves:
+        if leaf not in reachable:
+            leaf.solid = True
+            
+        leaf.portals.clear()
+        
+    bspTree.portals.clear()
+    
+    
+def get_reachable_visleaves(bspTree):
+    """ Returns the set of visleaves that can be reached through portals 
+    from the first visleaf of the given BSP tree, whose portals must have 
+    been generated. Every visleaf of a generated map should be reachable.
+    
+    """
+    
+    start = next(bspTree.iter_visleaves(), None)
+    
+    if start is None:
+        return set()
+        
+    reached = {start}
+    leafStack = [start]
+    
+    while leafStack:
+        visleaf = leafStack.pop()
+        
+        for portal in visleaf.portals:
+            otherLeaf = portal.get_other(visleaf)
+            
+            if otherLeaf not in reached:
+                reached.add(otherLeaf)
+                leafStack.append(otherLeaf)
+                
+    return reached
+    
+    
+def generate_map(style, numLeaves, seed=0):
+    """ Generates a BSP tree in the given style (one of STYLES) with about 
+    the given number of leaves. The same arguments always give the same 
+    tree.
+    
+    """
+    
+    if style not in STYLES:
+        raise ValueError("Unknown map style: {}".format(style))
+        
+    rng = random.Random(seed)
+    
+    # Make the map roughly square, and about big enough to fit the leaves, 
+    # in multiples of 64 pixels.
+    side = int(math.sqrt(numLeaves * _AREA_PER_LEAF[style]))
+    side = max(side // 64, 4) * 64
+    
+    bspTree = BSPTree(side, side)
+    bspTree.head.solid = False
+    
+    if style == 'field':
+        generate_field_map(bspTree, numLeaves, rng)
+    else:
+        generate_walled_map(bspTree, numLeaves, rng, _WALLED_STYLES[style])
+        
+    return bspTree
+    
+    
+def main():
+    parser = argparse.ArgumentParser(
+            description="Project VIS Stress Map Generator",
+        )
+    parser.add_argument(
+            'style',
+            choices=STYLES,
+            help="the kind of map to generate",
+        )
+    parser.add_argument(
+            'numLeaves',
+            type=int,
+            help="about how many leaves the map should have",
+        )
+    parser.add_argument(
+            'output',
+            nargs='?',
+            help="where to write the map (default: "
+                "tests/<style><numLeaves>-bsp.vdf)",
+        )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help="random seed (default: 0)",
+        )
+    args = parser.parse_args()
+    
+    output = args.output or "tests/{}{}-bsp.vdf".format(
+            args.style, args.numLeaves,
+        )
+        
+    bspTree = generate_map(args.style, args.numLeaves, args.seed)
+    
+    bspTree.generate_portals()
+    
+    numVisleaves = sum(1 for leaf in bspTree.iter_visleaves())
+    numReachable = len(get_reachable_visleaves(bspTree))
+    
+    if numReachable != numVisleaves:
+        print >> sys.stderr, (
+            "Only {} of {} open leaves can be reached from the first "
+            "one!".format(numReachable, numVisleaves)
+        )
+        return 1
+        
+    with open(output, 'w') as f:
+        f.write(bspTree.to_vdf())
+        
+    print "Wrote {} leaves ({} open) to {}".format(
+            sum(1 for leaf in bspTree.iter_leaves()), numVisleaves, output,
+        )
+        
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,10 @@ Utilities for processing Valve KeyValue data formats.
 
 """
 
+import os
+import re
+import json
+import hashlib
 from collections import OrderedDict
 
 VALID_CHARS = (
@@ -20,6 +24,24 @@ WHITESPACE = ' \r\n\t'
 # Byte that gets appended to keys to ensure uniqueness
 UNIQUEIFIER = '\x1d'
 
+# Suffix of the sidecar files that hold persisted VDF offset indices
+INDEX_SUFFIX = '.idx'
+
+# Token types yielded by iter_vdf_tokens()
+TOKEN_STRING = 0
+TOKEN_OPEN = 1
+TOKEN_CLOSE = 2
+
+# Matches a single quoted string, bracket, comment, or unquoted word. Any 
+# characters that fall between matches are ignored, just like parse_vdf() 
+# ignores them.
+_TOKEN_PATTERN = re.compile(
+        r'"([^"]*)"'
+        r'|([{}])'
+        r'|//[^\n]*'
+        r'|([' + re.escape(VALID_CHARS) + r']+)'
+    )
+
 
 class VDFConsistencyFailure(Exception):
     """ You have a bad VDF file. :( """
@@ -30,12 +52,14 @@ class VDFConsistencyFailure(Exception):
         return "{}\nError is: {}".format(self.BAD_VDF_MSG, self.message)
         
         
-def parse_vdf(inData, ordered=True, duplicates=False):
+def parse_vdf(inData, ordered=True, duplicates=False, multivalue=False):
     """ Parse a string in VDF format and return a dictionary representing the
     data.
     
     ordered:        Preserve ordering
     duplicates:     Allow duplicate keys (may cause Unicode problems)
+    multivalue:     Map every key to a list of all of its values, in order 
+                    (takes precedence over 'duplicates')
     
     """
     
@@ -94,6 +118,20 @@ def parse_vdf(inData, ordered=True, duplicates=False):
                 
         raise VDFConsistencyFailure("Mismatched brackets!")
         
+    def store_value(value):
+        ''' Store a value under the current key, and reset the key. '''
+        
+        if multivalue:
+            try:
+                data[States.key].append(value)
+            except KeyError:
+                data[States.key] = [value]
+                
+        else:
+            data[States.key] = value
+            
+        States.key = ''
+        
     def get_word(i):
         ''' Set wordEnd to the current index and grab the word at this
         position, assuming that the wordStart index has been found already.
@@ -107,13 +145,12 @@ def parse_vdf(inData, ordered=True, duplicates=False):
         
         word = inData[States.wordStart:States.wordEnd]
         if States.key:
-            data[States.key] = word
-            States.key = ''
+            store_value(word)
             
         else:
             States.key = word
             
-            while duplicates and (States.key in data):
+            while duplicates and not multivalue and (States.key in data):
                 # Ensures that dictionary States.keys are unique, if 
                 # duplicates are being allowed.
                 States.key += UNIQUEIFIER
@@ -135,13 +172,12 @@ def parse_vdf(inData, ordered=True, duplicates=False):
         quoteContents = inData[States.quoteStart + 1:States.quoteEnd]
         
         if States.key:
-            data[States.key] = quoteContents
-            States.key = ''
+            store_value(quoteContents)
             
         else:
             States.key = quoteContents
             
-            while duplicates and (States.key in data):
+            while duplicates and not multivalue and (States.key in data):
                 # Ensures that dictionary States.keys are unique, if 
                 # duplicates are being allowed.
                 States.key += UNIQUEIFIER
@@ -201,14 +237,15 @@ def parse_vdf(inData, ordered=True, duplicates=False):
                 States.bracketEnd = find_bracket_end(inData, i)
                 
                 # Recursion is fun!
-                data[States.key] = parse_vdf(
-                        inData[States.bracketStart + 1:States.bracketEnd],
-                        ordered=ordered,
-                        duplicates=duplicates,
+                store_value(
+                        parse_vdf(
+                            inData[States.bracketStart + 1:States.bracketEnd],
+                            ordered=ordered,
+                            duplicates=duplicates,
+                            multivalue=multivalue,
+                        )
                     )
-                
-                States.key = ''
-                
+                    
                 i = States.bracketEnd
                 
                 States.bracketStart = -1
@@ -234,9 +271,256 @@ def parse_vdf(inData, ordered=True, duplicates=False):
     return data
     
     
+def iter_vdf_tokens(inData, start=0, end=None):
+    """ Returns an iterator over the tokens of a string in VDF format, without 
+    building any dictionaries. Each token is a (tokenType, value, index) 
+    tuple, where tokenType is one of the TOKEN_* constants and index is the 
+    position of the token within inData. Comments are skipped.
+    
+    start:          Index to start tokenizing from
+    end:            Index to stop tokenizing at (defaults to the end of inData)
+    
+    """
+    
+    if end is None:
+        end = len(inData)
+        
+    for match in _TOKEN_PATTERN.finditer(inData, start, end):
+        quoteContents, bracket, word = match.groups()
+        
+        if quoteContents is not None:
+            yield (TOKEN_STRING, quoteContents, match.start())
+            
+        elif word is not None:
+            yield (TOKEN_STRING, word, match.start())
+            
+        elif bracket == '{':
+            yield (TOKEN_OPEN, bracket, match.start())
+            
+        elif bracket == '}':
+            yield (TOKEN_CLOSE, bracket, match.start())
+            
+        # Otherwise, the match is a comment.
+        
+        
+def build_vdf_index(inData, depth):
+    """ Build an index of the offsets of every value in a string in VDF 
+    format, down to the given depth. Returns an ordered dictionary that maps 
+    key paths (tuples of keys, at most 'depth' keys long) to the 
+    (start, end) range of the corresponding value within inData. The range 
+    of a block value includes its brackets.
+    
+    """
+    
+    index = OrderedDict()
+    
+    # Key paths and start indices of the blocks that are currently open.
+    path = []
+    blockStarts = []
+    
+    key = None
+    
+    for tokenType, value, i in iter_vdf_tokens(inData):
+        if tokenType == TOKEN_STRING:
+            if key is None:
+                key = value
+                continue
+                
+            if len(path) < depth:
+                # Account for the quotes, if the value has any.
+                if inData[i] == '"':
+                    end = i + len(value) + 2
+                else:
+                    end = i + len(value)
+                    
+                index[tuple(path) + (key,)] = (i, end)
+                
+            key = None
+            
+        elif tokenType == TOKEN_OPEN:
+            if key is None:
+                raise VDFConsistencyFailure("Brackets have no heading!")
+                
+            path.append(key)
+            blockStarts.append(i)
+            
+            if len(path) <= depth:
+                # Reserve the key path's slot, so that the index stays in 
+                # document order. The range is filled in once the block ends.
+                index[tuple(path)] = None
+                
+            key = None
+            
+        elif tokenType == TOKEN_CLOSE:
+            if not path or key is not None:
+                raise VDFConsistencyFailure("Mismatched brackets!")
+                
+            if len(path) <= depth:
+                index[tuple(path)] = (blockStarts[-1], i + 1)
+                
+            path.pop()
+            blockStarts.pop()
+            
+    if path:
+        raise VDFConsistencyFailure("Mismatched brackets!")
+        
+    if key is not None:
+        raise VDFConsistencyFailure("Key without value!")
+        
+    return index
+    
+    
+def parse_vdf_value(inData, ordered=True, duplicates=False):
+    """ Parse a single VDF value, such as a range given by build_vdf_index(), 
+    and return either its string contents or a dictionary representing its 
+    block.
+    
+    """
+    
+    inData = inData.strip()
+    
+    if inData.startswith('{'):
+        if not inData.endswith('}'):
+            raise VDFConsistencyFailure("Mismatched brackets!")
+            
+        return parse_vdf(inData[1:-1], ordered=ordered, duplicates=duplicates)
+        
+    elif inData.startswith('"'):
+        return inData[1:-1]
+        
+    else:
+        return inData
+        
+        
+def _hash_file(path):
+    """ Returns the MD5 hex digest of the given file's contents. """
+    
+    md5 = hashlib.md5()
+    
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+            
+    return md5.hexdigest()
+    
+    
+def load_vdf_index(path, depth):
+    """ Return the offset index of the VDF file at the given path, as built 
+    by build_vdf_index(). The index is loaded from the file's sidecar if the 
+    sidecar is still valid; otherwise the index is rebuilt from the file and 
+    the sidecar is rewritten.
+    
+    A sidecar is only valid if it was built with at least the given depth, 
+    and if the file's size, modification time, and contents hash all still 
+    match. An index that is deeper than needed still serves shallower 
+    lookups, so a rebuilt sidecar never gets shallower than the one it 
+    replaces, and lookups at different depths don't keep rewriting it.
+    
+    """
+    
+    indexPath = path + INDEX_SUFFIX
+    
+    stat = os.stat(path)
+    
+    # The depth that the index is built with, if it has to be rebuilt.
+    buildDepth = depth
+    
+    try:
+        with open(indexPath, 'rb') as f:
+            sidecar = json.load(f)
+            
+        sidecarDepth = int(sidecar['depth'])
+        
+        # The size and mtime checks are cheap, so do those before hashing.
+        if (sidecarDepth >= depth
+                and sidecar['size'] == stat.st_size
+                and sidecar['mtime'] == stat.st_mtime
+                and sidecar['hash'] == _hash_file(path)):
+            return OrderedDict(
+                (tuple(keyPath), (start, end))
+                for keyPath, start, end in sidecar['entries']
+                if len(keyPath) <= depth
+            )
+            
+        buildDepth = max(depth, sidecarDepth)
+        
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        # Missing, unreadable or malformed sidecars are simply rebuilt.
+        pass
+        
+    with open(path, 'rb') as f:
+        data = f.read()
+        
+    index = build_vdf_index(data, buildDepth)
+    
+    sidecar = OrderedDict(
+            (
+                ('depth', buildDepth),
+                ('size', stat.st_size),
+                ('mtime', stat.st_mtime),
+                ('hash', hashlib.md5(data).hexdigest()),
+                (
+                    'entries',
+                    [
+                        [list(keyPath), start, end]
+                        for keyPath, (start, end) in index.iteritems()
+                    ]
+                ),
+            )
+        )
+        
+    try:
+        with open(indexPath, 'wb') as f:
+            json.dump(sidecar, f)
+            
+    except (IOError, OSError):
+        pass    # The index still works; it just won't be persisted.
+        
+    if buildDepth > depth:
+        index = OrderedDict(
+            (keyPath, valueRange)
+            for keyPath, valueRange in index.iteritems()
+            if len(keyPath) <= depth
+        )
+        
+    return index
+    
+    
+def read_vdf_subtree(path, keyPath, index=None, depth=None):
+    """ Parse and return only the value at the given key path within the VDF 
+    file at the given path, by seeking directly to its range instead of 
+    parsing the whole file.
+    
+    index:          Offset index of the file, from load_vdf_index()
+    depth:          Depth of the index to load, if no index is given 
+                    (defaults to the length of the key path)
+                    
+    """
+    
+    keyPath = tuple(keyPath)
+    
+    if index is None:
+        if depth is None:
+            depth = len(keyPath)
+            
+        index = load_vdf_index(path, depth)
+        
+    try:
+        start, end = index[keyPath]
+    except KeyError:
+        raise KeyError("Key path not in index: {}".format(keyPath))
+        
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+        
+    return parse_vdf_value(data)
+    
+    
 def format_vdf(data, indentLevel=0):
     """ Take dictionary data and return a string representing that data in VDF 
-    format.
+    format. Values that are lists (as produced by parse_vdf() in multivalue 
+    mode) are written out as one entry per list item, under the same key.
     
     """
     
@@ -245,26 +529,29 @@ def format_vdf(data, indentLevel=0):
     
     outData = []
     
-    for key, item in data.iteritems():
-        key = key.replace(UNIQUEIFIER, '')
-        
-        if type(item) is str or type(item) is unicode:
-            outData += (
-                INDENT,
-                '"{}"'.format(key),
-                SINGLE_INDENT,
-                '"{}"'.format(item),
-                '\n',
-            )
-            
-        else:
-            outData += (
-                INDENT, '"{}"'.format(key),
-                '\n', INDENT, '{\n',
-                format_vdf(item, indentLevel + 1),  # Recursion is fun!
-                '\n', INDENT, '}\n',
-            )
+    for key, items in data.iteritems():
+        if type(items) is not list:
+            key = key.replace(UNIQUEIFIER, '')
+            items = (items,)
             
+        for item in items:
+            if type(item) is str or type(item) is unicode:
+                outData += (
+                    INDENT,
+                    '"{}"'.format(key),
+                    SINGLE_INDENT,
+                    '"{}"'.format(item),
+                    '\n',
+                )
+                
+            else:
+                outData += (
+                    INDENT, '"{}"'.format(key),
+                    '\n', INDENT, '{\n',
+                    format_vdf(item, indentLevel + 1),  # Recursion is fun!
+                    '\n', INDENT, '}\n',
+                )
+                
     return ''.join(outData)
     
     
\ No newline at end of file
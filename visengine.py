@@ -0,0 +1,981 @@
+"""
+
+visengine.py
+
+Headless visibility calculations for the VIS Project. Works out which leaves 
+of a BSP tree can be seen from a viewpoint and view angle, and which pixels 
+of those leaves are within view. Nothing in here depends on Pygame or on 
+module-level state, so servers can use it directly; vismain.py is just one 
+client that draws the results.
+
+"""
+
+import math
+import multiprocessing
+from itertools import izip, chain
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+    
+from bsp import BSPTree
+
+__all__ = (
+    'VisibilityEngine',
+    'VisibilityPool',
+    'iter_viewcone_spans',
+    'new_mask',
+    'fill_mask',
+    'mask_from_viewcones',
+    'viewcone_covers_surface',
+)
+
+# Default angle of the viewcone, in radians.
+DEFAULT_FOV = math.radians(135)
+
+
+def new_coord_rebaser(base):
+    """ Curried coordinate rebase function. Takes a set of base coordinates 
+    and returns a function that can be used to convert absolute coordinates 
+    to coordinates relative to the given base.
+    
+    """
+    
+    def rebaser(absCoords):
+        ''' Takes a set of absolute coordinates and returns a new set of 
+        coordinates relative to the original base coordinates.
+        
+        '''
+        
+        return (absCoords[0] - base[0], absCoords[1] - base[1])
+        
+    return rebaser
+    
+    
+def normal_from_lineseg(seg):
+    """ Returns a normal vector with respect to the given line segment. """
+    
+    start, end = seg
+    
+    x1, y1 = start
+    x2, y2 = end
+    
+    dx = x2 - x1
+    dy = y2 - y1
+    
+    return (dy, -dx)
+    
+    
+def dot(a, b):
+    """ Returns the dot product of two vectors. """
+    return a[0] * b[0] + a[1] * b[1]
+    
+    
+def sign(n):
+    """ Returns -1 if n is negative, 1 if n is positive, and 0 otherwise. """
+    if n > 0:
+        return 1
+    elif n < 0:
+        return -1
+    else:
+        return 0
+        
+        
+def clip_span_to_halfplane(start, end, normal, side, viewX, relY):
+    """ Takes a half-open span [start, end) of pixel columns within a row of 
+    pixels, and returns the part of that span whose pixels lie on the given 
+    side of a line through the viewpoint. A pixel lies on the given side if 
+    the sign of the dot product between the line's normal and the pixel's 
+    viewpoint-relative coordinates equals 'side'. The row is given by its 
+    Y coordinate relative to the viewpoint.
+    
+    Since the dot product is linear along the row, the pixels that pass the 
+    test always form a contiguous run at one end of the row. The boundary is 
+    estimated analytically and then nudged until it agrees with the per-pixel 
+    test, so the result matches testing every pixel individually.
+    
+    """
+    
+    def inside(x):
+        ''' Returns whether or not the pixel in column x is on the given side 
+        of the line.
+        
+        '''
+        
+        return sign(dot(normal, (x - viewX, relY))) == side
+        
+    normalX, normalY = normal
+    
+    if normalX == 0:
+        # The line is parallel to the row, so the whole row is on one side.
+        if inside(start):
+            return start, end
+        else:
+            return start, start
+            
+    # The column at which the line crosses the row, clamped to the span.
+    root = viewX - float(normalY) * relY / normalX
+    root = min(max(root, start - 1), end + 1)
+    
+    if normalX * side > 0:
+        # Pixels to the right of the line pass, so keep the right end.
+        bound = min(max(int(math.ceil(root)), start), end)
+        
+        while bound > start and inside(bound - 1):
+            bound -= 1
+        while bound < end and not inside(bound):
+            bound += 1
+            
+        return bound, end
+        
+    else:
+        # Pixels to the left of the line pass, so keep the left end.
+        bound = min(max(int(math.floor(root)) + 1, start), end)
+        
+        while bound < end and inside(bound):
+            bound += 1
+        while bound > start and not inside(bound - 1):
+            bound -= 1
+            
+        return start, bound
+        
+        
+def iter_viewcone_spans(size, viewconeLeft, viewconeRight):
+    """ Takes the size of a visleaf and yields the rectangles of pixels that 
+    lie between and in front of the given viewcone line segments, as 
+    (x, y, width, height) tuples. The viewcone line segment coordinates are 
+    expected to be rebased with respect to the top-left corner of the 
+    visleaf. The rectangles don't overlap, and are yielded from top to 
+    bottom.
+    
+    The area within the viewcone is the intersection of two half-planes with 
+    the leaf's rectangle, so every row of pixels within it is a single span. 
+    Rows that neither viewcone line crosses all have the same span, so those 
+    are yielded as whole rectangles; only the rows that a viewcone line 
+    actually crosses are computed one span at a time, and consecutive rows 
+    with the same span are merged.
+    
+    """
+    
+    surfWidth, surfHeight = size
+    
+    # Get the viewpoint.
+    viewpoint = viewconeLeft[0]
+    
+    # The left and right line segments must originate from the same point.
+    assert viewpoint == viewconeRight[0]
+    
+    viewX, viewY = viewpoint
+    
+    # A pixel is within the viewcone if its viewpoint-relative coordinates 
+    # have a negative dot product with the left viewcone normal, and a 
+    # positive dot product with the right viewcone normal.
+    halfplanes = (
+        (normal_from_lineseg(viewconeLeft), -1),
+        (normal_from_lineseg(viewconeRight), 1),
+    )
+    
+    def row_span(y):
+        ''' Returns the half-open range of columns within row y that fall 
+        within the viewcone.
+        
+        '''
+        
+        start, end = 0, surfWidth
+        relY = y - viewY
+        
+        for normal, side in halfplanes:
+            start, end = clip_span_to_halfplane(
+                    start, end,
+                    normal, side,
+                    viewX, relY,
+                )
+                
+            if start >= end:
+                return (0, 0)
+                
+        return (start, end)
+        
+    def row_side(normal, y):
+        ''' Returns the side of the given viewcone line that every pixel in 
+        row y strictly lies on, judging by the first and last pixels of the 
+        row. Returns 0 if the line crosses or touches the row.
+        
+        '''
+        
+        relY = y - viewY
+        
+        firstSign = sign(dot(normal, (-viewX, relY)))
+        lastSign = sign(dot(normal, (surfWidth - 1 - viewX, relY)))
+        
+        if firstSign == lastSign:
+            return firstSign
+        else:
+            return 0
+            
+    # Split the rows into bands wherever a viewcone line crosses the first or 
+    # last column, so that within each band, each viewcone line either 
+    # crosses every row or no row at all.
+    breakpoints = {0, surfHeight}
+    for normal, side in halfplanes:
+        normalX, normalY = normal
+        
+        if normalY == 0:
+            continue
+            
+        for column in (0, surfWidth - 1):
+            crossing = viewY - float(normalX) * (column - viewX) / normalY
+            crossing = int(math.floor(min(max(crossing, -1), surfHeight)))
+            
+            # Put the crossing row into a band of its own, since the float 
+            # estimate may be off by a row.
+            for y in (crossing, crossing + 2):
+                if 0 < y < surfHeight:
+                    breakpoints.add(y)
+                    
+    breakpoints = sorted(breakpoints)
+    
+    def iter_runs():
+        ''' Yields a (start, end, y, height) tuple for each run of rows that 
+        share the same span of columns [start, end). The spans may be empty.
+        
+        '''
+        
+        for bandStart, bandEnd in izip(breakpoints, breakpoints[1:]):
+            uniform = True
+            for normal, side in halfplanes:
+                firstSide = row_side(normal, bandStart)
+                
+                lastSide = row_side(normal, bandEnd - 1)
+                
+                if firstSide == 0 or lastSide != firstSide:
+                    uniform = False
+                    break
+                    
+            if uniform:
+                # Neither viewcone line crosses this band, so every row has 
+                # the same span.
+                start, end = row_span(bandStart)
+                yield (start, end, bandStart, bandEnd - bandStart)
+                continue
+                
+            # Go through the band row by row, merging runs of identical spans.
+            runSpan = row_span(bandStart)
+            runStart = bandStart
+            
+            for y in xrange(bandStart + 1, bandEnd):
+                span = row_span(y)
+                
+                if span != runSpan:
+                    yield (runSpan[0], runSpan[1], runStart, y - runStart)
+                    runSpan = span
+                    runStart = y
+                    
+            yield (runSpan[0], runSpan[1], runStart, bandEnd - runStart)
+            
+    for start, end, y, height in iter_runs():
+        if start < end:
+            yield (start, y, end - start, height)
+            
+            
+def compare_directions(a, b):
+    """ Compares the angles of two direction vectors that lie within half a 
+    turn of each other, where an angle 'a' corresponds to the direction 
+    (sin(a), cos(a)). Returns a negative number if a's angle is less than 
+    b's, a positive number if it is greater, and zero if both vectors point 
+    the same way.
+    
+    This is just the cross product of the two vectors, so it is exact for 
+    integer vectors.
+    
+    """
+    
+    return a[0] * b[1] - a[1] * b[0]
+    
+    
+def direction_within_arc(direction, low, high):
+    """ Returns whether or not the given direction vector lies within the arc 
+    that sweeps from the direction vector 'low' to the direction vector 
+    'high' in the direction of increasing angle. The arc may be at most half 
+    a turn wide, but the given direction may point anywhere.
+    
+    """
+    
+    return (compare_directions(low, direction) <= 0
+            and compare_directions(direction, high) <= 0)
+            
+            
+def intersect_intervals(intervals, arc):
+    """ Returns the parts of an angular interval list that lie within the 
+    given (low, high) arc, which may be at most half a turn wide.
+    
+    Angular interval lists are sorted lists of disjoint (low, high) pairs of 
+    direction vectors, which all lie within the same viewcone. Since the 
+    viewcone is narrower than half a turn, their directions can be ordered 
+    with compare_directions().
+    
+    """
+    
+    arcLow, arcHigh = arc
+    
+    result = []
+    
+    for low, high in intervals:
+        # The intersection starts at whichever start lies within the other 
+        # arc, if any.
+        if not direction_within_arc(low, arcLow, arcHigh):
+            if not direction_within_arc(arcLow, low, high):
+                continue
+                
+            low = arcLow
+            
+        if not direction_within_arc(high, arcLow, arcHigh):
+            high = arcHigh
+            
+        if compare_directions(low, high) < 0:
+            result.append((low, high))
+            
+    return result
+    
+    
+def unite_intervals(intervals1, intervals2):
+    """ Returns the union of two angular interval lists. Touching intervals 
+    are merged together.
+    
+    """
+    
+    result = []
+    
+    # Sort the intervals by their starting directions.
+    allIntervals = sorted(
+            intervals1 + intervals2,
+            cmp=lambda a, b: sign(compare_directions(a[0], b[0])),
+        )
+        
+    for low, high in allIntervals:
+        if result and compare_directions(low, result[-1][1]) <= 0:
+            if compare_directions(high, result[-1][1]) > 0:
+                result[-1] = (result[-1][0], high)
+        else:
+            result.append((low, high))
+            
+    return result
+    
+    
+def subtract_intervals(intervals1, intervals2):
+    """ Returns the parts of the first angular interval list that are not 
+    covered by the second angular interval list.
+    
+    """
+    
+    result = []
+    
+    for low, high in intervals1:
+        for otherLow, otherHigh in intervals2:
+            if (compare_directions(otherHigh, low) <= 0
+                    or compare_directions(otherLow, high) >= 0):
+                continue
+                
+            if compare_directions(low, otherLow) < 0:
+                result.append((low, otherLow))
+                
+            if compare_directions(low, otherHigh) < 0:
+                low = otherHigh
+                
+        if compare_directions(low, high) < 0:
+            result.append((low, high))
+            
+    return result
+    
+    
+def portal_arc(portal, leaf, viewPos):
+    """ Returns the (low, high) arc of direction vectors through which the 
+    given portal can be seen from the given viewpoint, when looking out of 
+    the given leaf. Returns None if the portal can only be seen edge-on.
+    
+    """
+    
+    startVector = (portal.start[0] - viewPos[0], portal.start[1] - viewPos[1])
+    endVector = (portal.end[0] - viewPos[0], portal.end[1] - viewPos[1])
+    
+    if viewPos[portal.axis] * portal.normal[portal.axis] == portal.offset:
+        # The viewpoint is on the portal's line.
+        
+        if dot(startVector, endVector) > 0:
+            # The viewpoint is beyond either end of the portal, so the portal 
+            # is only ever seen edge-on.
+            return None
+            
+        # The viewpoint is on the portal itself, so everything on the far 
+        # side of the portal can be seen through it.
+        if leaf is portal.leaf1:
+            farX, farY = portal.normal
+        else:
+            farX, farY = -portal.normal[0], -portal.normal[1]
+            
+        return ((-farY, farX), (farY, -farX))
+        
+    # The portal is seen through less than half a turn, starting from 
+    # whichever endpoint has the lower angle.
+    if compare_directions(startVector, endVector) < 0:
+        return (startVector, endVector)
+    else:
+        return (endVector, startVector)
+        
+        
+def viewcone_covers_surface(size, viewconeLeft, viewconeRight):
+    """ Returns whether or not every pixel of a surface of the given size 
+    lies within the given viewcone, whose line segments are rebased with 
+    respect to the surface. Since the viewcone is convex, it is enough to 
+    test the corner pixels.
+    
+    """
+    
+    width, height = size
+    
+    viewpoint = viewconeLeft[0]
+    viewconeLeftNormal = normal_from_lineseg(viewconeLeft)
+    viewconeRightNormal = normal_from_lineseg(viewconeRight)
+    
+    for x in (0, width - 1):
+        for y in (0, height - 1):
+            rel = (x - viewpoint[0], y - viewpoint[1])
+            
+            if not (dot(viewconeLeftNormal, rel) < 0
+                    and dot(viewconeRightNormal, rel) > 0):
+                return False
+                
+    return True
+    
+    
+def new_mask(size, maskFormat='bytes'):
+    """ Returns a new mask of the given size with every pixel set to 0. Masks 
+    are in row-major order, with one byte per pixel that is 1 if the pixel 
+    is visible and 0 otherwise.
+    
+    The 'bytes' mask format is a bytearray of width * height bytes. The 
+    'numpy' mask format is a NumPy uint8 array of shape (height, width).
+    
+    """
+    
+    width, height = size
+    
+    if maskFormat == 'numpy':
+        if numpy is None:
+            raise ValueError("The numpy mask format requires NumPy.")
+            
+        return numpy.zeros((height, width), dtype=numpy.uint8)
+        
+    elif maskFormat == 'bytes':
+        return bytearray(width * height)
+        
+    else:
+        raise ValueError("Unknown mask format: {}".format(maskFormat))
+        
+        
+def fill_mask(mask, maskSize, size, viewcones, offset=(0, 0)):
+    """ Takes a mask of the given size (see new_mask()) and sets every pixel 
+    within any of the given viewcones to 1. The viewcones are given as 
+    (viewconeLeft, viewconeRight) pairs rebased with respect to a visleaf of 
+    the given size, whose top-left corner is at the given offset within the 
+    mask. Pixels that fall outside of the mask are ignored.
+    
+    """
+    
+    maskWidth, maskHeight = maskSize
+    offsetX, offsetY = offset
+    
+    for viewconeLeft, viewconeRight in viewcones:
+        for x, y, w, h in iter_viewcone_spans(
+                size, viewconeLeft, viewconeRight):
+            # Clip the rectangle to the mask.
+            left = max(x + offsetX, 0)
+            top = max(y + offsetY, 0)
+            right = min(x + offsetX + w, maskWidth)
+            bottom = min(y + offsetY + h, maskHeight)
+            
+            if left >= right or top >= bottom:
+                continue
+                
+            if isinstance(mask, bytearray):
+                row = '\x01' * (right - left)
+                for rowStart in xrange(
+                        top * maskWidth, bottom * maskWidth, maskWidth):
+                    mask[rowStart + left:rowStart + right] = row
+                    
+            else:
+                mask[top:bottom, left:right] = 1
+                
+                
+def mask_from_viewcones(size, viewcones, maskFormat='bytes'):
+    """ Takes the size of a visleaf and a list of viewcones, given as 
+    (viewconeLeft, viewconeRight) pairs rebased with respect to that leaf, 
+    and returns a new mask (see new_mask()) of the pixels within any of the 
+    viewcones.
+    
+    """
+    
+    mask = new_mask(size, maskFormat)
+    fill_mask(mask, size, size, viewcones)
+    
+    return mask
+    
+    
+class VisibilityEngine(object):
+    """ Calculates what can be seen within a single BSP tree. The tree's 
+    portals must have been generated beforehand.
+    
+    Results are returned as plain data, keyed by the tree's visleaves. Engines 
+    don't share any state with each other, so any number of engines can be 
+    used at once, for the same tree or for different trees.
+    
+    """
+    
+    def __init__(self, bspTree, fov=DEFAULT_FOV):
+        self.bspTree = bspTree
+        self.fov = fov
+        
+        # Rotating a direction vector by half the FOV either way gives the 
+        # directions of the viewcone boundaries.
+        self._cosHalfFOV = math.cos(fov * 0.5)
+        self._sinHalfFOV = math.sin(fov * 0.5)
+        
+        # Statistics.
+        self.leafVisits = 0
+        self.portalTests = 0
+        self.culledPortalTests = 0
+        
+    def __repr__(self):
+        return "VisibilityEngine({}, {})".format(
+                repr(self.bspTree), self.fov,
+            )
+            
+    def __str__(self):
+        return (
+            "<VisibilityEngine: {} leaf visits; {} portal tests, {} avoided "
+            "by the PVS>".format(
+                self.leafVisits, self.portalTests, self.culledPortalTests,
+            )
+        )
+        
+    def _get_viewcone_intervals(self, viewPos, viewTarget):
+        ''' Returns the angular interval list covered by the whole viewcone 
+        when looking from the given viewing position towards the given view 
+        target position.
+        
+        '''
+        
+        # Calculate the viewing vector.
+        viewX = viewTarget[0] - viewPos[0]
+        viewY = viewTarget[1] - viewPos[1]
+        
+        if viewX == 0 and viewY == 0:
+            # Look straight down if the view target is the viewpoint itself.
+            viewY = 1
+            
+        # Determine the viewcone boundary directions, by rotating the viewing 
+        # vector by half the FOV either way.
+        viewconeLeftDirection = (
+            viewX * self._cosHalfFOV + viewY * self._sinHalfFOV,
+            viewY * self._cosHalfFOV - viewX * self._sinHalfFOV,
+        )
+        
+        viewconeRightDirection = (
+            viewX * self._cosHalfFOV - viewY * self._sinHalfFOV,
+            viewY * self._cosHalfFOV + viewX * self._sinHalfFOV,
+        )
+        
+        return [(viewconeRightDirection, viewconeLeftDirection)]
+        
+    def _traverse(self, playerLeaf, views):
+        ''' Walks the portals outwards from the given leaf for several 
+        viewers in that leaf at once. Takes a list of (viewPos, viewTarget) 
+        pairs, and returns a list holding an OrderedDict for each viewer, 
+        which maps every leaf visible to that viewer to the angular interval 
+        list through which it is seen.
+        
+        Each stack entry carries the intervals of every viewer that reaches 
+        a leaf through the same portal, so the viewers share the stack and 
+        the walk over each leaf's portals.
+        
+        If the tree has a PVS loaded, portals that lead to leaves outside the 
+        given leaf's PVS are skipped without being tested, so the walk never 
+        enters those leaves at all.
+        
+        '''
+        
+        # Viewers that aren't in any leaf, like viewers in a chunk of a 
+        # world.BSPWorld that isn't loaded, can't see anything.
+        if playerLeaf is None:
+            return [OrderedDict() for view in views]
+            
+        viewPositions = [viewPos for viewPos, viewTarget in views]
+        
+        # Maps each visible leaf to the angular interval list of the view 
+        # that reaches it, for each viewer.
+        visleafIntervalsDicts = [OrderedDict() for view in views]
+        
+        arrivals = [
+            (i, self._get_viewcone_intervals(viewPos, viewTarget))
+            for i, (viewPos, viewTarget) in enumerate(views)
+        ]
+        
+        visleafStack = [(playerLeaf, arrivals)]
+        
+        # The set of leaves that can possibly be seen from the given leaf, or 
+        # an empty set if no PVS has been loaded.
+        pvs = playerLeaf.pvs
+        
+        leafVisits = 0
+        portalTests = 0
+        culledPortalTests = 0
+        
+        while visleafStack:
+            visleaf, arrivals = visleafStack.pop()
+            
+            # Only the directions that haven't reached this leaf yet need to 
+            # be propagated any further.
+            newArrivals = []
+            
+            for i, intervals in arrivals:
+                visleafIntervalsDict = visleafIntervalsDicts[i]
+                
+                oldIntervals = visleafIntervalsDict.get(visleaf, [])
+                newIntervals = subtract_intervals(intervals, oldIntervals)
+                
+                if not newIntervals:
+                    continue
+                    
+                visleafIntervalsDict[visleaf] = unite_intervals(
+                        oldIntervals, newIntervals,
+                    )
+                    
+                newArrivals.append((i, newIntervals))
+                
+            if not newArrivals:
+                continue
+                
+            leafVisits += 1
+            
+            # Test portals for visibility.
+            for portal in visleaf.portals:
+                otherLeaf = portal.get_other(visleaf)
+                
+                if pvs and otherLeaf not in pvs:
+                    culledPortalTests += len(newArrivals)
+                    continue
+                    
+                portalTests += len(newArrivals)
+                
+                throughArrivals = []
+                
+                for i, newIntervals in newArrivals:
+                    arc = portal_arc(portal, visleaf, viewPositions[i])
+                    
+                    if arc is None:
+                        continue
+                        
+                    throughIntervals = intersect_intervals(newIntervals, arc)
+                    
+                    if throughIntervals:
+                        throughArrivals.append((i, throughIntervals))
+                        
+                if throughArrivals:
+                    visleafStack.append((otherLeaf, throughArrivals))
+                    
+        self.leafVisits += leafVisits
+        self.portalTests += portalTests
+        self.culledPortalTests += culledPortalTests
+        
+        return visleafIntervalsDicts
+        
+    def get_view_intervals(self, viewPos, viewTarget):
+        ''' Takes a viewing position and a view target position, and returns 
+        an OrderedDict that maps every visible leaf to the angular interval 
+        list (see intersect_intervals()) through which it is seen.
+        
+        '''
+        
+        # Determine player visleaf.
+        playerLeaf = self.bspTree.leaf_from_coords(*viewPos)
+        
+        return self._traverse(playerLeaf, [(viewPos, viewTarget)])[0]
+        
+    def get_visible_leaves(self, viewPos, viewTarget):
+        ''' Returns a list of the leaves that are visible from the given 
+        viewing position when looking towards the given view target position.
+        
+        '''
+        
+        return self.get_view_intervals(viewPos, viewTarget).keys()
+        
+    def get_visible_leaves_batch(self, views):
+        ''' Takes a list of (viewPos, viewTarget) pairs, one per viewer, and 
+        returns a list holding a frozenset of the leaves visible to each 
+        viewer.
+        
+        Viewers are grouped by the leaf that they're in, so each group only 
+        looks up its leaf once and walks the portals together (see 
+        ._traverse()). Viewers with identical views share a single result.
+        
+        '''
+        
+        # Maps each leaf that holds viewers to an OrderedDict that maps each 
+        # distinct view in that leaf to the indices of its viewers.
+        viewGroups = OrderedDict()
+        
+        playerLeaf = None
+        
+        for i, (viewPos, viewTarget) in enumerate(views):
+            x, y = viewPos
+            
+            # Viewers tend to be near each other, so check whether this 
+            # viewer is in the same leaf as the last one before searching 
+            # the tree.
+            if playerLeaf is None or not (
+                    playerLeaf.bounds[0] <= x < playerLeaf.bounds[2]
+                    and playerLeaf.bounds[1] <= y < playerLeaf.bounds[3]):
+                playerLeaf = self.bspTree.leaf_from_coords(x, y)
+                
+            viewGroup = viewGroups.setdefault(playerLeaf, OrderedDict())
+            viewGroup.setdefault((viewPos, viewTarget), []).append(i)
+            
+        results = [None] * len(views)
+        
+        for playerLeaf, viewGroup in viewGroups.iteritems():
+            groupViews = viewGroup.keys()
+            
+            visleafIntervalsDicts = self._traverse(playerLeaf, groupViews)
+            
+            for view, visleafIntervalsDict in izip(
+                    groupViews, visleafIntervalsDicts):
+                visleaves = frozenset(visleafIntervalsDict)
+                
+                for i in viewGroup[view]:
+                    results[i] = visleaves
+                    
+        return results
+        
+    def get_viewcones(self, viewPos, viewTarget):
+        ''' Returns an OrderedDict that maps every visible leaf to a list of 
+        (viewconeLeft, viewconeRight) line segment pairs, rebased with respect 
+        to the top-left corner of the leaf. The visible part of each leaf is 
+        the union of its viewcones.
+        
+        '''
+        
+        visleafViewconesDict = OrderedDict()
+        
+        visleafIntervalsDict = self.get_view_intervals(viewPos, viewTarget)
+        
+        for visleaf, intervals in visleafIntervalsDict.iteritems():
+            leafcoords_from_abscoords = new_coord_rebaser(
+                    visleaf.get_top_left()
+                )
+                
+            viewpoint = leafcoords_from_abscoords(viewPos)
+            
+            visleafViewcones = []
+            
+            for low, high in intervals:
+                visleafViewconeLeft = (
+                    viewpoint,
+                    (viewpoint[0] + high[0], viewpoint[1] + high[1]),
+                )
+                
+                visleafViewconeRight = (
+                    viewpoint,
+                    (viewpoint[0] + low[0], viewpoint[1] + low[1]),
+                )
+                
+                visleafViewcones.append(
+                        (visleafViewconeLeft, visleafViewconeRight)
+                    )
+                    
+            visleafViewconesDict[visleaf] = visleafViewcones
+            
+        return visleafViewconesDict
+        
+    def get_masks(self, viewPos, viewTarget, maskFormat='bytes'):
+        ''' Returns an OrderedDict that maps every visible leaf to a mask of 
+        its visible pixels. See new_mask() for the mask formats.
+        
+        '''
+        
+        visleafViewconesDict = self.get_viewcones(viewPos, viewTarget)
+        
+        visleafMaskDict = OrderedDict()
+        
+        for visleaf, viewcones in visleafViewconesDict.iteritems():
+            visleafMaskDict[visleaf] = mask_from_viewcones(
+                    visleaf.get_size(), viewcones, maskFormat,
+                )
+                
+        return visleafMaskDict
+        
+    def get_screen_mask(self, viewPos, viewTarget, size=None,
+            maskFormat='bytes'):
+        ''' Returns a single mask (see new_mask()) of everything that is 
+        visible, in absolute coordinates. Unless a different size is given, 
+        the mask reaches from (0, 0) to the bottom-right corner of the BSP 
+        tree, or of the loaded chunks of a world.BSPWorld.
+        
+        '''
+        
+        if size is None:
+            left, top, right, bottom = self.bspTree.get_bounds()
+            size = (right, bottom)
+            
+        mask = new_mask(size, maskFormat)
+        
+        visleafViewconesDict = self.get_viewcones(viewPos, viewTarget)
+        
+        for visleaf, viewcones in visleafViewconesDict.iteritems():
+            fill_mask(
+                    mask, size,
+                    visleaf.get_size(), viewcones,
+                    visleaf.get_top_left(),
+                )
+                
+        return mask
+        
+        
+# The VisibilityEngine of the current VisibilityPool worker process.
+_workerEngine = None
+
+
+def _init_pool_worker(bspData, pvsData, fov):
+    """ Initializes a VisibilityPool worker process, by building its own copy 
+    of the BSP tree from the given VDF data. pvsData maps the leaf IDs of 
+    visleaves to lists of the leaf IDs within their PVS.
+    
+    """
+    
+    global _workerEngine
+    
+    bspTree = BSPTree.from_vdf_fast(bspData)
+    bspTree.generate_portals()
+    
+    visleavesByID = {
+        visleaf.leafID : visleaf
+        for visleaf in bspTree.iter_visleaves()
+    }
+    
+    for leafID, pvsLeafIDs in pvsData.iteritems():
+        visleavesByID[leafID].pvs.update(
+            visleavesByID[pvsLeafID] for pvsLeafID in pvsLeafIDs
+        )
+        
+    _workerEngine = VisibilityEngine(bspTree, fov)
+    
+    
+def _get_visible_leaf_ids_batch(views):
+    """ Runs in a VisibilityPool worker process. Same as 
+    VisibilityEngine.get_visible_leaves_batch(), except that it returns lists 
+    of leaf IDs, since the leaves themselves only exist within this process.
+    
+    """
+    
+    return [
+        [visleaf.leafID for visleaf in visleaves]
+        for visleaves in _workerEngine.get_visible_leaves_batch(views)
+    ]
+    
+    
+class VisibilityPool(object):
+    """ Spreads large batches of viewers over a pool of worker processes. 
+    Each worker builds its own copy of the BSP tree once, when the pool is 
+    started, and sends back the IDs of the leaves that each viewer can see.
+    
+    Batches with fewer than minParallelViews viewers aren't worth sending 
+    to the workers, and are handled within the calling process instead.
+    
+    The workers get a copy of the tree's PVS as it is when the pool is 
+    started.
+    
+    A world.BSPWorld can't be used here, since its chunks come and go, so 
+    there is no single tree to copy.
+    
+    """
+    
+    def __init__(self, bspTree, fov=DEFAULT_FOV, processes=None,
+            minParallelViews=256):
+        if not isinstance(bspTree, BSPTree):
+            raise TypeError("VisibilityPool requires a single BSPTree.")
+            
+        self.engine = VisibilityEngine(bspTree, fov)
+        self.minParallelViews = minParallelViews
+        
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+            
+        self.processes = processes
+        
+        # Serializing the tree renumbers its visleaves, so the leaf IDs have 
+        # to be collected afterwards.
+        bspData = bspTree.to_vdf()
+        
+        self._visleavesByID = {
+            visleaf.leafID : visleaf
+            for visleaf in bspTree.iter_visleaves()
+        }
+        
+        # The PVS isn't part of the VDF data, so it's sent separately.
+        pvsData = {
+            visleaf.leafID : [pvsLeaf.leafID for pvsLeaf in visleaf.pvs]
+            for visleaf in bspTree.iter_visleaves()
+            if visleaf.pvs
+        }
+        
+        self._pool = multiprocessing.Pool(
+                processes,
+                _init_pool_worker, (bspData, pvsData, fov),
+            )
+            
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        
+    def close(self):
+        ''' Shuts down the worker processes. '''
+        
+        self._pool.close()
+        self._pool.join()
+        
+    def get_visible_leaves_batch(self, views):
+        ''' Same as VisibilityEngine.get_visible_leaves_batch(). '''
+        
+        if len(views) < self.minParallelViews:
+            return self.engine.get_visible_leaves_batch(views)
+            
+        bspTree = self.engine.bspTree
+        
+        # Hand out the viewers in order of their leaves, so that viewers in 
+        # the same leaf end up with the same worker.
+        order = sorted(
+                xrange(len(views)),
+                key=lambda i: bspTree.leaf_from_coords(*views[i][0]).leafID,
+            )
+            
+        chunkSize = -(-len(views) // self.processes)
+        
+        chunks = [
+            [views[i] for i in order[start:start + chunkSize]]
+            for start in xrange(0, len(views), chunkSize)
+        ]
+        
+        results = [None] * len(views)
+        
+        chunkResults = self._pool.map(_get_visible_leaf_ids_batch, chunks)
+        
+        for i, leafIDs in izip(order, chain.from_iterable(chunkResults)):
+            results[i] = frozenset(
+                self._visleavesByID[leafID] for leafID in leafIDs
+            )
+            
+        return results
+        
\ No newline at end of file
@@ -6,21 +6,40 @@ The main graphical runtime for the VIS Project. Calculates all points within
 the 2D geometry that are visible/not visible to the current viewpoint/view 
 angle, and colors the points white or black as necessary.
 
-Currently suffers from some performance issues with regards to large open 
-spaces (see test2-bsp.vdf as a test case with bad performance). Most likely 
-bottleneck is the quadtree-esque stack manipulation algorithm, which does a 
-lot of Python object handling in a tight loop. Consider Cythonizing the 
-algorithm if profiling confirms the bottleneck.
+Large open spaces used to be slow (see test2-bsp.vdf), because shroudmaps 
+were filled with a quadtree-esque stack manipulation algorithm that did a lot 
+of Python object handling in a tight loop. Shroudmaps are now filled with one 
+span per row of pixels, and rows are only computed individually where a 
+viewcone line actually crosses them.
+
+The visibility calculations themselves are done by visengine.py, which 
+doesn't depend on Pygame. This module just draws the results.
 
 """
 
 import os
 import sys
+import json
 import math
+import time
+import argparse
+import threading
+from collections import OrderedDict
 
 import pygame
 
-from bsp import BSPTree, BSPNode
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bsp import BSPTree
+from world import BSPWorld, split_tree_into_chunks
+from visprofiler import FrameProfiler
+from visengine import (
+        VisibilityEngine, iter_viewcone_spans, viewcone_covers_surface,
+        normal_from_lineseg,
+    )
 
 # BLOCK_SIZE = 16
 BLOCK_SIZE = 32
@@ -43,6 +62,11 @@ HEIGHT = BL_HEIGHT * BLOCK_SIZE
 
 FRAMERATE = 60
 
+# Debug drawing toggles.
+DEBUG_DRAW_VIEWCONE = False
+DEBUG_DRAW_LEAF_OUTLINES = True
+DEBUG_DRAW_PORTALS = False
+
 # Angle of the viewcone, in degrees.
 fovDegrees = 135
 
@@ -59,459 +83,342 @@ COLOR_CYAN = (0, 255, 255)
 COLOR_MAGENTA = (255, 0, 255)
 COLOR_YELLOW = (255, 255, 0)
 
-_bspTree = None
+# Palette indices of the pixels in the screen mask.
+MASK_HIDDEN = 0
+MASK_VISIBLE = 1
+
+# The VisibilityEngine for the current level.
+_visEngine = None
+
+# Cache of pixel coordinate grids used by the numpy shroud backend, keyed by 
+# surface size.
+_coordGrids = {}
 
 
-def new_coord_rebaser(base):
-    """ Curried coordinate rebase function. Takes a set of base coordinates 
-    and returns a function that can be used to convert absolute coordinates 
-    to coordinates relative to the given base.
+def fill_surface_within_viewcone(surface, viewconeLeft, viewconeRight):
+    """ Takes a Pygame surface and fills it with white pixels everywhere 
+    between and in front of the given viewcone line segments. The viewcone 
+    line segment coordinates are expected to be respective to the given 
+    surface's expected offset (i.e. the segments need to be rebased with 
+    respect to the top-left corner of the visleaf that corresponds to the 
+    given surface).
+    
+    The area within the viewcone is filled one rectangle at a time, as given 
+    by visengine.iter_viewcone_spans().
     
     """
     
-    def rebaser(absCoords):
-        ''' Takes a set of absolute coordinates and returns a new set of 
-        coordinates relative to the original base coordinates.
-        
-        '''
+    for rect in iter_viewcone_spans(
+            surface.get_size(), viewconeLeft, viewconeRight):
+        surface.fill(COLOR_WHITE, rect)
         
-        return (absCoords[0] - base[0], absCoords[1] - base[1])
         
-    return rebaser
-    
-    
-def normal_from_lineseg(seg):
-    """ Returns a normal vector with respect to the given line segment. """
+def get_coord_grids(size):
+    """ Returns a pair of NumPy arrays holding the X coordinates (as a column) 
+    and Y coordinates (as a row) of every pixel in a surface of the given 
+    size, indexed the same way as pygame.surfarray arrays. The arrays are 
+    cached per surface size, and must not be modified.
     
-    start, end = seg
+    """
     
-    x1, y1 = start
-    x2, y2 = end
+    try:
+        return _coordGrids[size]
+    except KeyError:
+        pass
+        
+    width, height = size
     
-    dx = x2 - x1
-    dy = y2 - y1
+    grids = (
+        numpy.arange(width, dtype=float).reshape(width, 1),
+        numpy.arange(height, dtype=float).reshape(1, height),
+    )
     
-    return (dy, -dx)
+    _coordGrids[size] = grids
     
+    return grids
     
-def dot(a, b):
-    """ Returns the dot product of two vectors. """
-    return a[0] * b[0] + a[1] * b[1]
     
+def fill_surface_within_viewcone_numpy(surface, viewconeLeft, viewconeRight):
+    """ Same as fill_surface_within_viewcone(), except that both viewcone 
+    tests are evaluated for every pixel at once with NumPy, and the result is 
+    written straight into the surface's pixels through pygame.surfarray.
     
-def sign(n):
-    """ Returns -1 if n is negative, 1 if n is positive, and 0 otherwise. """
-    if n > 0:
-        return 1
-    elif n < 0:
-        return -1
-    else:
-        return 0
-        
-        
-def intersect_line_ray(lineSeg, raySeg):
-    """ Constructs a line from the start and end points of a given line 
-    segment, and finds the intersection between that line and a ray 
-    constructed from the start and end points of a given ray segment.
+    """
     
-    If there is no intersection (i.e. the ray goes in the opposite direction 
-    or the ray is parallel to the line), returns None.
+    # Get the viewpoint.
+    viewpoint = viewconeLeft[0]
     
-    """
+    # The left and right line segments must originate from the same point.
+    assert viewpoint == viewconeRight[0]
     
-    lineStart, lineEnd = lineSeg
-    rayStart, rayEnd = raySeg
+    viewX, viewY = viewpoint
     
-    lineVector = (lineEnd[0] - lineStart[0], lineEnd[1] - lineStart[1])
-    rayVector = (rayEnd[0] - rayStart[0], rayEnd[1] - rayStart[1])
+    # Get the viewcone normals.
+    viewconeLeftNormal = normal_from_lineseg(viewconeLeft)
+    viewconeRightNormal = normal_from_lineseg(viewconeRight)
     
-    p1x, p1y = lineStart
-    p2x, p2y = rayStart
+    xs, ys = get_coord_grids(surface.get_size())
     
-    d1x, d1y = lineVector
-    d2x, d2y = rayVector
+    # Coordinates relative to the viewpoint.
+    relXs = xs - viewX
+    relYs = ys - viewY
     
-    # Check if the ray is parallel to the line.
-    parallel = (
-        (d1x == 0 and d2x == 0)
-        or ((d1x != 0 and d2x != 0) and
-            (float(d1y) / d1x == float(d2y) / d2x))
+    # Same test as the per-pixel rule: negative dot product with the left 
+    # normal, and positive dot product with the right normal.
+    mask = (
+        (viewconeLeftNormal[0] * relXs + viewconeLeftNormal[1] * relYs < 0)
+        & (viewconeRightNormal[0] * relXs + viewconeRightNormal[1] * relYs > 0)
     )
     
-    intersection = None
-    
-    # Only non-parallel lines can ever intersect.
-    if not parallel:
-        # Parametrize the line and ray to find the intersection.
-        parameter = (
-            float(p2y * d1x - p1y * d1x - p2x * d1y + p1x * d1y)
-            / (d2x * d1y - d1x * d2y)
-        )
+    if surface.get_bytesize() == 3:
+        # 24-bit surfaces can't be referenced as 2D arrays of mapped colors.
+        pixels = pygame.surfarray.pixels3d(surface)
+        pixels[mask] = COLOR_WHITE
         
-        # Only consider intersections that occur in front of the ray.
-        if parameter >= 0:
-            intersection = (
-                p2x + parameter * d2x,
-                p2y + parameter * d2y,
-            )
-            
-    return intersection
+    else:
+        pixels = pygame.surfarray.pixels2d(surface)
+        pixels[mask] = surface.map_rgb(COLOR_WHITE)
+        
+    # Release the surface lock.
+    del pixels
     
     
-def fill_surface_within_viewcone(surface, viewconeLeft, viewconeRight):
-    """ Takes a Pygame surface and fills it with white pixels everywhere 
-    between and in front of the given viewcone line segments. The viewcone 
-    line segment coordinates are expected to be respective to the given 
-    surface's expected offset (i.e. the segments need to be rebased with 
-    respect to the top-left corner of the visleaf that corresponds to the 
-    given surface).
+# Functions that can be used to fill shroudmaps, by backend name.
+SHROUD_BACKENDS = {
+    'scanline': fill_surface_within_viewcone,
+    'numpy': fill_surface_within_viewcone_numpy,
+}
+
+# The function that build_shroud() uses to fill shroudmaps.
+_fillShroudmap = fill_surface_within_viewcone
+
+
+def set_shroud_backend(name):
+    """ Selects the function that build_shroud() uses to fill shroudmaps. """
     
-    """
+    global _fillShroudmap
     
-    surfWidth = surface.get_width()
-    surfHeight = surface.get_height()
+    if name == 'numpy' and numpy is None:
+        raise ValueError("The numpy shroud backend requires NumPy.")
+        
+    _fillShroudmap = SHROUD_BACKENDS[name]
     
-    # The surface's dimensions must be divisible by the block size.
-    assert surfWidth % BLOCK_SIZE == 0
-    assert surfHeight % BLOCK_SIZE == 0
+    # Shroudmaps filled by the previous backend can't be reused.
+    _shroudmapCache.invalidate()
     
-    # Get the viewpoint.
-    viewpoint = viewconeLeft[0]
     
-    # The left and right line segments must originate from the same point.
-    assert viewpoint == viewconeRight[0]
+class ShroudmapPool(object):
+    """ A pool of shroudmap surfaces that are reused from frame to frame 
+    instead of being allocated anew for every visible leaf on every frame. 
+    Surfaces are pooled by size, since any visleaf of the same size can reuse 
+    the same surface.
     
-    viewpointcoords_from_surfcoords = new_coord_rebaser(viewpoint)
+    Free surfaces are kept to a bounded total number of pixels. When that 
+    bound is exceeded, surfaces of the sizes that were least recently used 
+    are dropped first, so moving through a large map with many differently 
+    sized leaves doesn't grow the pool without limit.
     
-    # Get the viewcone normals.
-    viewconeLeftNormal = normal_from_lineseg(viewconeLeft)
-    viewconeRightNormal = normal_from_lineseg(viewconeRight)
+    """
     
-    # Populate the block stack with initial blocks.
-    blockStack = [
-        (BLOCK_SIZE, x, y)
-        for y in xrange(0, surfHeight, BLOCK_SIZE)
-            for x in xrange(0, surfWidth, BLOCK_SIZE)
-    ]
-    
-    # Quadtree-esque algorithm for fine collision with the viewcone lines.
-    while blockStack:
-        blockSize, x, y = blockStack.pop()
-        
-        # Coordinates relative to the viewpoint.
-        relX, relY = viewpointcoords_from_surfcoords((x, y))
-        
-        firstCorner = (relX, relY)
-        leftDotSign = sign(dot(viewconeLeftNormal, firstCorner))
-        rightDotSign = sign(dot(viewconeRightNormal, firstCorner))
-        
-        if blockSize == 1:
-            # if leftDotSign in (0, 1) or rightDotSign == -1:
-            if leftDotSign == -1 and rightDotSign == 1:
-                pos = (x, y)
-                pygame.draw.line(surface, COLOR_WHITE, pos, pos)
-                
-            continue
-            
-        otherCorners = (
-            (relX + blockSize, relY),
-            (relX, relY + blockSize),
-            (relX + blockSize, relY + blockSize),
+    def __init__(self, maxFreePixels=WIDTH * HEIGHT * 2):
+        self.maxFreePixels = maxFreePixels
+        
+        # Lists of free surfaces, keyed by surface size, in order from least 
+        # recently used size to most recently used size.
+        self._free = OrderedDict()
+        self._freePixels = 0
+        
+        # Surfaces that have been handed out since the last .release_all().
+        self._inUse = []
+        
+        # Statistics.
+        self.allocations = 0
+        self.reuses = 0
+        self.evictions = 0
+        
+    def __str__(self):
+        return (
+            "<ShroudmapPool: {} allocations, {} saved by reuse, {} evicted; "
+            "{} free pixels>".format(
+                self.allocations, self.reuses, self.evictions,
+                self._freePixels,
+            )
         )
         
-        collision = False
-        for corner in otherCorners:
-            cornerLeftDotSign = sign(dot(viewconeLeftNormal, corner))
-            cornerRightDotSign = sign(dot(viewconeRightNormal, corner))
-            
-            leftCollision = cornerLeftDotSign != leftDotSign
-            rightCollision = cornerRightDotSign != rightDotSign
+    def acquire(self, size):
+        ''' Returns a shroudmap surface of the given size, filled with black 
+        and color-keyed on white. The surface belongs to the caller until the 
+        next call to .release_all().
+        
+        '''
+        
+        surfaces = self._free.pop(size, None)
+        
+        if surfaces:
+            shroudmap = surfaces.pop()
+            self._freePixels -= size[0] * size[1]
+            self.reuses += 1
             
-            if leftCollision or rightCollision:
-                # Collision with a viewcone line detected.
+            if surfaces:
+                # Re-insert the list, marking its size as recently used.
+                self._free[size] = surfaces
                 
-                if not (leftCollision and rightCollision):
-                    # Ignore the collision if the block is behind the viewcone 
-                    # frustum.
-                    if ((leftCollision and rightDotSign == -1)
-                            or (rightCollision and leftDotSign == 1)):
-                        continue
-                        
-                newBlockSize = blockSize / 2
-                
-                blockStack.append(
-                        (newBlockSize, x, y)
-                    )
-                blockStack.append(
-                        (newBlockSize, x + newBlockSize, y)
-                    )
-                blockStack.append(
-                        (newBlockSize, x, y + newBlockSize)
-                    )
-                blockStack.append(
-                        (newBlockSize, x + newBlockSize, y + newBlockSize)
-                    )
-                    
-                collision = True
-                break
+        else:
+            shroudmap = pygame.Surface(size)
+            shroudmap.set_colorkey(COLOR_WHITE)
+            self.allocations += 1
+            
+        shroudmap.fill(COLOR_BLACK)
+        
+        self._inUse.append(shroudmap)
+        
+        return shroudmap
+        
+    def release_all(self, keep=()):
+        ''' Returns all surfaces handed out by .acquire() to the pool, 
+        except for the given surfaces, which stay with the caller.
+        
+        '''
+        
+        keep = set(keep)
+        
+        for shroudmap in self._inUse:
+            if shroudmap in keep:
+                continue
                 
-        if not collision:
-            # No collision detected. Color the block if it falls within the 
-            # viewcone.
+            size = shroudmap.get_size()
+            
+            surfaces = self._free.pop(size, [])
+            surfaces.append(shroudmap)
+            self._free[size] = surfaces
             
-            if leftDotSign == -1 and rightDotSign == 1:
-                rect = pygame.Rect((x, y), (blockSize, blockSize))
-                pygame.draw.rect(surface, COLOR_WHITE, rect, 0)
+            self._freePixels += size[0] * size[1]
+            
+        self._inUse = [
+            shroudmap for shroudmap in self._inUse if shroudmap in keep
+        ]
+        
+        # Drop the least recently used surfaces until we're within bounds.
+        while self._freePixels > self.maxFreePixels:
+            size, surfaces = next(self._free.iteritems())
+            
+            surfaces.pop()
+            self._freePixels -= size[0] * size[1]
+            self.evictions += 1
+            
+            if not surfaces:
+                del self._free[size]
                 
                 
-def portal_within_viewcone(portal, viewconeLeft, viewconeRight):
-    """ Returns whether or not the given portal is visible within the given 
-    viewcone boundaries. Assumes that the viewcone segments use absolute 
-    coordinates.
+# Pool of the shroudmaps handed out by build_shroud().
+_shroudmapPool = ShroudmapPool()
+
+
+class ShroudmapCache(object):
+    """ Remembers the shroudmaps built by the last call to build_shroud(), so 
+    that the next call can reuse them. The whole result is reused if the 
+    viewpoint and view angle haven't changed, and individual shroudmaps are 
+    reused for every leaf whose clipped viewcones haven't changed.
+    
+    Since viewcones are keyed exactly (see viewcone_key()), a shroudmap can 
+    only be reused for a leaf that is fully visible, or when the viewpoint 
+    stays put and only the view angle changes. In the latter case, the 
+    leaves whose viewcones are only shaped by portals keep their keys, 
+    while the ones that the edges of the view reach are filled again. Any 
+    movement of the viewpoint changes the keys of every partly visible 
+    leaf.
     
     """
     
-    # Get the viewpoint.
-    viewpoint = viewconeLeft[0]
-    
-    # The left and right line segments must originate from the same point.
-    assert viewpoint == viewconeRight[0]
-    
-    intersectLeft = intersect_line_ray(
-            (portal.start, portal.end),
-            viewconeLeft,
-        )
+    def __init__(self):
+        self.invalidate()
         
-    intersectRight = intersect_line_ray(
-            (portal.start, portal.end),
-            viewconeRight,
-        )
+        # Statistics.
+        self.frameHits = 0
+        self.leafReuses = 0
+        self.leafFills = 0
         
-    # if intersectLeft:
-        # pygame.draw.circle(
-                # overlay, COLOR_BLUE,
-                # (int(intersectLeft[0]), int(intersectLeft[1])),
-                # 5,
-            # )
-            
-    # if intersectRight:
-        # pygame.draw.circle(
-                # overlay, COLOR_RED,
-                # (int(intersectRight[0]), int(intersectRight[1])),
-                # 3,
-            # )
-            
-    if intersectLeft and intersectRight:
-        intersectLeftBounded = (
-            int(min(max(intersectLeft[0], portal.start[0]), portal.end[0])),
-            int(min(max(intersectLeft[1], portal.start[1]), portal.end[1])),
+    def __str__(self):
+        return (
+            "<ShroudmapCache: {} frames reused; {} shroudmaps reused, "
+            "{} filled>".format(
+                self.frameHits, self.leafReuses, self.leafFills,
+            )
         )
         
-        intersectRightBounded = (
-            int(min(max(intersectRight[0], portal.start[0]), portal.end[0])),
-            int(min(max(intersectRight[1], portal.start[1]), portal.end[1])),
-        )
+    def invalidate(self):
+        ''' Forgets the last result, so that the next build_shroud() call 
+        rebuilds every shroudmap. Must be called whenever the BSP tree or 
+        the shroud backend changes.
         
-        return (
-            intersectLeftBounded[0] - intersectRightBounded[0] != 0 or
-            intersectLeftBounded[1] - intersectRightBounded[1] != 0
-        )
+        '''
         
-        # return (
-            # (
-                # (intersectLeft[0] <= portal.start[0] <= intersectRight[0]) or
-                # (intersectLeft[0] >= portal.start[0] >= intersectRight[0])
-            # )
-            # and (
-                # (intersectLeft[1] <= portal.start[1] <= intersectRight[1]) or
-                # (intersectLeft[1] >= portal.start[1] >= intersectRight[1])
-            # )
-            # or
-            # (
-                # (intersectLeft[0] <= portal.end[0] <= intersectRight[0]) or
-                # (intersectLeft[0] >= portal.end[0] >= intersectRight[0])
-            # )
-            # and (
-                # (intersectLeft[1] <= portal.end[1] <= intersectRight[1]) or
-                # (intersectLeft[1] >= portal.end[1] >= intersectRight[1])
-            # )
-        # )
-        
-    elif intersectLeft and not intersectRight:
-        return True
-        
-    elif not intersectLeft and intersectRight:
-        return True
-        
-    elif not intersectLeft and not intersectRight:
-        return False
-        
-    # viewcoords_from_abscoords = new_coord_rebaser(viewpoint)
-    
-    # portalStart = viewcoords_from_abscoords(portal.start)
-    # portalEnd = viewcoords_from_abscoords(portal.end)
-    
-    # # Get the viewcone normals.
-    # viewconeLeftNormal = normal_from_lineseg(viewconeLeft)
-    # viewconeRightNormal = normal_from_lineseg(viewconeRight)
-    
-    if 0:   # DEBUG
-        rebase = new_coord_rebaser((-200, -200))
-        
-        pygame.draw.circle(overlay, COLOR_YELLOW, (200, 200), 5)
-        
-        pygame.draw.line(
-                overlay, COLOR_CYAN,
-                rebase(portalStart), rebase(portalEnd),
-            )
-            
-        pygame.draw.line(
-                overlay, COLOR_CYAN,
-                (200, 200), rebase(portalStart),
-            )
-            
-        pygame.draw.line(
-                overlay, COLOR_CYAN,
-                (200, 200), rebase(portalEnd),
-            )
-            
-        pygame.draw.line(
-                overlay, COLOR_BLUE,
-                (200, 200),
-                rebase(
-                        (
-                            viewconeLeftNormal[0] * 100,
-                            viewconeLeftNormal[1] * 100
-                        )
-                    ),
-            )
+        # The (viewPos, viewTarget) that the last result was built for.
+        self.viewKey = None
+        
+        # Maps visleaves to their last shroudmaps.
+        self.shroudmaps = {}
+        
+        # Maps visleaves to the cone keys (see viewcone_key()) that their 
+        # last shroudmaps were filled with.
+        self.coneKeys = {}
+        
+    def invalidate_leaves(self, leaves):
+        ''' Forgets the shroudmaps of the given leaves, and the last result 
+        as a whole, but keeps the shroudmaps of every other leaf for reuse. 
+        Must be called for every leaf that was removed or changed whenever 
+        the BSP tree is edited in place. 
+        
+        '''
+        
+        self.viewKey = None
+        
+        for leaf in leaves:
+            self.shroudmaps.pop(leaf, None)
+            self.coneKeys.pop(leaf, None)
             
-        pygame.draw.line(
-                overlay, COLOR_MAGENTA,
-                (200, 200),
-                rebase(
-                        (
-                            viewconeRightNormal[0] * 100,
-                            viewconeRightNormal[1] * 100,
-                        )
-                    ),
-            )
             
-    # return (
-        # (dot(viewconeLeftNormal, portalStart) < 0 and
-            # dot(viewconeRightNormal, portalStart) > 0)
-        # or (dot(viewconeLeftNormal, portalEnd) < 0 and
-            # dot(viewconeRightNormal, portalEnd) > 0)
-    # )
-    
-    assert False
-    
-    # if portal.orientation == BSPNode.Orientation.VERTI:
-        # if viewpoint[0] < portal.start[0]:
-            # return (
-                # dot(viewconeLeftNormal, portalEnd) < 0 and
-                # dot(viewconeRightNormal, portalStart) > 0
-            # )
-        # elif viewpoint[0] >= portal.start[0]:
-            # return (
-                # dot(viewconeLeftNormal, portalStart) < 0 and
-                # dot(viewconeRightNormal, portalEnd) > 0
-            # )
-            
-    # elif portal.orientation == BSPNode.Orientation.HORIZ:
-        # if viewpoint[1] < portal.start[1]:
-            # return (
-                # dot(viewconeLeftNormal, portalStart) < 0 and
-                # dot(viewconeRightNormal, portalEnd) > 0
-            # )
-        # elif viewpoint[1] >= portal.start[1]:
-            # return (
-                # dot(viewconeLeftNormal, portalEnd) < 0 and
-                # dot(viewconeRightNormal, portalStart) > 0
-            # )
-            
-    # else:
-        # assert False
-        
-        
-def restrict_viewcone(portal, viewconeLeft, viewconeRight):
-    """ Returns a new set of viewcone line segments that are restricted to fit 
-    through the given portal. If the viewcone already fits through the given 
-    portal, a set of equivalent viewcone line segments are returned.
-    
-    Assumes that the viewcone line segments are based with respect to the 
-    absolute coordinate system.
-    
-    """
+# Cache of the last result of build_shroud().
+_shroudmapCache = ShroudmapCache()
+
+
+def viewcone_key(size, viewconeLeft, viewconeRight):
+    """ Returns a key that is equal for any two rebased viewcones that fill a 
+    surface of the given size in the same way. Viewcones that cover the 
+    whole surface all share the same key, no matter where they come from.
     
-    # Get the viewcone endpoints.
-    viewconeLeftStart, viewconeLeftEnd = viewconeLeft
-    viewconeRightStart, viewconeRightEnd = viewconeRight
+    Every other viewcone is its own key, float coordinates and all. Rounding 
+    them would let nearby viewpoints share shroudmaps, but a reused 
+    shroudmap could then differ from the one that its leaf would be filled 
+    with, and what is drawn would depend on where the viewer came from.
     
-    # The left and right line segments must originate from the same point.
-    assert viewconeLeftStart == viewconeRightStart
+    """
     
-    intersectLeft = intersect_line_ray(
-            (portal.start, portal.end),
-            viewconeLeft,
-        )
-        
-    if intersectLeft is None:
-        if portal.orientation == BSPNode.Orientation.VERTI:
-            if viewconeLeftStart[0] < portal.start[0]:
-                newViewconeLeft = (viewconeLeftStart, portal.start)
-            elif viewconeLeftStart[0] >= portal.start[0]:
-                newViewconeLeft = (viewconeLeftStart, portal.end)
-                
-        elif portal.orientation == BSPNode.Orientation.HORIZ:
-            if viewconeLeftStart[1] < portal.start[1]:
-                newViewconeLeft = (viewconeLeftStart, portal.end)
-            elif viewconeLeftStart[1] >= portal.start[1]:
-                newViewconeLeft = (viewconeLeftStart, portal.start)
-                
-        else:
-            assert False    # Invalid orientation.
-            
+    if viewcone_covers_surface(size, viewconeLeft, viewconeRight):
+        return 'full'
     else:
-        newViewconeLeft = (
-            viewconeLeftStart,
-            (
-                min(max(intersectLeft[0], portal.start[0]), portal.end[0]),
-                min(max(intersectLeft[1], portal.start[1]), portal.end[1]),
-            ),
-        )
+        return (viewconeLeft, viewconeRight)
         
-    intersectRight = intersect_line_ray(
-            (portal.start, portal.end),
-            viewconeRight,
-        )
         
-    if intersectRight is None:
-        if portal.orientation == BSPNode.Orientation.VERTI:
-            if viewconeRightStart[0] < portal.start[0]:
-                newViewconeRight = (viewconeRightStart, portal.end)
-            elif viewconeRightStart[0] >= portal.start[0]:
-                newViewconeRight = (viewconeRightStart, portal.start)
-                
-        elif portal.orientation == BSPNode.Orientation.HORIZ:
-            if viewconeRightStart[1] < portal.start[1]:
-                newViewconeRight = (viewconeRightStart, portal.start)
-            elif viewconeRightStart[1] >= portal.start[1]:
-                newViewconeRight = (viewconeRightStart, portal.end)
-                
-        else:
-            assert False    # Invalid orientation.
-            
-    else:
-        newViewconeRight = (
-            viewconeRightStart,
-            (
-                min(max(intersectRight[0], portal.start[0]), portal.end[0]),
-                min(max(intersectRight[1], portal.start[1]), portal.end[1]),
-            ),
+def get_cone_keys(visleafViewconesDict):
+    """ Takes a dictionary that maps visleaves to lists of rebased viewcones, 
+    and returns a dictionary that maps the same visleaves to tuples of the 
+    keys of their viewcones (see viewcone_key()). A leaf is filled the same 
+    way by any two lists of viewcones with the same keys.
+    
+    """
+    
+    coneKeys = {}
+    
+    for visleaf, visleafViewcones in visleafViewconesDict.iteritems():
+        size = visleaf.get_size()
+        
+        coneKeys[visleaf] = tuple(
+            viewcone_key(size, *visleafViewcone)
+            for visleafViewcone in visleafViewcones
         )
         
-    return newViewconeLeft, newViewconeRight
+    return coneKeys
     
     
 def build_shroud(viewPos, viewTarget):
@@ -519,116 +426,503 @@ def build_shroud(viewPos, viewTarget):
     shroudmap for all leaves visible from that target position and angle, and 
     returns a dictionary that maps visible leaves to their shroudmaps.
     
-    """
+    The shroudmaps come from a pool and are recycled or reused by the next 
+    call, so neither the dictionary nor the shroudmaps may be modified or held 
+    on to across calls.
     
-    # Calculate the viewing vector.
-    viewVector = (viewTarget[1] - viewPos[1], viewTarget[0] - viewPos[0])
+    """
     
-    # Determine the viewcone line segment boundaries.
+    # Nothing needs to be recalculated if the view hasn't changed.
+    viewKey = (viewPos, viewTarget)
+    if viewKey == _shroudmapCache.viewKey:
+        _shroudmapCache.frameHits += 1
+        return _shroudmapCache.shroudmaps
+        
+    # Find the visible leaves, along with the viewcones that reach them.
+    visleafViewconesDict = _visEngine.get_viewcones(viewPos, viewTarget)
     
-    halfFOV = FOV * 0.5
+    # Work out which leaves are filled the same way as in the last call, and 
+    # hold on to their shroudmaps.
+    coneKeys = get_cone_keys(visleafViewconesDict)
+    shroudmapDict = {}
     
-    viewAngle = math.atan2(viewVector[1], viewVector[0]) % (2 * math.pi)
+    for visleaf in visleafViewconesDict:
+        if coneKeys[visleaf] == _shroudmapCache.coneKeys.get(visleaf):
+            shroudmapDict[visleaf] = _shroudmapCache.shroudmaps[visleaf]
+            
+    _shroudmapCache.leafReuses += len(shroudmapDict)
     
-    viewconeLeftAngle = viewAngle + halfFOV
-    viewconeRightAngle = viewAngle - halfFOV
+    # Recycle the last call's shroudmaps, except for the ones we're reusing.
+    _shroudmapPool.release_all(keep=shroudmapDict.values())
     
-    viewconeLeft = (
-        viewPos,
-        (
-            math.sin(viewconeLeftAngle) + viewPos[0],
-            math.cos(viewconeLeftAngle) + viewPos[1],
-        ),
-    )
+    # Fill the shroudmaps of every leaf whose viewcones have changed.
+    for visleaf, visleafViewcones in visleafViewconesDict.iteritems():
+        if visleaf in shroudmapDict:
+            continue
+            
+        shroudmap = _shroudmapPool.acquire(visleaf.get_size())
+        shroudmapDict[visleaf] = shroudmap
+        
+        # Fill the surface with white between the viewcone vectors.
+        for visleafViewconeLeft, visleafViewconeRight in visleafViewcones:
+            _fillShroudmap(
+                    shroudmap,
+                    visleafViewconeLeft, visleafViewconeRight,
+                )
+                
+        _shroudmapCache.leafFills += 1
+        
+    _shroudmapCache.viewKey = viewKey
+    _shroudmapCache.shroudmaps = shroudmapDict
+    _shroudmapCache.coneKeys = coneKeys
     
-    viewconeRight = (
-        viewPos,
-        (
-            math.sin(viewconeRightAngle) + viewPos[0],
-            math.cos(viewconeRightAngle) + viewPos[1],
-        ),
-    )
+    return shroudmapDict
     
-    # Determine player visleaf.
-    playerLeaf = _bspTree.leaf_from_coords(*viewPos)
     
-    shroudmapDict = {}
+class ScreenMask(object):
+    """ A single screen-sized 8-bit mask of everything that the player can 
+    see, used instead of per-leaf shroudmaps in the 'mask' composite mode. 
+    Pixels are set to MASK_VISIBLE where they can be seen and to MASK_HIDDEN 
+    everywhere else, and the palette maps those to white and black, so the 
+    whole view can be composited onto the screen in one pass (see 
+    .composite()).
     
-    # A set of all portals that we have already processed.
-    alreadyProcessedPortals = set()
+    The mask surface is updated in place, so other systems can share it. 
+    Only the leaves whose viewcones changed since the last update are 
+    rasterized again.
     
-    visleafStack = [(playerLeaf, viewconeLeft, viewconeRight)]
+    """
     
-    while visleafStack:
-        visleaf, viewconeLeft, viewconeRight = visleafStack.pop()
+    def __init__(self, size):
+        self.surface = pygame.Surface(size, 0, 8)
+        self.surface.set_palette([COLOR_BLACK, COLOR_WHITE])
+        
+        self.invalidate()
+        
+        # Statistics.
+        self.frameHits = 0
+        self.leafReuses = 0
+        self.leafFills = 0
+        
+    def __str__(self):
+        return (
+            "<ScreenMask: {} frames reused; {} leaves reused, "
+            "{} filled>".format(
+                self.frameHits, self.leafReuses, self.leafFills,
+            )
+        )
         
-        if visleaf not in shroudmapDict:
-            shroudmap = pygame.Surface(
-                    (visleaf.get_width(), visleaf.get_height())
+    def invalidate(self):
+        ''' Clears the mask, so that the next .update() call rasterizes every 
+        visible leaf. Must be called whenever the BSP tree changes.
+        
+        '''
+        
+        self.surface.fill(MASK_HIDDEN)
+        
+        # The (viewPos, viewTarget) that the mask was last updated for.
+        self.viewKey = None
+        
+        # Maps the visleaves in the mask to their cone keys (see 
+        # get_cone_keys()).
+        self.coneKeys = {}
+        
+    def invalidate_leaves(self, leaves):
+        ''' Hides the given leaves in the mask, so that the next .update() 
+        call rasterizes them again if they are visible. Must be called for 
+        every leaf that was removed or changed whenever the BSP tree is 
+        edited in place. 
+        
+        '''
+        
+        self.viewKey = None
+        
+        for leaf in leaves:
+            if self.coneKeys.pop(leaf, None) is not None:
+                rect = pygame.Rect(leaf.get_top_left(), leaf.get_size())
+                self.surface.fill(MASK_HIDDEN, rect)
+                
+    def update(self, viewPos, viewTarget):
+        ''' Takes a viewing position and a view target position, and updates 
+        the mask to show what is visible from there. Returns a dictionary 
+        that maps visible leaves to their cone keys (see get_cone_keys()), 
+        which must not be modified.
+        
+        '''
+        
+        # Nothing needs to be recalculated if the view hasn't changed.
+        viewKey = (viewPos, viewTarget)
+        if viewKey == self.viewKey:
+            self.frameHits += 1
+            return self.coneKeys
+            
+        visleafViewconesDict = _visEngine.get_viewcones(viewPos, viewTarget)
+        
+        coneKeys = get_cone_keys(visleafViewconesDict)
+        
+        # Hide the leaves that are no longer visible, or that are about to be 
+        # filled again.
+        for visleaf, visleafConeKeys in self.coneKeys.iteritems():
+            if coneKeys.get(visleaf) != visleafConeKeys:
+                rect = pygame.Rect(visleaf.get_top_left(), visleaf.get_size())
+                self.surface.fill(MASK_HIDDEN, rect)
+                
+        # Fill the leaves whose viewcones have changed.
+        for visleaf, visleafViewcones in visleafViewconesDict.iteritems():
+            if coneKeys[visleaf] == self.coneKeys.get(visleaf):
+                self.leafReuses += 1
+                continue
+                
+            left, top = visleaf.get_top_left()
+            
+            for visleafViewconeLeft, visleafViewconeRight in visleafViewcones:
+                for x, y, width, height in iter_viewcone_spans(
+                        visleaf.get_size(),
+                        visleafViewconeLeft, visleafViewconeRight):
+                    rect = pygame.Rect(x + left, y + top, width, height)
+                    self.surface.fill(MASK_VISIBLE, rect)
+                    
+            self.leafFills += 1
+            
+        self.viewKey = viewKey
+        self.coneKeys = coneKeys
+        
+        return coneKeys
+        
+    def composite(self, surface, rect):
+        ''' Blacks out every pixel of the given surface within the given 
+        rectangle that isn't visible according to the mask. 
+        
+        With NumPy, the surface's pixels are multiplied by the mask's pixels 
+        (which are 0 or 1) in place. Otherwise, the mask is blitted onto the 
+        surface keeping the minimum of both, which is much slower since 
+        Pygame has to convert the 8-bit mask as it goes.
+        
+        '''
+        
+        rect = rect.clip(surface.get_rect()).clip(self.surface.get_rect())
+        
+        if numpy is not None and surface.get_bytesize() != 3:
+            pixels = pygame.surfarray.pixels2d(surface)
+            mask = pygame.surfarray.pixels2d(self.surface)
+            
+            region = (
+                slice(rect.left, rect.right),
+                slice(rect.top, rect.bottom),
+            )
+            
+            numpy.multiply(
+                    pixels[region], mask[region],
+                    out=pixels[region], casting='unsafe',
                 )
-            shroudmap.fill(COLOR_BLACK)
-            shroudmap.set_colorkey(COLOR_WHITE)
-            shroudmapDict[visleaf] = shroudmap
+                
+            # Release the surface locks.
+            del pixels
+            del mask
             
         else:
-            shroudmap = shroudmapDict[visleaf]
+            surface.blit(self.surface, rect, rect, pygame.BLEND_RGB_MIN)
             
-        leafcoords_from_abscoords = new_coord_rebaser(visleaf.get_top_left())
+            
+# The screen mask, if running in the 'mask' composite mode.
+_screenMask = None
+
+
+# The frame profiler, if profiling is turned on.
+_profiler = None
+
+
+def install_profiler(profiler):
+    """ Instruments the runtime with the given FrameProfiler. Must be called 
+    after the VisibilityEngine, the shroud backend and the screen mask have 
+    been set up.
+    
+    The instrumented functions are replaced by timing and counting wrappers, 
+    so none of this costs anything unless profiling is turned on.
+    
+    """
+    
+    global _profiler
+    global build_shroud, _fillShroudmap, iter_viewcone_spans
+    
+    _profiler = profiler
+    
+    build_shroud = profiler.timed('build_shroud', build_shroud)
+    _fillShroudmap = profiler.timed('fill', _fillShroudmap)
+    
+    _visEngine.get_viewcones = profiler.timed(
+            'traverse', _visEngine.get_viewcones,
+        )
         
-        # Rebase the viewcone vectors with respect to the current visleaf.
+    if _screenMask is not None:
+        _screenMask.update = profiler.timed('mask update', _screenMask.update)
         
-        visleafViewconeLeft = (
-            leafcoords_from_abscoords(viewconeLeft[0]),
-            leafcoords_from_abscoords(viewconeLeft[1]),
-        )
+    spansFunc = iter_viewcone_spans
+    
+    def count_viewcone_spans(size, viewconeLeft, viewconeRight):
+        for rect in spansFunc(size, viewconeLeft, viewconeRight):
+            profiler.count('spans filled')
+            profiler.count('pixels filled', rect[2] * rect[3])
+            yield rect
+            
+    iter_viewcone_spans = count_viewcone_spans
+    
+    profiler.watch('leaf visits', lambda: _visEngine.leafVisits)
+    profiler.watch('portal tests', lambda: _visEngine.portalTests)
+    profiler.watch('PVS culls', lambda: _visEngine.culledPortalTests)
+    
+    if _screenMask is not None:
+        stats = _screenMask
+    else:
+        stats = _shroudmapCache
         
-        visleafViewconeRight = (
-            leafcoords_from_abscoords(viewconeRight[0]),
-            leafcoords_from_abscoords(viewconeRight[1]),
-        )
+    profiler.watch('leaves filled', lambda: stats.leafFills)
+    profiler.watch('leaves reused', lambda: stats.leafReuses)
+    
+    
+class MapReloader(object):
+    """ Watches a BSP file for changes. When the file changes, its new 
+    version is parsed on a background thread, so that the frame loop keeps 
+    running while a large map is being reloaded. 
+    
+    """
+    
+    def __init__(self, path, interval=0.5):
+        self.path = path
         
-        # Fill the surface with white between the viewcone vectors.
-        fill_surface_within_viewcone(
-                shroudmap,
-                visleafViewconeLeft, visleafViewconeRight,
+        # How often the file is checked for changes, in seconds.
+        self.interval = interval
+        
+        self._fileKey = self._get_file_key()
+        self._checkTime = time.time()
+        
+        self._thread = None
+        self._result = None
+        
+        # Statistics.
+        self.reloads = 0
+        self.failures = 0
+        
+    def __str__(self):
+        return "<MapReloader: {} reloads, {} failed>".format(
+                self.reloads, self.failures,
             )
             
-        # Test portals for visibility.
-        for portal in visleaf.portals:
-            if (portal_within_viewcone(portal, viewconeLeft, viewconeRight)
-                    and portal not in alreadyProcessedPortals):
-                    
-                # Add the portal to the set of already-processed portals.
-                alreadyProcessedPortals.add(portal)
+    def _get_file_key(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+            
+        return (stat.st_mtime, stat.st_size)
+        
+    def _parse(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = f.read()
                 
-                # Calculate the new view frustum endpoints.
-                newViewconeLeft, newViewconeRight = restrict_viewcone(
-                        portal,
-                        viewconeLeft, viewconeRight,
-                    )
-                    
-                visleafStack.append(
-                        (
-                            portal.get_other(visleaf),
-                            newViewconeLeft, newViewconeRight,
-                        )
+            self._result = (BSPTree.from_vdf_fast(data), None)
+            
+        except Exception as e:
+            self._result = (None, e)
+            
+    def poll(self):
+        ''' Returns the newly parsed BSPTree if the file has changed and 
+        finished parsing since the last call, and None otherwise. Never 
+        waits for the file to be parsed. 
+        
+        '''
+        
+        if self._thread is not None:
+            if self._thread.is_alive():
+                return None
+                
+            self._thread = None
+            
+            bspTree, error = self._result
+            self._result = None
+            
+            if error is not None:
+                # Most likely, the file was caught halfway through being 
+                # written. It will be parsed again when it changes next.
+                print >> sys.stderr, "Couldn't reload {}: {}".format(
+                        self.path, error,
                     )
-                    
-    return shroudmapDict
+                self.failures += 1
+                
+                return None
+                
+            self.reloads += 1
+            
+            return bspTree
+            
+        now = time.time()
+        
+        if now - self._checkTime < self.interval:
+            return None
+            
+        self._checkTime = now
+        
+        fileKey = self._get_file_key()
+        
+        if fileKey is None or fileKey == self._fileKey:
+            return None
+            
+        self._fileKey = fileKey
+        
+        self._thread = threading.Thread(target=self._parse)
+        self._thread.daemon = True
+        self._thread.start()
+        
+        return None
+        
+        
+def load_pvs(bspTree, path):
+    """ Loads the visibility matrix in the given JSON file into the given 
+    BSP tree (see BSPTree.load_visibility_matrix()). The matrix is a list of 
+    rows of booleans, indexed by the leaf IDs that the tree's visleaves were 
+    saved with. Raises ValueError if it doesn't cover every visleaf.
+    
+    """
+    
+    with open(path, 'r') as f:
+        visMatrix = json.load(f)
+        
+    numLeafIDs = max(
+            [visleaf.leafID for visleaf in bspTree.iter_visleaves()] or [-1]
+        ) + 1
+        
+    if (not isinstance(visMatrix, list)
+            or len(visMatrix) < numLeafIDs
+            or not all(
+                isinstance(row, list) and len(row) >= numLeafIDs
+                for row in visMatrix[:numLeafIDs]
+            )):
+        raise ValueError(
+                "{} isn't a visibility matrix for {} visleaves".format(
+                    path, numLeafIDs,
+                )
+            )
+            
+    bspTree.load_visibility_matrix(visMatrix)
+    
+    
+def load_world(bspTree, chunkSize):
+    """ Splits the given BSP tree into a world of chunkSize by chunkSize 
+    chunks, and returns the BSPWorld. 
     
+    """
+    
+    chunks = split_tree_into_chunks(bspTree, chunkSize, chunkSize)
     
+    return BSPWorld(
+            chunkSize, chunkSize,
+            lambda chunkX, chunkY: chunks.get((chunkX, chunkY)),
+        )
+        
+        
 def main():
+    parser = argparse.ArgumentParser(description="Project VIS Main Runtime")
+    parser.add_argument(
+            'levelName',
+            help="path to the level, without the '-bsp.vdf' suffix",
+        )
+    parser.add_argument(
+            '--shroud-backend',
+            choices=sorted(SHROUD_BACKENDS),
+            default='scanline',
+            help="how shroudmaps are filled (default: scanline)",
+        )
+    parser.add_argument(
+            '--composite',
+            choices=('shroudmaps', 'mask'),
+            default='shroudmaps',
+            help="draw visibility with a shroudmap per visible leaf, or with "
+                "a single screen-sized mask (default: shroudmaps)",
+        )
+    parser.add_argument(
+            '--chunk-size',
+            type=int,
+            metavar='SIZE',
+            help="split the level into a world of SIZE by SIZE chunks, and "
+                "only load the chunks around the player",
+        )
+    parser.add_argument(
+            '--profile',
+            action='store_true',
+            help="time each stage of every frame, and show the last frame's "
+                "timings and counters on screen (toggle with F3)",
+        )
+    parser.add_argument(
+            '--profile-dump',
+            metavar='PATH',
+            help="write the profile of every frame to PATH on exit, as JSON "
+                "if PATH ends with '.json' and as CSV otherwise (implies "
+                "--profile)",
+        )
+    parser.add_argument(
+            '--record-path',
+            metavar='PATH',
+            help="record the camera's position and view target on every "
+                "frame, and write them to PATH on exit as a camera path for "
+                "replaybench.py",
+        )
+    parser.add_argument(
+            '--stats',
+            action='store_true',
+            help="print cache and visibility statistics on exit (also "
+                "done when profiling)",
+        )
+    parser.add_argument(
+            '--pvs',
+            metavar='PATH',
+            help="cull portals against the visibility matrix in PATH, a JSON "
+                "list of rows indexed by visleaf ID (dropped if the level is "
+                "reloaded)",
+        )
+    parser.add_argument(
+            '--no-reload',
+            action='store_true',
+            help="don't reload the level when its file changes",
+        )
+    args = parser.parse_args()
+    
+    try:
+        set_shroud_backend(args.shroud_backend)
+    except ValueError as e:
+        parser.error(str(e))
+        
     # Load the relevant BSP file.
-    levelName = sys.argv[1]
-    bspFilePath = "{}-bsp.vdf".format(levelName)
+    bspFilePath = "{}-bsp.vdf".format(args.levelName)
     
     with open(bspFilePath, 'r') as f:
         data = f.read()
         
     # BSP setup
-    global _bspTree
-    _bspTree = BSPTree.from_vdf(data)
-    _bspTree.generate_portals()
+    bspTree = BSPTree.from_vdf_fast(data)
+    bspTree.generate_portals()
+    
+    if args.pvs:
+        if args.chunk_size:
+            parser.error("--pvs can't be used with --chunk-size")
+            
+        try:
+            load_pvs(bspTree, args.pvs)
+        except (IOError, ValueError) as e:
+            parser.error("couldn't load the PVS: {}".format(e))
+            
+    if args.chunk_size:
+        world = load_world(bspTree, args.chunk_size)
+    else:
+        world = None
+        
+    if args.no_reload:
+        reloader = None
+    else:
+        reloader = MapReloader(bspFilePath)
+        
+    global _visEngine
+    _visEngine = VisibilityEngine(world or bspTree, FOV)
     
     os.environ['SDL_VIDEO_WINDOW_POS'] = '{},{}'.format(100, 100)
     
@@ -642,18 +936,77 @@ def main():
     overlay = pygame.Surface((WIDTH, HEIGHT))
     overlay.set_colorkey(COLOR_BLACK)
     
+    if args.composite == 'mask':
+        global _screenMask
+        _screenMask = ScreenMask((WIDTH, HEIGHT))
+        
+    if args.profile or args.profile_dump:
+        # The overlay only shows the last frame, so every frame only needs 
+        # to be kept if they are going to be dumped.
+        if args.profile_dump:
+            install_profiler(FrameProfiler())
+        else:
+            install_profiler(FrameProfiler(maxFrames=1))
+            
+        hudFont = pygame.font.SysFont('monospace', 14)
+        
+    # Whether the profiler's overlay is shown, and where it was drawn.
+    showHUD = _profiler is not None
+    drawnHUDRect = None
+    
     playerPos = (100, 100)
     
+    # The (viewPos, viewTarget) pair of every frame, if recording.
+    cameraPath = [] if args.record_path else None
+    
+    # The cone keys (see viewcone_key()) of the leaves that were drawn as 
+    # visible on the last frame, and where the player was drawn.
+    drawnConeKeys = {}
+    drawnPlayerRect = None
+    
+    # The whole screen needs to be drawn on the first frame.
+    fullRedraw = True
+    
     while 1:
+        if _profiler is not None:
+            _profiler.begin_frame()
+            
         events = pygame.event.get()
         for event in events:
             if event.type == pygame.QUIT:
+                if args.stats or _profiler is not None:
+                    if _screenMask is not None:
+                        print _screenMask
+                    else:
+                        print _shroudmapPool
+                        print _shroudmapCache
+                        
+                    print _visEngine
+                    
+                    if world is not None:
+                        print world
+                        
+                    if reloader is not None:
+                        print reloader
+                        
+                if args.profile_dump:
+                    _profiler.dump(args.profile_dump)
+                    
+                if cameraPath is not None:
+                    with open(args.record_path, 'w') as f:
+                        json.dump(cameraPath, f)
+                        
                 return 0
                 
-        screen.fill(COLOR_BLACK)
-        
-        overlay.fill(COLOR_BLACK)
-        
+            elif event.type == pygame.VIDEOEXPOSE:
+                # The window's contents have been lost.
+                fullRedraw = True
+                
+            elif (event.type == pygame.KEYDOWN and event.key == pygame.K_F3
+                    and _profiler is not None):
+                showHUD = not showHUD
+                fullRedraw = True
+                
         pressedKeys = pygame.key.get_pressed()
         
         if pressedKeys[pygame.K_w]:
@@ -665,30 +1018,154 @@ def main():
         if pressedKeys[pygame.K_d]:
             playerPos = (playerPos[0] + 5, playerPos[1])
             
+        if _profiler is not None:
+            _profiler.lap('input')
+            
+        newTree = reloader.poll() if reloader is not None else None
+        
+        if newTree is not None:
+            if world is None and newTree.get_bounds() == bspTree.get_bounds():
+                # Only the parts of the tree that changed are replaced, and 
+                # only their leaves need to be drawn again.
+                changedLeaves = set.union(*bspTree.graft_changes(newTree))
+                
+                if _screenMask is not None:
+                    _screenMask.invalidate_leaves(changedLeaves)
+                else:
+                    _shroudmapCache.invalidate_leaves(changedLeaves)
+                    
+            else:
+                # Resized levels and chunked worlds are rebuilt from scratch.
+                bspTree = newTree
+                bspTree.generate_portals()
+                
+                if args.chunk_size:
+                    world = load_world(bspTree, args.chunk_size)
+                    
+                # The engine is kept, since the profiler may have wrapped it.
+                _visEngine.bspTree = world or bspTree
+                
+                if _screenMask is not None:
+                    _screenMask.invalidate()
+                else:
+                    _shroudmapCache.invalidate()
+                    
+            fullRedraw = True
+            
+        if world is not None:
+            world.update_viewers([playerPos])
+            
         # Pre-build shroudmaps and mark all visible leaves in the process.
         viewTarget = pygame.mouse.get_pos()
-        shroudmapDict = build_shroud(playerPos, viewTarget)
         
+        if cameraPath is not None:
+            cameraPath.append((playerPos, viewTarget))
+        
+        portalTests = _visEngine.portalTests
+        culledPortalTests = _visEngine.culledPortalTests
+        
+        if _screenMask is not None:
+            coneKeys = _screenMask.update(playerPos, viewTarget)
+            
+        else:
+            shroudmapDict = build_shroud(playerPos, viewTarget)
+            coneKeys = _shroudmapCache.coneKeys
+            
+        # Show how much work the PVS saved, if the view was recalculated.
+        if (portalTests != _visEngine.portalTests
+                or culledPortalTests != _visEngine.culledPortalTests):
+            pygame.display.set_caption(
+                    "Project VIS Main Runtime ({} portal tests, {} avoided by "
+                    "the PVS)".format(
+                        _visEngine.portalTests - portalTests,
+                        _visEngine.culledPortalTests - culledPortalTests,
+                    )
+                )
+                
+        if _profiler is not None:
+            _profiler.lap('visibility')
+            
         visleafRectDict = {
             visleaf : pygame.Rect(visleaf.get_top_left(), visleaf.get_size())
-            for visleaf in shroudmapDict
+            for visleaf in coneKeys
         }
         
-        # Draw texmaps for each marked leaf.
-        for visleaf in shroudmapDict.iterkeys():
-            pygame.draw.rect(screen, COLOR_WHITE, visleafRectDict[visleaf])
-            
-        # Draw entities in each marked leaf.
-        pygame.draw.circle(screen, COLOR_GREEN, playerPos, 10)
-        
-        # Draw the lightmap overlay for each marked leaf.
-        pass
+        playerRect = pygame.Rect(0, 0, 21, 21)
+        playerRect.center = playerPos
         
-        # Draw shroudmaps over each marked leaf.
-        for visleaf, shroudmap in shroudmapDict.iteritems():
-            screen.blit(shroudmap, visleafRectDict[visleaf])
+        if DEBUG_DRAW_VIEWCONE or DEBUG_DRAW_PORTALS:
+            # Debug drawings cross leaves that may not otherwise be redrawn.
+            fullRedraw = True
+            
+        if fullRedraw:
+            dirtyRects = [screen.get_rect()]
+            
+        else:
+            dirtyRects = []
+            
+            # A leaf looks the same as on the last frame if it is still 
+            # visible and it was filled with the same viewcones.
+            for visleaf in set(drawnConeKeys) | set(coneKeys):
+                if drawnConeKeys.get(visleaf) != coneKeys.get(visleaf):
+                    dirtyRects.append(
+                            pygame.Rect(
+                                visleaf.get_top_left(), visleaf.get_size(),
+                            )
+                        )
+                        
+            if playerRect != drawnPlayerRect:
+                dirtyRects.append(drawnPlayerRect)
+                dirtyRects.append(playerRect)
+                
+            # The overlay changes every frame, so whatever it covered has to 
+            # be drawn again before it is drawn on top.
+            if showHUD and drawnHUDRect is not None:
+                dirtyRects.append(drawnHUDRect)
+                
+        for dirtyRect in dirtyRects:
+            # Only draw within the region that is being redrawn.
+            screen.set_clip(dirtyRect)
+            
+            screen.fill(COLOR_BLACK)
+            
+            # Only the leaves that overlap the region need to be drawn.
+            dirtyVisleaves = [
+                visleaf for visleaf in coneKeys
+                if visleafRectDict[visleaf].colliderect(dirtyRect)
+            ]
+            
+            # Draw texmaps for each marked leaf.
+            for visleaf in dirtyVisleaves:
+                pygame.draw.rect(screen, COLOR_WHITE, visleafRectDict[visleaf])
+                
+            # Draw entities in each marked leaf.
+            pygame.draw.circle(screen, COLOR_GREEN, playerPos, 10)
+            
+            # Draw the lightmap overlay for each marked leaf.
+            pass
             
-        if 0:   # DEBUG
+            if _screenMask is not None:
+                # Black out everything that isn't visible, in one go.
+                _screenMask.composite(screen, dirtyRect)
+                
+            else:
+                # Draw shroudmaps over each marked leaf.
+                for visleaf in dirtyVisleaves:
+                    screen.blit(
+                            shroudmapDict[visleaf], visleafRectDict[visleaf],
+                        )
+                        
+            if DEBUG_DRAW_LEAF_OUTLINES:
+                for visleaf in dirtyVisleaves:
+                    pygame.draw.rect(
+                            screen, COLOR_RED, visleafRectDict[visleaf], 1,
+                        )
+                        
+            screen.blit(overlay, dirtyRect, dirtyRect)
+            
+        screen.set_clip(None)
+        
+        if DEBUG_DRAW_VIEWCONE:
             viewPos = playerPos
             
             viewVector = (viewTarget[1] - viewPos[1], viewTarget[0] - viewPos[0])
@@ -720,23 +1197,40 @@ def main():
             pygame.draw.line(screen, COLOR_RED, viewPos, viewconeLeftVector[1])
             pygame.draw.line(screen, COLOR_RED, viewPos, viewconeRightVector[1])
             
-        if 1:   # DEBUG
-            for visleaf in shroudmapDict:
-                rect = pygame.Rect(visleaf.get_top_left(), visleaf.get_size())
-                pygame.draw.rect(screen, COLOR_RED, rect, 1)
-                
-        if 0:   # DEBUG
-            for portal in _bspTree.portals:
+        if DEBUG_DRAW_PORTALS:
+            for portal in _visEngine.bspTree.portals:
                 pygame.draw.circle(screen, COLOR_YELLOW, portal.start, 5)
                 
-            for portal in _bspTree.portals:
+            for portal in _visEngine.bspTree.portals:
                 pygame.draw.circle(screen, COLOR_RED, portal.end, 3)
                 
-        screen.blit(overlay, pygame.Rect(0, 0, WIDTH, HEIGHT))
-        pygame.display.update()
+        if _profiler is not None:
+            _profiler.count('dirty rects', len(dirtyRects))
+            _profiler.count(
+                    'dirty pixels',
+                    sum(rect.width * rect.height for rect in dirtyRects),
+                )
+            _profiler.lap('draw')
+            
+            if showHUD:
+                drawnHUDRect = _profiler.draw_hud(screen, hudFont)
+                dirtyRects.append(drawnHUDRect)
+                _profiler.lap('hud')
+                
+        pygame.display.update(dirtyRects)
+        
+        if _profiler is not None:
+            _profiler.lap('present')
+            
+        drawnConeKeys = coneKeys
+        drawnPlayerRect = playerRect
+        fullRedraw = False
         
         clock.tick(FRAMERATE)
         
+        if _profiler is not None:
+            _profiler.end_frame('wait')
+        
     return 0
     
     
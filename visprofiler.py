@@ -0,0 +1,232 @@
+"""
+
+visprofiler.py
+
+Optional per-frame instrumentation for vismain.py. Times the stages of each 
+frame and collects per-frame counters, so that frame time can be broken down 
+on an on-screen overlay or dumped to CSV/JSON for later analysis.
+
+Nothing in here runs unless a FrameProfiler is created: instrumented 
+functions are only wrapped by FrameProfiler.timed() when profiling is turned 
+on, so the unprofiled code paths are left exactly as they are.
+
+"""
+
+import csv
+import json
+import time
+from itertools import izip
+from collections import OrderedDict
+
+import pygame
+
+COLOR_BLACK = (0, 0, 0)
+COLOR_YELLOW = (255, 255, 0)
+
+
+class FrameProfiler(object):
+    """ Collects timings and counters for each frame.
+    
+    Each frame is divided into consecutive stages with .lap(), which records 
+    the time since the previous lap. Functions that are called during a 
+    stage can additionally be timed on their own with .timed(). Counters are 
+    either incremented directly with .count(), or sampled at the start and 
+    end of every frame with .watch().
+    
+    """
+    
+    def __init__(self, maxFrames=None):
+        # Completed frame records, as OrderedDicts of column names to values. 
+        # Only the last maxFrames records are kept, if given.
+        self.frames = []
+        self.maxFrames = maxFrames
+        
+        # Maps counter names to functions that return their current totals.
+        self._watches = OrderedDict()
+        
+        self._frameNumber = 0
+        self._record = None
+        self._frameStart = None
+        self._lapStart = None
+        self._watchStarts = None
+        
+    def watch(self, name, getter):
+        ''' Records, for every frame, how much the value returned by the 
+        given function grew during that frame.
+        
+        '''
+        
+        self._watches[name] = getter
+        
+    def begin_frame(self):
+        ''' Starts recording a new frame. '''
+        
+        self._record = OrderedDict()
+        self._record['frame'] = self._frameNumber
+        
+        self._watchStarts = [getter() for getter in self._watches.itervalues()]
+        
+        self._frameStart = self._lapStart = time.time()
+        
+    def lap(self, stage):
+        ''' Ends the current stage of the frame, and records its duration (in 
+        milliseconds) under the given name.
+        
+        '''
+        
+        now = time.time()
+        
+        self.add_time(stage, now - self._lapStart)
+        
+        self._lapStart = now
+        
+    def end_frame(self, stage='wait'):
+        ''' Ends the last stage of the frame under the given name, and stores 
+        the frame's record.
+        
+        '''
+        
+        self.lap(stage)
+        
+        record = self._record
+        
+        record['total (ms)'] = (time.time() - self._frameStart) * 1000
+        
+        for (name, getter), start in izip(
+                self._watches.iteritems(), self._watchStarts):
+            record[name] = getter() - start
+            
+        self.frames.append(record)
+        
+        if self.maxFrames is not None and len(self.frames) > self.maxFrames:
+            del self.frames[0]
+            
+        self._frameNumber += 1
+        self._record = None
+        
+    def add_time(self, stage, seconds):
+        ''' Adds the given duration to the given stage of the current frame. 
+        Does nothing between frames.
+        
+        '''
+        
+        if self._record is not None:
+            key = stage + ' (ms)'
+            self._record[key] = self._record.get(key, 0) + seconds * 1000
+            
+    def count(self, name, amount=1):
+        ''' Adds the given amount to the given counter of the current frame. 
+        Does nothing between frames.
+        
+        '''
+        
+        if self._record is not None:
+            self._record[name] = self._record.get(name, 0) + amount
+            
+    def timed(self, stage, func):
+        ''' Returns a wrapper around the given function that adds the time 
+        spent in each call to the given stage.
+        
+        '''
+        
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(stage, time.time() - start)
+                
+        return wrapper
+        
+    def get_last_frame(self):
+        ''' Returns the record of the last completed frame, or None. '''
+        
+        if self.frames:
+            return self.frames[-1]
+        else:
+            return None
+            
+    def draw_hud(self, surface, font, pos=(8, 8)):
+        ''' Draws the last completed frame's record onto the given surface as 
+        lines of text, and returns the rectangle that was drawn to.
+        
+        '''
+        
+        record = self.get_last_frame()
+        
+        if record is None:
+            return pygame.Rect(pos, (0, 0))
+            
+        lines = []
+        for name, value in record.iteritems():
+            if isinstance(value, float):
+                lines.append("{}: {:.2f}".format(name, value))
+            else:
+                lines.append("{}: {}".format(name, value))
+                
+        lineHeight = font.get_linesize()
+        
+        images = [font.render(line, False, COLOR_YELLOW) for line in lines]
+        
+        rect = pygame.Rect(
+                pos,
+                (
+                    max(image.get_width() for image in images) + 8,
+                    lineHeight * len(images) + 8,
+                ),
+            )
+            
+        surface.fill(COLOR_BLACK, rect)
+        
+        for i, image in enumerate(images):
+            surface.blit(image, (pos[0] + 4, pos[1] + 4 + i * lineHeight))
+            
+        return rect
+        
+    def get_columns(self):
+        ''' Returns the names of all columns in the frame records, in order 
+        of first appearance.
+        
+        '''
+        
+        columns = OrderedDict()
+        
+        for record in self.frames:
+            for name in record:
+                columns[name] = None
+                
+        return columns.keys()
+        
+    def dump_csv(self, path):
+        ''' Writes every frame record to the given path as CSV. Counters and 
+        stages that didn't occur during a frame are written as 0.
+        
+        '''
+        
+        columns = self.get_columns()
+        
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            
+            for record in self.frames:
+                writer.writerow([record.get(name, 0) for name in columns])
+                
+    def dump_json(self, path):
+        ''' Writes every frame record to the given path as a JSON list. '''
+        
+        with open(path, 'w') as f:
+            json.dump(self.frames, f, indent=1)
+            
+    def dump(self, path):
+        ''' Writes every frame record to the given path, as JSON if the path 
+        ends with '.json' and as CSV otherwise.
+        
+        '''
+        
+        if path.lower().endswith('.json'):
+            self.dump_json(path)
+        else:
+            self.dump_csv(path)
+            
\ No newline at end of file
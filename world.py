@@ -0,0 +1,573 @@
+"""
+
+world.py
+
+A world made of a grid of BSP tree chunks, so that large levels don't have 
+to be held in a single tree, and only the parts of the level that are near 
+the viewers have to be loaded at all.
+
+Each chunk is an independent BSPTree whose origin is the top-left corner of 
+its cell in the grid, so that every chunk's leaves and portals are already 
+in world coordinates. Whenever two neighboring chunks are both loaded, the 
+visleaves on either side of their shared edge are stitched together with 
+BSPChunkPortals. Since those are added to the leaves' own portal sets, 
+anything that walks portals, like visengine.VisibilityEngine, crosses from 
+chunk to chunk without knowing about chunks at all, so a BSPWorld can be 
+used in place of a BSPTree there. Of the rest of the BSPTree interface, a 
+world only provides get_bounds(), iter_leaves(), iter_visleaves(), 
+leaf_from_coords(), segment_collision() and portals, and it can't be used 
+with visengine.VisibilityPool, whose workers each need their own copy of a 
+single tree.
+
+Chunks can't have a PVS loaded, since a PVS only covers its own chunk and 
+would hide every other chunk from view.
+
+"""
+
+import os
+import sys
+import math
+import argparse
+
+from bsp import BSPTree, BSPNode, BSPPortal, nudge_segment_start
+
+__all__ = (
+    'BSPWorld',
+    'BSPChunkPortal',
+    'crop_tree',
+    'split_tree_into_chunks',
+    'chunk_file_loader',
+)
+
+
+class BSPChunkPortal(BSPPortal):
+    """ A portal between two visleaves in neighboring chunks. The leaves 
+    belong to different trees, so which side of each other they are on has 
+    to be worked out from their bounds alone.
+    
+    """
+    
+    @staticmethod
+    def get_neighbor_relation(leaf1, leaf2):
+        left1, top1, right1, bottom1 = leaf1.bounds
+        left2, top2, right2, bottom2 = leaf2.bounds
+        
+        if right1 == left2:
+            return 'L'
+        elif bottom1 == top2:
+            return 'T'
+        elif left1 == right2:
+            return 'R'
+        elif top1 == bottom2:
+            return 'B'
+        else:
+            assert False
+            
+            
+def iter_edge_visleaves(bspTree, side):
+    """ Returns an iterator over the visleaves of the given BSP tree that lie 
+    along the given side ('L', 'T', 'R' or 'B') of the whole tree.
+    
+    """
+    
+    # Index into the bounds of the side's coordinate.
+    index = {'L': 0, 'T': 1, 'R': 2, 'B': 3}[side]
+    
+    edge = bspTree.get_bounds()[index]
+    
+    nodeStack = [bspTree.head]
+    while nodeStack:
+        node = nodeStack.pop()
+        
+        if node.bounds[index] != edge:
+            continue
+            
+        if type(node) is BSPNode:
+            nodeStack.append(node.left)
+            nodeStack.append(node.right)
+            
+        elif not node.solid:
+            yield node
+            
+            
+def stitch_chunks(chunk1, chunk2, side):
+    """ Creates BSPChunkPortals between the visleaves along the given side 
+    ('R' or 'B') of the first chunk and the visleaves of the second chunk 
+    that touch them, and adds them to the leaves' portal sets. Returns a set 
+    of the new portals.
+    
+    """
+    
+    if side == 'R':
+        otherSide = 'L'
+        
+        # Index into the bounds of where the leaves start along the edge.
+        index = 1
+        
+    else:
+        otherSide = 'T'
+        index = 0
+        
+    visleaves1 = sorted(
+            iter_edge_visleaves(chunk1, side),
+            key=lambda visleaf: visleaf.bounds[index],
+        )
+    visleaves2 = sorted(
+            iter_edge_visleaves(chunk2, otherSide),
+            key=lambda visleaf: visleaf.bounds[index],
+        )
+        
+    portals = set()
+    
+    # Sweep along the edge, pairing up every two leaves that overlap.
+    i = j = 0
+    while i < len(visleaves1) and j < len(visleaves2):
+        visleaf1 = visleaves1[i]
+        visleaf2 = visleaves2[j]
+        
+        start = max(visleaf1.bounds[index], visleaf2.bounds[index])
+        end1 = visleaf1.bounds[index + 2]
+        end2 = visleaf2.bounds[index + 2]
+        
+        if start < min(end1, end2):
+            portal = BSPChunkPortal(visleaf1, visleaf2)
+            
+            portals.add(portal)
+            visleaf1.portals.add(portal)
+            visleaf2.portals.add(portal)
+            
+        if end1 <= end2:
+            i += 1
+        else:
+            j += 1
+            
+    return portals
+    
+    
+def crop_tree(bspTree, bounds):
+    """ Returns a new BSP tree that covers the given (left, top, right, 
+    bottom) bounds of the given BSP tree, with its origin at the top-left 
+    corner of the bounds. The new tree has the same leaves as the given 
+    tree, except that leaves that cross the bounds are cut down to fit.
+    
+    """
+    
+    left, top, right, bottom = bounds
+    
+    cropped = BSPTree(right - left, bottom - top, (left, top))
+    
+    # Pairs of elements of the given tree, and the leaves of the cropped 
+    # tree that cover the parts of them within the bounds.
+    elementStack = [(bspTree.head, cropped.head)]
+    
+    while elementStack:
+        element, leaf = elementStack.pop()
+        
+        while type(element) is BSPNode:
+            if element.orientation == BSPNode.Orientation.VERTI:
+                low, high = leaf.bounds[0], leaf.bounds[2]
+            else:
+                low, high = leaf.bounds[1], leaf.bounds[3]
+                
+            # Partitions outside the leaf only have one side to follow.
+            if element.partition <= low:
+                element = element.right
+                
+            elif element.partition >= high:
+                element = element.left
+                
+            else:
+                node = cropped.divide_leaf(
+                        leaf, element.orientation, element.partition,
+                    )
+                    
+                elementStack.append((element.left, node.left))
+                elementStack.append((element.right, node.right))
+                break
+                
+        else:
+            leaf.solid = element.solid
+            
+    return cropped
+    
+    
+def split_tree_into_chunks(bspTree, chunkWidth, chunkHeight):
+    """ Splits the given BSP tree into chunks of the given size, and returns 
+    a dictionary that maps (chunkX, chunkY) grid coordinates to chunks. 
+    Chunks along the right and bottom edges are cut short if the tree isn't 
+    a whole number of chunks across.
+    
+    """
+    
+    left, top, right, bottom = bspTree.get_bounds()
+    
+    chunks = {}
+    
+    for chunkY in xrange(top // chunkHeight, -(-bottom // chunkHeight)):
+        for chunkX in xrange(left // chunkWidth, -(-right // chunkWidth)):
+            chunkBounds = (
+                max(chunkX * chunkWidth, left),
+                max(chunkY * chunkHeight, top),
+                min((chunkX + 1) * chunkWidth, right),
+                min((chunkY + 1) * chunkHeight, bottom),
+            )
+            
+            chunks[chunkX, chunkY] = crop_tree(bspTree, chunkBounds)
+            
+    return chunks
+    
+    
+def chunk_file_loader(pathFormat):
+    """ Returns a chunk loader for BSPWorld that reads each chunk from the 
+    VDF file at pathFormat.format(x=chunkX, y=chunkY), if it exists.
+    
+    """
+    
+    def load_chunk(chunkX, chunkY):
+        path = pathFormat.format(x=chunkX, y=chunkY)
+        
+        if not os.path.exists(path):
+            return None
+            
+        with open(path, 'r') as f:
+            return BSPTree.from_vdf_fast(f.read())
+            
+    return load_chunk
+    
+    
+class BSPWorld(object):
+    """ A grid of BSP tree chunks, each chunkWidth by chunkHeight pixels, 
+    that are loaded on demand.
+    
+    Chunks are loaded by calling loader(chunkX, chunkY), which must return 
+    the BSP tree of that chunk, with its origin at (chunkX * chunkWidth, 
+    chunkY * chunkHeight), or None if there is no such chunk. Chunks along 
+    the edges of the world may be smaller than a full chunk. Portals are 
+    generated for each chunk as it is loaded.
+    
+    """
+    
+    def __init__(self, chunkWidth, chunkHeight, loader, loadRadius=1):
+        self.chunkWidth = chunkWidth
+        self.chunkHeight = chunkHeight
+        self.loader = loader
+        
+        # Chunks within this many chunks of a viewer's chunk are kept 
+        # loaded by .update_viewers().
+        self.loadRadius = loadRadius
+        
+        # Maps (chunkX, chunkY) grid coordinates to loaded chunks.
+        self.chunks = {}
+        
+        # Maps the grid coordinates of each loaded chunk to the set of 
+        # BSPChunkPortals along its edges.
+        self._seamPortals = {}
+        
+        # Statistics.
+        self.loads = 0
+        self.unloads = 0
+        
+    def __repr__(self):
+        return "BSPWorld({}, {}, {})".format(
+                self.chunkWidth, self.chunkHeight, repr(self.loader),
+            )
+            
+    def __str__(self):
+        return (
+            "<BSPWorld ({}x{} chunks): {} loaded; {} loads, {} "
+            "unloads>".format(
+                self.chunkWidth, self.chunkHeight, len(self.chunks),
+                self.loads, self.unloads,
+            )
+        )
+        
+    @property
+    def portals(self):
+        ''' The set of every portal within and between the loaded chunks. '''
+        
+        portals = set()
+        
+        for chunk in self.chunks.itervalues():
+            portals.update(chunk.portals)
+            
+        for seamPortals in self._seamPortals.itervalues():
+            portals.update(seamPortals)
+            
+        return portals
+        
+    def get_chunk_coords(self, x, y):
+        ''' Returns the grid coordinates of the chunk that the given point 
+        falls in.
+        
+        '''
+        
+        return (int(x // self.chunkWidth), int(y // self.chunkHeight))
+        
+    def load_chunk(self, chunkX, chunkY):
+        ''' Loads the chunk at the given grid coordinates, if it isn't loaded 
+        already, and stitches it to its loaded neighbors. Returns the chunk, 
+        or None if there is no such chunk.
+        
+        '''
+        
+        coords = (chunkX, chunkY)
+        
+        if coords in self.chunks:
+            return self.chunks[coords]
+            
+        chunk = self.loader(chunkX, chunkY)
+        
+        if chunk is None:
+            return None
+            
+        assert chunk.origin == (
+            chunkX * self.chunkWidth, chunkY * self.chunkHeight,
+        )
+        
+        chunk.generate_portals()
+        
+        self.chunks[coords] = chunk
+        self._seamPortals[coords] = set()
+        
+        # Stitch the chunk to each loaded neighbor, always from the left or 
+        # top chunk of the pair.
+        neighbors = (
+            ((chunkX - 1, chunkY), 'R', False),
+            ((chunkX, chunkY - 1), 'B', False),
+            ((chunkX + 1, chunkY), 'R', True),
+            ((chunkX, chunkY + 1), 'B', True),
+        )
+        
+        for neighborCoords, side, chunkFirst in neighbors:
+            neighbor = self.chunks.get(neighborCoords)
+            
+            if neighbor is None:
+                continue
+                
+            if chunkFirst:
+                portals = stitch_chunks(chunk, neighbor, side)
+            else:
+                portals = stitch_chunks(neighbor, chunk, side)
+                
+            self._seamPortals[coords].update(portals)
+            self._seamPortals[neighborCoords].update(portals)
+            
+        self.loads += 1
+        
+        return chunk
+        
+    def unload_chunk(self, chunkX, chunkY):
+        ''' Unloads the chunk at the given grid coordinates, if it is loaded, 
+        and removes the portals that lead into it from its neighbors.
+        
+        '''
+        
+        coords = (chunkX, chunkY)
+        
+        if coords not in self.chunks:
+            return
+            
+        for portal in self._seamPortals.pop(coords):
+            portal.leaf1.portals.discard(portal)
+            portal.leaf2.portals.discard(portal)
+            
+            for seamPortals in self._seamPortals.itervalues():
+                seamPortals.discard(portal)
+                
+        del self.chunks[coords]
+        
+        self.unloads += 1
+        
+    def update_viewers(self, positions):
+        ''' Loads every chunk within the load radius of any of the given 
+        viewer positions, and unloads every other chunk. Returns a (loaded, 
+        unloaded) tuple of lists of the grid coordinates of the chunks that 
+        were loaded and unloaded.
+        
+        '''
+        
+        radius = self.loadRadius
+        
+        wanted = set()
+        
+        for x, y in positions:
+            chunkX, chunkY = self.get_chunk_coords(x, y)
+            
+            for offsetY in xrange(-radius, radius + 1):
+                for offsetX in xrange(-radius, radius + 1):
+                    wanted.add((chunkX + offsetX, chunkY + offsetY))
+                    
+        unloaded = [coords for coords in self.chunks if coords not in wanted]
+        
+        for coords in unloaded:
+            self.unload_chunk(*coords)
+            
+        loaded = []
+        
+        for coords in sorted(wanted):
+            if coords not in self.chunks and self.load_chunk(*coords):
+                loaded.append(coords)
+                
+        return loaded, unloaded
+        
+    def get_bounds(self):
+        ''' Returns the (left, top, right, bottom) bounds of the loaded 
+        chunks, or (0, 0, 0, 0) if no chunks are loaded.
+        
+        '''
+        
+        if not self.chunks:
+            return (0, 0, 0, 0)
+            
+        allBounds = [chunk.get_bounds() for chunk in self.chunks.itervalues()]
+        
+        return (
+            min(bounds[0] for bounds in allBounds),
+            min(bounds[1] for bounds in allBounds),
+            max(bounds[2] for bounds in allBounds),
+            max(bounds[3] for bounds in allBounds),
+        )
+        
+    def iter_leaves(self):
+        ''' Returns an iterator over all BSP leaves in the loaded chunks. '''
+        return (
+            leaf
+            for chunk in self.chunks.itervalues()
+                for leaf in chunk.iter_leaves()
+        )
+        
+    def iter_visleaves(self):
+        ''' Returns an iterator over all non-solid BSP leaves in the loaded 
+        chunks.
+        
+        '''
+        return (leaf for leaf in self.iter_leaves() if not leaf.solid)
+        
+    def leaf_from_coords(self, x, y):
+        ''' Given a set of coordinates, return the corresponding BSP leaf, or 
+        None if the chunk that holds them isn't loaded.
+        
+        '''
+        
+        chunk = self.chunks.get(self.get_chunk_coords(x, y))
+        
+        if chunk is None:
+            return None
+            
+        return chunk.leaf_from_coords(x, y)
+        
+    def segment_collision(self, startPos, endPos):
+        ''' Returns the first solid leaf that the given line segment collides 
+        with, if any, within the loaded chunks. Returns None if the line 
+        does not collide with any solid leaf. Chunks that aren't loaded are 
+        passed through.
+        
+        '''
+        
+        # Nudge the start of the whole segment the way a single tree would, 
+        # but not the start of each piece, since those are only seams.
+        startPos = nudge_segment_start(startPos, endPos)
+        
+        # A single tree returns the leaf that the segment starts in if it is 
+        # solid, even if the segment heads straight out of it across an edge 
+        # that here may be a chunk's edge, so that piece would be skipped.
+        startLeaf = self.leaf_from_coords(*startPos)
+        
+        if startLeaf is not None and startLeaf.solid:
+            return startLeaf
+            
+        startX, startY = startPos
+        endX, endY = endPos
+        
+        deltaX = endX - startX
+        deltaY = endY - startY
+        
+        # Find where along the segment (from 0 to 1) it crosses from one 
+        # chunk into another.
+        crossings = [0.0, 1.0]
+        
+        for start, delta, size in (
+                (startX, deltaX, self.chunkWidth),
+                (startY, deltaY, self.chunkHeight)):
+            if delta == 0:
+                continue
+                
+            low, high = sorted((start, start + delta))
+            
+            edge = (int(math.floor(float(low) / size)) + 1) * size
+            while edge < high:
+                crossings.append(float(edge - start) / delta)
+                edge += size
+                
+        crossings.sort()
+        
+        # Test each piece of the segment against the chunk that holds it.
+        for t1, t2 in zip(crossings, crossings[1:]):
+            if t1 == t2:
+                continue
+                
+            pieceStart = (startX + deltaX * t1, startY + deltaY * t1)
+            pieceEnd = (startX + deltaX * t2, startY + deltaY * t2)
+            
+            # Any point inside the piece tells which chunk it is in.
+            chunk = self.chunks.get(
+                    self.get_chunk_coords(
+                        (pieceStart[0] + pieceEnd[0]) * 0.5,
+                        (pieceStart[1] + pieceEnd[1]) * 0.5,
+                    )
+                )
+                
+            if chunk is None:
+                continue
+                
+            if t1 == 0.0:
+                pieceStart = startPos
+                
+            if t2 == 1.0:
+                pieceEnd = endPos
+                
+            result = chunk.segment_collision(
+                    pieceStart, pieceEnd, nudgeStart=False,
+                )
+            
+            if result is not None:
+                return result
+                
+        return None
+        
+        
+def main():
+    parser = argparse.ArgumentParser(
+            description="Project VIS World Chunk Splitter",
+        )
+    parser.add_argument(
+            'levelName',
+            help="path to the level, without the '-bsp.vdf' suffix",
+        )
+    parser.add_argument(
+            'chunkSize',
+            type=int,
+            help="width and height of each chunk",
+        )
+    args = parser.parse_args()
+    
+    with open("{}-bsp.vdf".format(args.levelName), 'r') as f:
+        bspTree = BSPTree.from_vdf_fast(f.read())
+        
+    chunks = split_tree_into_chunks(bspTree, args.chunkSize, args.chunkSize)
+    
+    for (chunkX, chunkY), chunk in sorted(chunks.iteritems()):
+        path = "{}-{}-{}-bsp.vdf".format(args.levelName, chunkX, chunkY)
+        
+        with open(path, 'w') as f:
+            f.write(chunk.to_vdf())
+            
+    print "Wrote {} chunks; load them with chunk_file_loader({!r})".format(
+            len(chunks), "{}-{{x}}-{{y}}-bsp.vdf".format(args.levelName),
+        )
+        
+    return 0
+    
+    
+if __name__ == '__main__':
+    sys.exit(main())